@@ -0,0 +1,81 @@
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from company.kvk import ResultsParser
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures the time to extract the companies from recorded KVK result pages, "
+        "and checks that parsing up to the stop marker finds the same companies."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "paths",
+            nargs="+",
+            help="html files or directories with html files recorded from the register",
+        )
+        parser.add_argument("--repeat", type=int, default=200)
+        parser.add_argument(
+            "--stop-marker",
+            default=settings.KVK_RESULTS_STOP_MARKER,
+            help="text that follows the results, KVK_RESULTS_STOP_MARKER by default",
+        )
+
+    def handle(self, *args, **options):
+        pages = self.load_pages(options["paths"])
+        if not pages:
+            logger.error("no result pages found")
+            return
+        repeat = options["repeat"]
+        total_size = sum(len(page) for page in pages)
+        logger.info(f"parsing {len(pages)} pages ({total_size} characters) {repeat}x")
+        parsers = [("full", ResultsParser())]
+        stop_marker = options["stop_marker"]
+        if stop_marker:
+            parsers.append(("partial", ResultsParser(stop_marker=stop_marker)))
+            mismatches = [
+                i
+                for i, page in enumerate(pages)
+                if parsers[0][1].parse(page) != parsers[1][1].parse(page)
+            ]
+            if mismatches:
+                logger.error(
+                    f"{len(mismatches)} pages parse differently up to {stop_marker!r}"
+                )
+        for name, parser in parsers:
+            company_count = sum(len(parser.parse(page).companies) for page in pages)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for page in pages:
+                    parser.parse(page)
+            duration = time.perf_counter() - start
+            self.stdout.write(
+                f"{name}: {duration / (repeat * len(pages)) * 1e6:.1f} µs per page, "
+                f"{company_count} companies in {len(pages)} pages"
+            )
+
+    @classmethod
+    def load_pages(cls, paths):
+        filepaths = []
+        for path in paths:
+            if os.path.isdir(path):
+                filepaths += [
+                    os.path.join(path, filename)
+                    for filename in sorted(os.listdir(path))
+                    if filename.endswith(".html")
+                ]
+            else:
+                filepaths.append(path)
+        pages = []
+        for filepath in filepaths:
+            with open(filepath, encoding="utf-8") as f:
+                pages.append(f.read())
+        return pages
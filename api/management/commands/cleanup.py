@@ -1,6 +1,14 @@
+import logging
+
+import numpy as np
 from django.core.management.base import BaseCommand
+
+from building.models import Address
 from building.models import Building
 from building.models import Company
+from geo.utils import haversine_array
+
+logger = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
@@ -11,14 +19,56 @@ class Command(BaseCommand):
         self.cleanup_companies()
 
     @classmethod
-    def cleanup_buildings(cls):
-        buildings = Building.objects.all()
-        for building in buildings:
-            addresses_nearby = Building.filter_nearest(
-                building, building.addresses_nearby.all()
-            )
-            building.addresses_nearby.set(addresses_nearby)
-            building.save()
+    def cleanup_buildings(cls, limit=5):
+        """
+        Removes all but the nearest addresses of each building.
+        The distances of all building/address pairs are calculated at once.
+        """
+        through = Building.addresses_nearby.through
+        pairs = np.array(
+            through.objects.values_list("id", "building_id", "address_id"),
+            dtype=np.int64,
+        ).reshape(-1, 3)
+        logger.info(f"ranking {len(pairs)} nearby addresses")
+        if len(pairs) == 0:
+            return
+        pair_ids, building_ids, address_ids = pairs.T
+
+        buildings = np.array(
+            Building.objects.order_by("id").values_list(
+                "id", "lat_min", "lat_max", "lon_min", "lon_max"
+            ),
+            dtype=np.float64,
+        ).reshape(-1, 5)
+        addresses = np.array(
+            Address.objects.order_by("id").values_list("id", "lat", "lon"),
+            dtype=np.float64,
+        ).reshape(-1, 3)
+        building_rows = np.searchsorted(buildings[:, 0], building_ids)
+        address_rows = np.searchsorted(addresses[:, 0], address_ids)
+        building_lats = (buildings[:, 1] + buildings[:, 2]) / 2
+        building_lons = (buildings[:, 3] + buildings[:, 4]) / 2
+        distances = haversine_array(
+            building_lats[building_rows],
+            building_lons[building_rows],
+            addresses[address_rows, 1],
+            addresses[address_rows, 2],
+        )
+
+        # rank the addresses of each building by distance
+        order = np.lexsort((distances, building_ids))
+        building_ids_sorted = building_ids[order]
+        group_starts = np.flatnonzero(
+            np.r_[True, building_ids_sorted[1:] != building_ids_sorted[:-1]]
+        )
+        group_sizes = np.diff(np.r_[group_starts, len(order)])
+        ranks = np.arange(len(order)) - np.repeat(group_starts, group_sizes)
+        pair_ids_delete = pair_ids[order][ranks >= limit].tolist()
+
+        logger.info(f"removing {len(pair_ids_delete)} distant nearby addresses")
+        batch_size = 500
+        for i in range(0, len(pair_ids_delete), batch_size):
+            through.objects.filter(id__in=pair_ids_delete[i : i + batch_size]).delete()
 
     @classmethod
     def cleanup_companies(cls):
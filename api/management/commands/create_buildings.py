@@ -1,8 +1,14 @@
 import logging
+import os
+import subprocess
+import sys
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
 
 from building.create import BuildingFactory
+from osm.extract import OSMExtract
 
 logger = logging.getLogger(__name__)
 
@@ -17,14 +23,62 @@ class Command(BaseCommand):
             # default="lunteren",
             help="The region to create buildings for",
         )
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=1,
+            help="The number of worker processes that create tiles in parallel. An Overpass query that runs "
+            "past its budget is killed with kill_my_queries, which kills the queries of all workers on this host",
+        )
+        parser.add_argument(
+            "--extract",
+            type=str,
+            help="A local OSM file (.osm, .osm.gz, .osm.bz2 or .osm.pbf) to read buildings and addresses from "
+            "instead of Overpass, all buildings in it (or in the region) are created in one pass",
+        )
+        parser.add_argument(
+            "--refresh",
+            action="store_true",
+            help="Update the complete tiles with the OSM changes since they were last created or refreshed",
+        )
 
     def handle(self, *args, **options):
+        if options["workers"] > 1:
+            # only creating tiles runs in worker processes
+            for option in ["region", "extract", "refresh"]:
+                if options[option]:
+                    raise CommandError(f"--workers cannot be combined with --{option}")
         try:
             region = options.get("region")
             region_bbox = BuildingFactory.get_region_bbox(region)
-            if region_bbox is not None:
+            if options["refresh"]:
+                BuildingFactory.refresh_tiles()
+            elif options["extract"] is not None:
+                extract = OSMExtract(options["extract"])
+                BuildingFactory.create_for_bbox(region_bbox, extract=extract)
+            elif region_bbox is not None:
                 BuildingFactory.create_for_bbox(region_bbox)
+            elif options["workers"] > 1:
+                self.run_workers(options["workers"])
             else:
                 BuildingFactory.create_tiles()
         except Exception as e:
             logger.exception(e)
+
+    @classmethod
+    def run_workers(cls, worker_count: int):
+        """
+        Starts worker processes that each claim and create tiles until none are left.
+        Workers on other hosts can be started with this command against the same database.
+        Overpass identifies clients by IP address, so when a query of one worker runs past its budget,
+        the queries of the other workers on this host are killed too and their sub-tiles fail.
+        """
+        logger.info(f"starting {worker_count} workers")
+        manage_path = os.path.join(settings.BASE_DIR, "manage.py")
+        processes = [
+            subprocess.Popen([sys.executable, manage_path, "create_buildings"])
+            for _ in range(worker_count)
+        ]
+        for process in processes:
+            process.wait()
+        logger.info(f"{worker_count} workers finished")
@@ -1,8 +1,11 @@
 import logging
 
 from django.core.management.base import BaseCommand
+from django.db.models import Max
+from django.db.models import Min
 
 from building.models import Building
+from osm.tile import generate_tiles
 
 logger = logging.getLogger(__name__)
 
@@ -11,5 +14,28 @@ class Command(BaseCommand):
     help = ""
 
     def handle(self, *args, **options):
-        buildings = Building.objects.all()
-        Building.update_nearby_addresses(buildings)
+        bounds = Building.objects.aggregate(
+            Min("lat_min"), Min("lon_min"), Max("lat_min"), Max("lon_min")
+        )
+        if bounds["lat_min__min"] is None:
+            return
+        # the address nodes are requested per tile to keep the Overpass queries small
+        tiles = generate_tiles(
+            min_lat=bounds["lat_min__min"],
+            min_lon=bounds["lon_min__min"],
+            max_lat=bounds["lat_min__max"] + 1e-6,
+            max_lon=bounds["lon_min__max"] + 1e-6,
+            delta_lat=0.07,
+            delta_lon=0.07,
+        )
+        for i, (lat_min, lon_min, lat_max, lon_max) in enumerate(tiles):
+            logger.info(f"updating nearby addresses for tile {i+1}/{len(tiles)}")
+            buildings = list(
+                Building.objects.filter(
+                    lat_min__gte=lat_min,
+                    lat_min__lt=lat_max,
+                    lon_min__gte=lon_min,
+                    lon_min__lt=lon_max,
+                )
+            )
+            Building.update_nearby_addresses(buildings)
@@ -142,7 +142,40 @@ REST_FRAMEWORK = {
 CORS_ORIGIN_ALLOW_ALL = True
 
 # Application settings
-KVK_SCRAPE_SLEEP_SEC = 0.8
+# Maximum average rate of requests to the KVK register, the burst is the number of requests
+# allowed at once after an idle period and concurrency the number of requests in flight
+KVK_SCRAPE_RATE_PER_SEC = 1.25
+KVK_SCRAPE_BURST = 1
+KVK_SCRAPE_CONCURRENCY = 4
+# Search the addresses of a street with one request and assign the results by their address
+KVK_SCRAPE_BY_STREET = False
+# XPath expression that matches every results page of the register, also those without results.
+# A page without it is a scraper anomaly, None only checks the markup of pages with results.
+KVK_MARKUP_ANCHOR_XPATH = None
+# Text that follows the results on every results page, the page is only parsed up to it.
+# None parses the whole page, set it from recorded pages and check it with benchmark_kvk_parser.
+KVK_RESULTS_STOP_MARKER = None
+# Backoff after a scraper malfunction, doubles with each consecutive malfunction
+KVK_BACKOFF_BASE_SEC = 60
+KVK_BACKOFF_MAX_SEC = 60 * 60
+# Directory of the on-disk caches of scraped responses, set to None to disable caching
+CACHE_DIR = os.path.join(BASE_DIR, "data", "cache")
+KVK_CACHE_TTL_SEC = 30 * 24 * 60 * 60
+KVK_CACHE_MAX_SIZE_BYTES = 500 * 1024 * 1024
+# Time after which the lease of a tile expires if its worker stops renewing it
+TILE_LEASE_SEC = 10 * 60
+# Number of concurrent Overpass queries, the public server allows about 2 per IP address
+OVERPASS_CONCURRENCY = 2
+OVERPASS_TIMEOUT_SEC = 600
+# Overpass servers to spread queries over, weighted by weight and their health,
+# a failed query is retried on another choice up to OVERPASS_RETRIES times
+OVERPASS_ENDPOINTS = [
+    {"url": "https://overpass-api.de/api/interpreter", "weight": 1},
+]
+OVERPASS_RETRIES = 3
+# Overpass responses are cached in CACHE_DIR, to replay re-runs of tiles without requests
+OVERPASS_CACHE_TTL_SEC = 7 * 24 * 60 * 60
+OVERPASS_CACHE_MAX_SIZE_BYTES = 2 * 1024 * 1024 * 1024
 
 ###########
 # LOGGING #
@@ -18,4 +18,24 @@ DATABASES = {
     }
 }
 
-# KVK_SCRAPE_SLEEP_SEC = 0.8
+# KVK_SCRAPE_RATE_PER_SEC = 1.25
+# KVK_SCRAPE_BURST = 1
+# KVK_SCRAPE_CONCURRENCY = 4
+# KVK_SCRAPE_BY_STREET = False
+# KVK_MARKUP_ANCHOR_XPATH = None
+# KVK_RESULTS_STOP_MARKER = None
+# KVK_BACKOFF_BASE_SEC = 60
+# KVK_BACKOFF_MAX_SEC = 60 * 60
+# CACHE_DIR = None
+# KVK_CACHE_TTL_SEC = 30 * 24 * 60 * 60
+# KVK_CACHE_MAX_SIZE_BYTES = 500 * 1024 * 1024
+# TILE_LEASE_SEC = 10 * 60
+# OVERPASS_CONCURRENCY = 2
+# OVERPASS_TIMEOUT_SEC = 600
+# OVERPASS_ENDPOINTS = [
+#     {"url": "https://overpass-api.de/api/interpreter", "weight": 1},
+#     {"url": "http://localhost:12345/api/interpreter", "weight": 4, "timeout_sec": 300},
+# ]
+# OVERPASS_RETRIES = 3
+# OVERPASS_CACHE_TTL_SEC = 7 * 24 * 60 * 60
+# OVERPASS_CACHE_MAX_SIZE_BYTES = 2 * 1024 * 1024 * 1024
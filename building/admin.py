@@ -81,6 +81,8 @@ class TileAdmin(admin.ModelAdmin):
         "duration",
         "building_count",
         "company_count",
+        "lease_owner",
+        "lease_expires",
         "error",
     ]
 
@@ -1,18 +1,38 @@
 import logging
+import os
+import socket
+import threading
 import time
+from datetime import datetime
+from typing import Dict
+from typing import Iterator
 from typing import List
 from typing import Optional
 from typing import Tuple
 
+from django.conf import settings
+from django.db import connection
+from django.utils import timezone
+
 from building.cities import CITIES_LARGE_NL
 from building.models import Address
 from building.models import Building
 from building.models import Company
 from building.models import Tile
+from company.kvk import CircuitBreaker
 from company.kvk import ScraperMalfunction
+from company.kvk import UittrekselRegisterScraper
+from geo.index import CompactPointIndex
+from geo.index import PointIndex
 from geo.utils import BBox
-from osm.building import get_buildings_batches
 from osm.building import OSMBuilding
+from osm.building import get_building_changes
+from osm.building import get_buildings_batches
+from osm.building import parse_timestamp
+from osm.client import AsyncOverpassClient
+from osm.core import TimestampRecorder
+from osm.core import get_pool
+from osm.extract import OSMExtract
 
 logger = logging.getLogger(__name__)
 
@@ -27,66 +47,312 @@ class BuildingFactory:
         "uden": (51.612175, 5.6340277, 51.6421757, 5.6640277),
         "utrecht": (52.1081869, 5.0961645, 52.1228383, 5.1226157),
     }
+    OSM_BATCH_SIZE = 500
 
     @classmethod
-    def create_tiles(cls):
-        tiles = Tile.objects.filter(complete=False).all()
-        for tile in tiles:
-            logger.info(f"Creating tile {tile.id}")
-            try:
-                cls.create_tile(tile)
-            except ScraperMalfunction as e:
-                logger.exception(e)
-                tile.failed = True
-                tile.error = str(e)[:9500]
-                tile.save()
-                logger.info("sleeping for 5 minutes...")
-                time.sleep(300)
-            except Exception as e:
-                logger.exception(e)
-                tile.failed = True
-                tile.error = str(e)
-            else:
-                tile.failed = False
-                tile.error = ""
-            finally:
-                tile.save()
+    def create_tiles(cls, owner: Optional[str] = None):
+        """
+        Create all incomplete tiles, claiming a lease per tile so that multiple workers
+        (processes or hosts sharing the database) can run this concurrently.
+        Every tile is attempted at most once per call.
+        """
+        owner = owner or cls.get_worker_name()
+        lease_sec = settings.TILE_LEASE_SEC
+        circuit_breaker = CircuitBreaker(
+            settings.KVK_BACKOFF_BASE_SEC, settings.KVK_BACKOFF_MAX_SEC
+        )
+        attempted_ids = []
+        while True:
+            # do not claim a tile while the scraper is backing off
+            circuit_breaker.wait()
+            tile = Tile.claim(owner, lease_sec, exclude_ids=attempted_ids)
+            if tile is None:
+                break
+            attempted_ids.append(tile.id)
+            logger.info(f"Creating tile {tile.id} as worker {owner}")
+            with TileLeaseHeartbeat(tile, lease_sec) as lease:
+                scraper_malfunction = cls._create_tile_safe(tile, lease=lease)
+            tile.release_lease()
             logger.info(f"Finished tile {tile.id}.")
+            if scraper_malfunction:
+                backoff = circuit_breaker.record_failure()
+                logger.info(f"scraper malfunction, backing off for {backoff:.0f} s")
+            else:
+                circuit_breaker.record_success()
+        logger.info(f"Worker {owner} found no more tiles to create")
 
     @classmethod
-    def create_tile(cls, tile: Tile):
+    def _create_tile_safe(
+        cls,
+        tile: Tile,
+        refresh: bool = False,
+        lease: Optional["TileLeaseHeartbeat"] = None,
+    ) -> bool:
+        """
+        Create or refresh a tile and store any error on it. Returns True if the KVK scraper malfunctioned.
+        The result is discarded if the lease of the tile was lost.
+        """
+        scraper_malfunction = False
+        try:
+            if refresh:
+                cls.refresh_tile(tile, lease=lease)
+            else:
+                cls.create_tile(tile, lease=lease)
+        except LeaseLost as e:
+            logger.warning(f"{e}, the result is discarded")
+            return False
+        except ScraperMalfunction as e:
+            logger.exception(e)
+            # the next attempt starts with a canary search
+            UittrekselRegisterScraper.health_monitor.record_anomaly(str(e))
+            tile.failed = True
+            tile.error = str(e)[:9500]
+            scraper_malfunction = True
+        except Exception as e:
+            logger.exception(e)
+            tile.failed = True
+            tile.error = str(e)
+        else:
+            tile.failed = False
+            tile.error = ""
+        if not tile.save_result():
+            logger.warning(
+                f"tile {tile.id} is leased by another worker, the result is discarded"
+            )
+        return scraper_malfunction
+
+    @classmethod
+    def get_worker_name(cls) -> str:
+        return f"{socket.gethostname()}-{os.getpid()}"
+
+    @classmethod
+    def create_tile(cls, tile: Tile, lease: Optional["TileLeaseHeartbeat"] = None):
+        """
+        Creates the buildings of a tile and sets the result on it, the caller saves the result.
+        """
         start = time.time()
-        buildings, companies = cls.create_for_bbox(tile.to_bbox())
+        synced = timezone.now() - Tile.SYNC_MARGIN
+        with get_pool().record_timestamps() as timestamps:
+            buildings, companies = cls.create_for_bbox(tile.to_bbox(), lease=lease)
+        get_pool().log_cache_stats()
+        if lease is not None:
+            lease.check()
         tile.duration = time.time() - start
         tile.building_count = len(buildings)
         tile.company_count = len(companies)
         tile.complete = True
-        tile.save()
+        tile.datetime_synced = cls._get_synced(timestamps, synced)
 
     @classmethod
-    def create_for_bbox(cls, bbox: BBox) -> Tuple[List[Building], List[Company]]:
-        buildings_osm_large = cls._get_large_osm_buildings(bbox)
-        logger.info(f"{len(buildings_osm_large)} buildings selected as large enough")
+    def refresh_tiles(cls, owner: Optional[str] = None):
+        """
+        Refreshes the complete tiles with the OSM changes since they were last synced,
+        the least recently synced first. Tiles that were never synced are created again.
+        Like create_tiles, a lease is claimed per tile so that workers can run this concurrently.
+        Stops when the KVK scraper malfunctions.
+        """
+        owner = owner or cls.get_worker_name()
+        lease_sec = settings.TILE_LEASE_SEC
+        attempted_ids = []
+        while True:
+            tile = Tile.claim(
+                owner, lease_sec, exclude_ids=attempted_ids, complete=True
+            )
+            if tile is None:
+                break
+            attempted_ids.append(tile.id)
+            logger.info(f"Refreshing tile {tile.id} as worker {owner}")
+            with TileLeaseHeartbeat(tile, lease_sec) as lease:
+                scraper_malfunction = cls._create_tile_safe(
+                    tile, refresh=True, lease=lease
+                )
+            tile.release_lease()
+            if scraper_malfunction:
+                logger.warning("scraper malfunction, stopping the refresh")
+                break
 
-        buildings: List[Building] = [
-            Building.create_from_osm(building_osm)
-            for building_osm in buildings_osm_large
+    @classmethod
+    def refresh_tile(cls, tile: Tile, lease: Optional["TileLeaseHeartbeat"] = None):
+        if tile.datetime_synced is None:
+            cls.create_tile(tile, lease=lease)
+            return
+        start = time.time()
+        synced = timezone.now() - Tile.SYNC_MARGIN
+        with get_pool().record_timestamps() as timestamps:
+            buildings, companies, timestamp = cls.refresh_for_bbox(
+                tile.to_bbox(), tile.datetime_synced
+            )
+        if lease is not None:
+            lease.check()
+        tile.duration = time.time() - start
+        tile.datetime_synced = cls._get_synced(timestamps, timestamp or synced)
+
+    @classmethod
+    def _get_synced(cls, timestamps: TimestampRecorder, synced: datetime) -> datetime:
+        """
+        The time up to which a tile has the OSM changes. Responses from the Overpass cache
+        can be days old, so it is never later than the oldest OSM timestamp of the responses used.
+        """
+        if timestamps.oldest is None:
+            return synced
+        return min(synced, parse_timestamp(timestamps.oldest))
+
+    @classmethod
+    def refresh_for_bbox(
+        cls, bbox: BBox, since: datetime
+    ) -> Tuple[List[Building], List[Company], Optional[datetime]]:
+        """
+        Applies the OSM changes since a time to the buildings with their center in the bbox.
+        Changed buildings are updated, removed buildings and addresses are deleted, and the address
+        and company stages are run again only for changed buildings and buildings near changed
+        or removed addresses.
+        Returns the updated buildings, their companies and the time of the OSM data.
+        """
+        changes = get_building_changes(bbox, since)
+        logger.info(
+            f"{len(changes.ways)} building ways and {len(changes.address_nodes)} address nodes changed since {since}"
+        )
+        osm_buildings = [
+            OSMBuilding.create_from_osm_way(way)
+            for way in changes.ways
+            if way["id"] in changes.way_ids
         ]
+        osm_buildings_large = OSMBuilding.filter_by_area(osm_buildings)
+        way_ids_changed = {way["id"] for way in changes.ways}
+        way_ids_large = {osm_building.id for osm_building in osm_buildings_large}
 
-        addresses = cls._get_addresses_for_buildings(buildings)
+        buildings_stored = Building.get_in_bbox(bbox)
+        buildings_removed = [
+            building
+            for building in buildings_stored
+            if building.way_id not in changes.way_ids
+            or (
+                building.way_id in way_ids_changed
+                and building.way_id not in way_ids_large
+            )
+        ]
+        company_ids_removed = {
+            building.company_id
+            for building in buildings_removed
+            if building.company_id is not None
+        }
+        Building.objects.filter(
+            id__in=[building.id for building in buildings_removed]
+        ).delete()
+        logger.info(f"deleted {len(buildings_removed)} removed buildings")
+        # deleting an address deletes its companies
+        addresses_removed = [
+            address
+            for address in Address.get_in_bbox(bbox)
+            if address.node_id not in changes.address_node_ids
+        ]
+        Address.objects.filter(
+            id__in=[address.id for address in addresses_removed]
+        ).delete()
+        logger.info(f"deleted {len(addresses_removed)} removed addresses")
+
+        buildings = Building.create_from_osm_many(osm_buildings_large)
+        logger.info(f"{len(buildings)} changed buildings updated")
+        # buildings near changed or removed addresses get their addresses again
+        address_index = PointIndex.from_nodes(
+            changes.address_nodes
+            + [
+                {"lat": address.lat, "lon": address.lon}
+                for address in addresses_removed
+            ]
+        )
+        way_ids_skip = way_ids_large | {b.way_id for b in buildings_removed}
+        buildings += [
+            building
+            for building in buildings_stored
+            if building.way_id not in way_ids_skip
+            and address_index.count_within(
+                building.center.lat, building.center.lon, Building.ADDRESS_DISTANCE_MAX
+            )
+            > 0
+        ]
+
+        companies = cls._update_for_buildings(buildings)
+        # the animal count of companies of removed buildings changes
+        Company.update_companies(Company.objects.filter(id__in=company_ids_removed))
+        logger.info(f"Successfully refreshed {len(buildings)} buildings")
+        return buildings, companies, changes.timestamp
+
+    @classmethod
+    def create_for_bbox(
+        cls,
+        bbox: Optional[BBox],
+        extract: Optional[OSMExtract] = None,
+        lease: Optional["TileLeaseHeartbeat"] = None,
+    ) -> Tuple[List[Building], List[Company]]:
+        """
+        Creates the buildings in the bbox with data from Overpass, or from a local OSM extract.
+        With an extract the bbox is optional, without it all buildings in the extract are created.
+        The buildings are stored per batch while they stream in, the addresses and companies are
+        updated per batch once the stream is finished. The Overpass queries hold their slots
+        until their stream is read, so the address queries and slow KVK searches cannot run
+        while it is open.
+        With the lease of a tile, creating stops between batches once the lease is lost.
+        """
+        address_index = None
+        if extract is not None:
+            # reading the extract is slow, so its address nodes are read once for all batches
+            address_index = cls._get_extract_address_index(extract, bbox)
+        batches: List[List[Building]] = []
+        buildings_osm = cls._get_large_osm_buildings(
+            bbox, batch_size=cls.OSM_BATCH_SIZE, extract=extract
+        )
+        for buildings_osm_large in buildings_osm:
+            if lease is not None:
+                lease.check()
+            batches.append(Building.create_from_osm_many(buildings_osm_large))
+        buildings: List[Building] = []
+        companies: Dict[int, Company] = {}
+        for batch in batches:
+            if lease is not None:
+                lease.check()
+            buildings += batch
+            for company in cls._update_for_buildings(batch, address_index):
+                companies[company.id] = company
+        logger.info(f"Successfully created {len(buildings)} buildings")
+        return buildings, list(companies.values())
+
+    @classmethod
+    def _get_extract_address_index(
+        cls, extract: OSMExtract, bbox: Optional[BBox]
+    ) -> PointIndex:
+        # without bbox these are all address nodes of the country, so they are kept packed in arrays
+        if bbox is not None:
+            bbox = bbox.expand(Building.ADDRESS_DISTANCE_MAX + Address.NEARBY_DISTANCE)
+        nodes = extract.read_address_nodes(bbox)
+        logger.info(f"{len(nodes)} address nodes read from {extract}")
+        return CompactPointIndex(nodes, nodes.lats, nodes.lons)
+
+    @classmethod
+    def _update_for_buildings(
+        cls, buildings: List[Building], address_index: Optional[PointIndex] = None
+    ) -> List[Company]:
+        """
+        Runs the address and company stages for the buildings, returns the companies found.
+        Without an index of address nodes, the address nodes near the buildings are requested.
+        """
+        addresses = cls._get_addresses_for_buildings(buildings, address_index)
         companies = Address.update_companies(addresses)
         Company.update_companies(companies)
 
         logger.info(f"finding companies for buildings")
-        for building in buildings:
-            building.update_company()
-
-        logger.info(f"Successfully created {len(buildings)} buildings")
-        return buildings, companies
+        Building.update_companies(buildings)
+        return companies
 
     @classmethod
-    def _get_addresses_for_buildings(cls, buildings):
-        addresses = Building.update_nearby_addresses(buildings)
+    def _get_addresses_for_buildings(
+        cls, buildings: List[Building], address_index: Optional[PointIndex] = None
+    ) -> List[Address]:
+        if address_index is None:
+            address_index = PointIndex.from_nodes(Building.get_address_nodes(buildings))
+        addresses = Building.update_nearby_addresses(
+            buildings, address_index=address_index
+        )
         addresses_before = len(addresses)
         addresses = list(set(addresses))
         logger.info(
@@ -102,11 +368,8 @@ class BuildingFactory:
         logger.info(
             f"removed {addresses_before - len(addresses)} addresses in large cities. {len(addresses)} left."
         )
-        for i, address in enumerate(addresses):
-            logger.info(
-                f"finding nearby address count for address {i + 1}/{len(addresses)}"
-            )
-            address.update_addresses_nearby_count()
+        logger.info(f"finding nearby address count for {len(addresses)} addresses")
+        Address.update_addresses_nearby_counts(addresses, address_index)
         addresses_before = len(addresses)
         addresses = [
             address
@@ -119,14 +382,52 @@ class BuildingFactory:
         return addresses
 
     @classmethod
-    def _get_large_osm_buildings(cls, bbox) -> List[OSMBuilding]:
-        buildings_raw = get_buildings_batches(bbox)
-        buildings_osm: List[OSMBuilding] = []
+    def _get_large_osm_buildings(
+        cls,
+        bbox: Optional[BBox],
+        batch_size: int = OSM_BATCH_SIZE,
+        extract: Optional[OSMExtract] = None,
+    ) -> Iterator[List[OSMBuilding]]:
+        """
+        Yields the buildings in the bbox that are large enough, in batches of buildings found,
+        so that only one batch of OSM buildings is kept in memory.
+        """
+        if extract is not None:
+            buildings_raw = extract.get_buildings_batches(bbox)
+        else:
+            client = AsyncOverpassClient(
+                max_concurrent=settings.OVERPASS_CONCURRENCY,
+                timeout_sec=settings.OVERPASS_TIMEOUT_SEC,
+            )
+            buildings_raw = get_buildings_batches(bbox, client=client)
+        count = 0
+        batch: List[OSMBuilding] = []
         for building_raw in buildings_raw:
-            buildings_osm.append(OSMBuilding.create_from_osm_way(building_raw))
-        logger.info(f"{len(buildings_osm)} buildings found")
-        buildings_osm_large = OSMBuilding.filter_by_area(buildings_osm)
-        return buildings_osm_large
+            batch.append(OSMBuilding.create_from_osm_way(building_raw))
+            if len(batch) == batch_size:
+                count += len(batch)
+                yield cls._filter_large(batch)
+                batch = []
+        if batch:
+            count += len(batch)
+            yield cls._filter_large(batch)
+        logger.info(f"{count} buildings found")
+
+    @classmethod
+    def _filter_large(cls, osm_buildings: List[OSMBuilding]) -> List[OSMBuilding]:
+        """
+        Filters the buildings by area. Stored buildings that are unchanged were large enough before,
+        they are kept without calculating their geometry.
+        """
+        hashes_stored = Building.get_stored_hashes([b.id for b in osm_buildings])
+        unchanged = []
+        changed = []
+        for osm_building in osm_buildings:
+            if hashes_stored.get(osm_building.id) == osm_building.content_hash:
+                unchanged.append(osm_building)
+            else:
+                changed.append(osm_building)
+        return unchanged + OSMBuilding.filter_by_area(changed)
 
     @classmethod
     def get_region_bbox(cls, region: Optional[str]) -> Optional[BBox]:
@@ -140,3 +441,44 @@ class BuildingFactory:
                 lat_max=region_bbox[2],
             )
         return None
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class TileLeaseHeartbeat:
+    """
+    Renews the lease of a tile in a background thread while the tile is being created,
+    so that long-running tiles are not reclaimed by other workers.
+    If a renewal fails the lease is lost, check() then raises LeaseLost to stop the work.
+    """
+
+    def __init__(self, tile: Tile, lease_sec: float):
+        self.tile = tile
+        self.lease_sec = lease_sec
+        self.lost = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> "TileLeaseHeartbeat":
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        try:
+            while not self._stop.wait(self.lease_sec / 4):
+                if not self.tile.renew_lease(self.lease_sec):
+                    logger.error(f"lost lease of tile {self.tile.id}")
+                    self.lost.set()
+                    break
+        finally:
+            connection.close()
+
+    def check(self) -> None:
+        if self.lost.is_set():
+            raise LeaseLost(f"lost lease of tile {self.tile.id}")
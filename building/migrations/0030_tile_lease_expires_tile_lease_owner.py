@@ -0,0 +1,25 @@
+# Generated by Django 5.0.7 on 2026-10-18 07:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("building", "0029_alter_company_animal_type_main"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="tile",
+            name="lease_expires",
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="tile",
+            name="lease_owner",
+            field=models.CharField(
+                blank=True, db_index=True, default="", max_length=200
+            ),
+        ),
+    ]
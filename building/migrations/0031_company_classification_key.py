@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 07:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("building", "0030_tile_lease_expires_tile_lease_owner"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="company",
+            name="classification_key",
+            field=models.CharField(blank=True, default="", max_length=40),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.7 on 2026-10-18 08:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("building", "0031_company_classification_key"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="tile",
+            name="datetime_synced",
+            field=models.DateTimeField(null=True),
+        ),
+    ]
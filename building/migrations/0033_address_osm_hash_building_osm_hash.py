@@ -0,0 +1,23 @@
+# Generated by Django 5.0.7 on 2026-10-18 08:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("building", "0032_tile_datetime_synced"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="address",
+            name="osm_hash",
+            field=models.CharField(blank=True, default="", max_length=32),
+        ),
+        migrations.AddField(
+            model_name="building",
+            name="osm_hash",
+            field=models.CharField(blank=True, default="", max_length=32),
+        ),
+    ]
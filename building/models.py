@@ -1,27 +1,44 @@
+import json
 import logging
 import math
-import time
 from dataclasses import dataclass
+from datetime import timedelta
+from functools import lru_cache
 from typing import Dict
+from typing import Iterable
 from typing import List
 from typing import Optional
+from typing import Sequence
 
+import numpy as np
 from django.conf import settings
 from django.db import models
+from django.db import transaction
+from django.db.models import F
 from django.db.models import Q
 from django.db.models import QuerySet
+from django.db.models import Sum
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 from pydantic import BaseModel
 
+from company.classifier import Classification
+from company.classifier import DescriptionClassifier
 from company.kvk import ScraperMalfunction
 from company.kvk import UittrekselRegisterScraper
+from geo.index import PointIndex
 from geo.utils import BBox
+from geo.utils import haversine
+from geo.utils import haversine_array
 from osm.building import OSMBuilding
 from osm.building import get_address_nearby
-
+from osm.building import get_addresses_in_bbox
+from osm.building import get_content_hash
 
 logger = logging.getLogger(__name__)
 
+DESCRIPTION_CLASSIFIER = DescriptionClassifier()
+
 
 class Coordinate(BaseModel):
     lat: float
@@ -39,18 +56,44 @@ class Coordinate(BaseModel):
         """
         The haversine distance between two coordinates
         """
-        R = 6371 * 1000  # Radius of the Earth in meters
+        return haversine(coord1.lat, coord1.lon, coord2.lat, coord2.lon)
 
-        dLat = cls.to_radians(coord2.lat - coord1.lat)
-        dLon = cls.to_radians(coord2.lon - coord1.lon)
-        rLat1 = cls.to_radians(coord1.lat)
-        rLat2 = cls.to_radians(coord2.lat)
+    def distances_to(self, lats: Sequence[float], lons: Sequence[float]) -> np.ndarray:
+        """
+        The haversine distances to arrays of latitudes and longitudes
+        """
+        return haversine_array(self.lat, self.lon, lats, lons)
 
-        a = math.sin(dLat / 2) * math.sin(dLat / 2) + math.sin(dLon / 2) * math.sin(
-            dLon / 2
-        ) * math.cos(rLat1) * math.cos(rLat2)
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-        return R * c
+    @classmethod
+    def distance_matrix(
+        cls,
+        lats1: Sequence[float],
+        lons1: Sequence[float],
+        lats2: Sequence[float],
+        lons2: Sequence[float],
+    ) -> np.ndarray:
+        """
+        The haversine distances between all pairs of two arrays of coordinates, as n x m matrix
+        """
+        return haversine_array(
+            np.asarray(lats1)[:, np.newaxis],
+            np.asarray(lons1)[:, np.newaxis],
+            np.asarray(lats2)[np.newaxis, :],
+            np.asarray(lons2)[np.newaxis, :],
+        )
+
+    def nearest_indices(
+        self, lats: Sequence[float], lons: Sequence[float], k: int
+    ) -> np.ndarray:
+        """
+        The indices of the k nearest of the given coordinates, nearest first
+        """
+        distances = self.distances_to(lats, lons)
+        if k < len(distances):
+            indices = np.argpartition(distances, k - 1)[:k]
+        else:
+            indices = np.arange(len(distances))
+        return indices[np.argsort(distances[indices], kind="stable")]
 
 
 class Tile(models.Model):
@@ -65,10 +108,27 @@ class Tile(models.Model):
     duration = models.FloatField(null=True)
     building_count = models.IntegerField(null=True)
     company_count = models.IntegerField(null=True)
+    lease_owner = models.CharField(
+        null=False, default="", max_length=200, blank=True, db_index=True
+    )
+    lease_expires = models.DateTimeField(null=True, db_index=True)
+    # the time of the OSM data of the last successful run, changes after it are refreshed
+    datetime_synced = models.DateTimeField(null=True)
     datetime_created = models.DateTimeField(auto_now_add=True, null=False)
     datetime_updated = models.DateTimeField(auto_now=True, null=False)
 
     LEVEL_DEFAULT = 10
+    RESULT_FIELDS = [
+        "complete",
+        "failed",
+        "error",
+        "duration",
+        "building_count",
+        "company_count",
+        "datetime_synced",
+    ]
+    # Overpass data lags behind the OSM database, a sync time without OSM timestamp is moved back
+    SYNC_MARGIN = timedelta(hours=1)
 
     @classmethod
     def from_bbox(cls, bbox: BBox) -> "Tile":
@@ -89,6 +149,77 @@ class Tile(models.Model):
             lat_max=self.lat_max,
         )
 
+    @classmethod
+    def claim(
+        cls,
+        owner: str,
+        lease_sec: float,
+        exclude_ids: Iterable[int] = (),
+        complete: bool = False,
+    ) -> Optional["Tile"]:
+        """
+        Claim the lease of an incomplete tile that is not leased, or whose lease has expired.
+        With complete, claim the least recently synced complete tile instead, to refresh it.
+        The claim is a single conditional UPDATE, so concurrent workers never get the same tile.
+        """
+        exclude_ids = list(exclude_ids)
+        if complete:
+            order_by = [F("datetime_synced").asc(nulls_first=True), "id"]
+        else:
+            order_by = ["id"]
+        while True:
+            now = timezone.now()
+            available = Q(lease_expires__isnull=True) | Q(lease_expires__lt=now)
+            tile_id = (
+                cls.objects.filter(complete=complete)
+                .filter(available)
+                .exclude(id__in=exclude_ids)
+                .order_by(*order_by)
+                .values_list("id", flat=True)
+                .first()
+            )
+            if tile_id is None:
+                return None
+            claimed = (
+                cls.objects.filter(id=tile_id, complete=complete)
+                .filter(available)
+                .update(
+                    lease_owner=owner,
+                    lease_expires=now + timedelta(seconds=lease_sec),
+                )
+            )
+            if claimed:
+                return cls.objects.get(id=tile_id)
+            logger.info(f"tile {tile_id} was claimed by another worker, retrying")
+
+    def renew_lease(self, lease_sec: float) -> bool:
+        lease_expires = timezone.now() + timedelta(seconds=lease_sec)
+        renewed = Tile.objects.filter(id=self.id, lease_owner=self.lease_owner).update(
+            lease_expires=lease_expires
+        )
+        if renewed:
+            self.lease_expires = lease_expires
+        return bool(renewed)
+
+    def save_result(self) -> bool:
+        """
+        Saves the result fields while this worker holds the lease, returns False if it does not.
+        The lease fields are never written, so a worker that lost its lease cannot overwrite
+        the lease or the result of the worker that reclaimed the tile.
+        """
+        values = {field: getattr(self, field) for field in self.RESULT_FIELDS}
+        saved = Tile.objects.filter(id=self.id, lease_owner=self.lease_owner).update(
+            datetime_updated=timezone.now(), **values
+        )
+        return bool(saved)
+
+    def release_lease(self) -> None:
+        Tile.objects.filter(id=self.id, lease_owner=self.lease_owner).update(
+            lease_owner="", lease_expires=None
+        )
+        self.lease_owner = ""
+        self.lease_expires = None
+
 
 class Address(models.Model):
     node_id = models.BigIntegerField(unique=True, null=False, db_index=True)
@@ -99,32 +230,89 @@ class Address(models.Model):
     postcode = models.CharField(max_length=200, null=True)
     city = models.CharField(max_length=200, null=True)
     addresses_nearby_count = models.IntegerField(null=True)
+    osm_hash = models.CharField(max_length=32, default="", blank=True)
+
+    NEARBY_DISTANCE = 100  # in m
+    OSM_FIELDS = ["street", "housenumber", "postcode", "city", "lat", "lon", "osm_hash"]
 
     @property
     def coordinate(self) -> Coordinate:
         return Coordinate(lat=self.lat, lon=self.lon)
 
+    @classmethod
+    def get_in_bbox(cls, bbox: BBox) -> QuerySet["Address"]:
+        return cls.objects.filter(
+            lat__gte=bbox.lat_min,
+            lat__lte=bbox.lat_max,
+            lon__gte=bbox.lon_min,
+            lon__lte=bbox.lon_max,
+        )
+
     @staticmethod
     def get_or_create_from_node(node) -> Optional["Address"]:
-        tags = node["tags"]
-        street = tags.get("addr:street")
-        housenumber = tags.get("addr:housenumber")
-        if street is None or housenumber is None:
-            return None
-        postcode = tags.get("addr:postcode")
-        city = tags.get("addr:city")
-        address, _created = Address.objects.update_or_create(
-            node_id=node["id"],
-            defaults=dict(
+        return Address.create_from_nodes([node]).get(node["id"])
+
+    @classmethod
+    def create_from_nodes(
+        cls, nodes: List[Dict], batch_size=500
+    ) -> Dict[int, "Address"]:
+        """
+        Creates or updates (by node_id) the addresses of OSM nodes in bulk.
+        Addresses of which the node hash is unchanged are not written.
+        Returns the stored addresses by node id, nodes without street or housenumber are skipped.
+        """
+        addresses_new = {}
+        for node in nodes:
+            tags = node["tags"]
+            street = tags.get("addr:street")
+            housenumber = tags.get("addr:housenumber")
+            if street is None or housenumber is None:
+                continue
+            addresses_new[node["id"]] = Address(
+                node_id=node["id"],
                 street=street,
                 housenumber=housenumber,
-                postcode=postcode,
-                city=city,
+                postcode=tags.get("addr:postcode"),
+                city=tags.get("addr:city"),
                 lat=node["lat"],
                 lon=node["lon"],
-            ),
-        )
-        return address
+                osm_hash=cls.get_node_hash(node),
+            )
+        addresses_new = list(addresses_new.values())
+        addresses = {}
+        for i in range(0, len(addresses_new), batch_size):
+            batch = addresses_new[i : i + batch_size]
+            hashes_stored = dict(
+                Address.objects.filter(
+                    node_id__in=[address.node_id for address in batch]
+                ).values_list("node_id", "osm_hash")
+            )
+            batch_changed = [
+                address
+                for address in batch
+                if hashes_stored.get(address.node_id) != address.osm_hash
+            ]
+            if batch_changed:
+                Address.objects.bulk_create(
+                    batch_changed,
+                    update_conflicts=True,
+                    unique_fields=["node_id"],
+                    update_fields=cls.OSM_FIELDS,
+                )
+            addresses.update(
+                Address.objects.in_bulk(
+                    [address.node_id for address in batch], field_name="node_id"
+                )
+            )
+        return addresses
+
+    @staticmethod
+    def get_node_hash(node: Dict) -> str:
+        """
+        A hash of the tags and coordinates of an OSM node, to detect changed nodes
+        """
+        data = json.dumps([node["lat"], node["lon"], node["tags"]], sort_keys=True)
+        return get_content_hash(data.encode())
 
     def __str__(self):
         return f"{self.street} {self.housenumber}, {self.city}"
@@ -141,32 +329,72 @@ class Address(models.Model):
         return NotImplemented
 
     def update_addresses_nearby_count(self):
-        nodes = get_address_nearby(self.lat, self.lon, distance=100)
+        nodes = get_address_nearby(self.lat, self.lon, distance=self.NEARBY_DISTANCE)
         self.addresses_nearby_count = len(nodes)
         self.save()
 
     @classmethod
-    def update_companies(cls, addresses: List["Address"]) -> List["Company"]:
+    def update_addresses_nearby_counts(
+        cls, addresses: List["Address"], address_index: PointIndex
+    ) -> None:
+        """
+        Counts the address nodes near each address with an index of address nodes,
+        which should include all nodes within NEARBY_DISTANCE of the addresses.
+        """
+        counts = address_index.count_within_many(
+            [(address.lat, address.lon) for address in addresses],
+            radius=cls.NEARBY_DISTANCE,
+        )
+        for address, count in zip(addresses, counts):
+            address.addresses_nearby_count = count
+        Address.objects.bulk_update(
+            addresses, ["addresses_nearby_count"], batch_size=500
+        )
+
+    @classmethod
+    def update_companies(
+        cls, addresses: List["Address"], check_interval=20
+    ) -> List["Company"]:
+        """
+        Finds the companies of the addresses in the KVK register.
+        Requests are done concurrently, paced by the rate limit of the scraper.
+        With KVK_SCRAPE_BY_STREET, addresses that share a street are searched with one request.
+        The health of the scraper is checked every check_interval addresses.
+        """
         companies = []
+        by_street = settings.KVK_SCRAPE_BY_STREET
+        if by_street:
+            addresses = sorted(
+                addresses, key=lambda address: (address.city or "", address.street)
+            )
         # TODO BR: (optionally) only update addresses without related company
-        for i, address in enumerate(addresses):
-            logger.info(f"finding company for address {i+1}/{len(addresses)}")
-            if i % 20 == 0:
-                if not UittrekselRegisterScraper.check_is_working():
-                    raise ScraperMalfunction("Scraper is not giving expected results!")
-            companies_kvk = UittrekselRegisterScraper.get_companies_for_address(
-                str(address)
+        for i in range(0, len(addresses), check_interval):
+            batch = addresses[i : i + check_interval]
+            logger.info(
+                f"finding companies for addresses {i+1}-{i+len(batch)}/{len(addresses)}"
             )
-            for c in companies_kvk:
-                company, _created = Company.objects.get_or_create(
-                    address=address, description=c.description, active=c.active
+            if not UittrekselRegisterScraper.check_health():
+                raise ScraperMalfunction("Scraper is not giving expected results!")
+            if by_street:
+                results = (
+                    UittrekselRegisterScraper.get_companies_for_addresses_by_street(
+                        [
+                            (address.street, address.housenumber, address.city)
+                            for address in batch
+                        ]
+                    )
+                )
+            else:
+                results = UittrekselRegisterScraper.get_companies_for_addresses(
+                    [str(address) for address in batch]
                 )
-                companies.append(company)
-            # rate limit to prevent unintentional DOS
-            time.sleep(settings.KVK_SCRAPE_SLEEP_SEC)
-            if (i + 1) % 250 == 0:
-                logger.info(f"time to sleep a few minutes")
-                time.sleep(60)
+            for address, companies_kvk in zip(batch, results):
+                for c in companies_kvk:
+                    company, _created = Company.objects.get_or_create(
+                        address=address, description=c.description, active=c.active
+                    )
+                    companies.append(company)
+        UittrekselRegisterScraper.log_cache_stats()
         return companies
 
 
@@ -217,6 +445,23 @@ class Company(models.Model):
     other_activities = models.BooleanField(default=False, null=False, db_index=True)
     animal_type_main = models.CharField(max_length=3, choices=Animal, null=True)
     animal_count = models.IntegerField(null=False, default=0)
+    classification_key = models.CharField(
+        null=False, default="", max_length=40, blank=True
+    )
+
+    UPDATE_FIELDS = [
+        "chicken",
+        "pig",
+        "cattle",
+        "cattle_beef",
+        "cattle_dairy",
+        "sheep",
+        "goat",
+        "other_activities",
+        "animal_type_main",
+        "animal_count",
+        "classification_key",
+    ]
 
     @property
     def has_type(self) -> bool:
@@ -235,137 +480,108 @@ class Company(models.Model):
         return Company.objects.filter(active=True).exclude(animal_type_main=None)
 
     def update(self, save=True):
-        self._update_animal_type()
-        self._update_animal_count()
+        """
+        Updates the animal type and count of the company, like update_companies.
+        """
         if save:
-            self.save()
+            Company.update_companies([self])
+        else:
+            self._update_animal_type()
+            Company._update_animal_counts([self])
 
     @classmethod
-    def update_companies(cls, companies: List["Company"]) -> None:
+    def update_companies(cls, companies: Iterable["Company"], batch_size=500) -> None:
+        """
+        Updates the animal type and count of the companies, in batches.
+        The building area per company is summed with one aggregate query per batch
+        and the results are written with bulk_update.
+        """
+        companies = list(companies)
         logger.info(f"updating {len(companies)} companies")
-        for i, company in enumerate(companies):
-            if i % 100 == 0:
-                logger.info(
-                    f"determining type for company {i+1}/{len(companies)} ({(i/len(companies)*100):.2f}%)"
-                )
-            company.update(save=True)
+        classified_count = 0
+        for i in range(0, len(companies), batch_size):
+            logger.info(
+                f"determining type for company {i+1}/{len(companies)} ({(i/len(companies)*100):.2f}%)"
+            )
+            batch = companies[i : i + batch_size]
+            companies_changed = []
+            keys = []
+            for company in batch:
+                key = DESCRIPTION_CLASSIFIER.get_key(company.description)
+                if company.classification_key != key:
+                    companies_changed.append(company)
+                    keys.append(key)
+            classifications = DESCRIPTION_CLASSIFIER.classify_many(
+                company.description for company in companies_changed
+            )
+            for company, classification, key in zip(
+                companies_changed, classifications, keys
+            ):
+                company.apply_classification(classification)
+                company.classification_key = key
+                classified_count += 1
+            cls._update_animal_counts(batch)
+            Company.objects.bulk_update(batch, cls.UPDATE_FIELDS)
+        logger.info(
+            f"classified {classified_count}/{len(companies)} companies with a changed description or classifier version, {DESCRIPTION_CLASSIFIER.cache_info()}"
+        )
 
-    def _update_animal_type(self) -> None:
-        cattle_words = ["melkvee", "rundvee", "kalveren"]
-        dairy_cattle_words = ["melkvee"]
-        beef_cattle_words = ["rundvee", "vleeskalveren", "kalveren"]
-        chicken_words = ["pluimvee", "kippen", "kuikens", "hennen"]
-        pig_words = ["varken", "zeug"]
-        sheep_words = ["schaap", "schapen"]
-        goat_words = ["geit"]
-        other_activities_words = [
-            "dienstverlening",
-            "arbeidskrachten",
-            "loonwerk",
-            "loonbedrijf",
-            "teelt",
-        ]
-        description = self.description.lower()
-        self.cattle = any(word in description for word in cattle_words)
-        self.cattle_beef = any(word in description for word in beef_cattle_words)
-        self.cattle_dairy = any(word in description for word in dairy_cattle_words)
-        if "geen melkvee" in description or "niet melkvee" in description:
-            self.cattle_dairy = False
-        self.chicken = any(word in description for word in chicken_words)
-        self.pig = any(word in description for word in pig_words)
-        self.sheep = any(word in description for word in sheep_words)
-        self.goat = any(word in description for word in goat_words)
-        self.other_activities = any(
-            word in description for word in other_activities_words
+    @classmethod
+    def _update_animal_counts(cls, companies: List["Company"]) -> None:
+        area_totals = dict(
+            Company.objects.filter(id__in=[company.id for company in companies])
+            .annotate(area_total=Sum("building__area"))
+            .values_list("id", "area_total")
         )
-        self.animal_type_main = self._determine_main_type()
+        for company in companies:
+            area_total = area_totals.get(company.id) or 0
+            company.animal_count = int(
+                area_total / company.animal_config.minimal_square_meter_per_animal
+            )
 
-    def _determine_main_type(self) -> Animal:
+    def _update_animal_type(self) -> None:
+        self.apply_classification(DESCRIPTION_CLASSIFIER.classify(self.description))
+        self.classification_key = DESCRIPTION_CLASSIFIER.get_key(self.description)
+
+    def apply_classification(self, classification: Classification) -> None:
+        for flag in DescriptionClassifier.FLAGS:
+            setattr(self, flag, getattr(classification, flag))
+        self.animal_type_main = self.determine_main_type(classification)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def determine_main_type(c: Classification) -> Optional[Animal]:
         main_type = None
-        if self.chicken and not any(
-            [
-                self.cattle_dairy,
-                self.cattle_beef,
-                self.pig,
-                self.goat,
-                self.sheep,
-            ]
+        if c.chicken and not any(
+            (c.cattle_dairy, c.cattle_beef, c.pig, c.goat, c.sheep)
         ):
             main_type = Animal.CHICKEN
-        elif self.pig and not any(
-            [
-                self.cattle_dairy,
-                self.cattle_beef,
-                self.chicken,
-                self.goat,
-                self.sheep,
-            ]
+        elif c.pig and not any(
+            (c.cattle_dairy, c.cattle_beef, c.chicken, c.goat, c.sheep)
         ):
             main_type = Animal.PIG
-        elif self.cattle_beef and not any(
-            [
-                self.cattle_dairy,
-                self.pig,
-                self.chicken,
-                self.goat,
-                self.sheep,
-            ]
+        elif c.cattle_beef and not any(
+            (c.cattle_dairy, c.pig, c.chicken, c.goat, c.sheep)
         ):
             main_type = Animal.COW_BEEF
-        elif self.cattle_dairy and not any(
-            [
-                self.cattle_beef,
-                self.pig,
-                self.chicken,
-                self.goat,
-                self.sheep,
-            ]
+        elif c.cattle_dairy and not any(
+            (c.cattle_beef, c.pig, c.chicken, c.goat, c.sheep)
         ):
             main_type = Animal.COW_DAIRY
-        elif self.sheep and not any(
-            [
-                self.cattle,
-                self.cattle_beef,
-                self.cattle_dairy,
-                self.pig,
-                self.chicken,
-                self.goat,
-            ]
+        elif c.sheep and not any(
+            (c.cattle, c.cattle_beef, c.cattle_dairy, c.pig, c.chicken, c.goat)
         ):
             main_type = Animal.SHEEP
-        elif self.goat and not any(
-            [
-                self.cattle,
-                self.cattle_beef,
-                self.cattle_dairy,
-                self.pig,
-                self.chicken,
-                self.sheep,
-            ]
+        elif c.goat and not any(
+            (c.cattle, c.cattle_beef, c.cattle_dairy, c.pig, c.chicken, c.sheep)
         ):
             main_type = Animal.GOAT
         elif any(
-            [
-                self.cattle,
-                self.cattle_beef,
-                self.cattle_dairy,
-                self.pig,
-                self.chicken,
-                self.sheep,
-                self.goat,
-            ]
+            (c.cattle, c.cattle_beef, c.cattle_dairy, c.pig, c.chicken, c.sheep, c.goat)
         ):
             main_type = Animal.COMBINED
         return main_type
 
-    def _update_animal_count(self) -> None:
-        animal_count = 0
-        for building in self.building_set.all():
-            animal_count += (
-                building.area / self.animal_config.minimal_square_meter_per_animal
-            )
-        self.animal_count = animal_count
-
 
 class Building(models.Model):
     way_id = models.BigIntegerField(unique=True, null=False, db_index=True)
@@ -380,8 +596,22 @@ class Building(models.Model):
     company = models.ForeignKey(Company, null=True, on_delete=models.SET_NULL)
     addresses_nearby = models.ManyToManyField(Address)
     addresses_nearby_count = models.IntegerField(null=False, default=0)
+    osm_hash = models.CharField(max_length=32, default="", blank=True)
 
     MAX_ADDRESSES_NEARBY = 10
+    OSM_FIELDS = [
+        "osm_raw",
+        "osm_hash",
+        "lon_min",
+        "lon_max",
+        "lat_min",
+        "lat_max",
+        "area",
+        "length",
+        "width",
+    ]
+    ADDRESS_DISTANCE = 100  # in m
+    ADDRESS_DISTANCE_MAX = 200  # in m
 
     @property
     def geometry(self) -> List[Dict[str, float]]:
@@ -399,64 +629,295 @@ class Building(models.Model):
 
     @classmethod
     def create_from_osm(cls, osm_building: OSMBuilding) -> "Building":
+        return cls.create_from_osm_many([osm_building])[0]
+
+    @classmethod
+    def create_from_osm_many(
+        cls, osm_buildings: List[OSMBuilding], batch_size=500
+    ) -> List["Building"]:
+        """
+        Creates or updates (by way_id) the buildings in bulk, with an upsert per batch.
+        Buildings of which the OSM content hash is unchanged are not written,
+        and their geometry is not calculated.
+        Returns the stored buildings, without osm_raw loaded, in the order of osm_buildings.
+        """
+        buildings = []
+        unchanged_count = 0
+        for i in range(0, len(osm_buildings), batch_size):
+            batch = osm_buildings[i : i + batch_size]
+            hashes_stored = cls.get_stored_hashes([b.id for b in batch])
+            batch_changed = []
+            for osm_building in batch:
+                osm_hash = osm_building.content_hash
+                if hashes_stored.get(osm_building.id) != osm_hash:
+                    batch_changed.append((osm_building, osm_hash))
+            unchanged_count += len(batch) - len(batch_changed)
+            if batch_changed:
+                OSMBuilding.calculate_geometries([b for b, _hash in batch_changed])
+                Building.objects.bulk_create(
+                    [
+                        cls._create_from_osm(b, osm_hash)
+                        for b, osm_hash in batch_changed
+                    ],
+                    update_conflicts=True,
+                    unique_fields=["way_id"],
+                    update_fields=cls.OSM_FIELDS,
+                )
+            # select the stored buildings to get their ids and fields not set from OSM
+            buildings_stored = Building.objects.defer("osm_raw").in_bulk(
+                [b.id for b in batch], field_name="way_id"
+            )
+            buildings += [buildings_stored[b.id] for b in batch]
+        logger.info(f"{unchanged_count}/{len(osm_buildings)} buildings unchanged")
+        return buildings
+
+    @classmethod
+    def _create_from_osm(cls, osm_building: OSMBuilding, osm_hash: str) -> "Building":
         length, width = osm_building.length_width
-        building, _created = Building.objects.update_or_create(
+        bounds = osm_building.bounds
+        return Building(
             way_id=osm_building.id,
-            defaults=dict(
-                osm_raw=osm_building.raw,
-                lon_min=osm_building.raw["bounds"]["minlon"],
-                lon_max=osm_building.raw["bounds"]["maxlon"],
-                lat_min=osm_building.raw["bounds"]["minlat"],
-                lat_max=osm_building.raw["bounds"]["maxlat"],
-                area=osm_building.area_square_meters,
-                length=length,
-                width=width,
-            ),
+            osm_raw=osm_building.raw,
+            osm_hash=osm_hash,
+            lon_min=bounds["minlon"],
+            lon_max=bounds["maxlon"],
+            lat_min=bounds["minlat"],
+            lat_max=bounds["maxlat"],
+            area=osm_building.area_square_meters,
+            length=length,
+            width=width,
+        )
+
+    @classmethod
+    def get_stored_hashes(cls, way_ids: List[int]) -> Dict[int, str]:
+        return dict(
+            Building.objects.filter(way_id__in=way_ids).values_list(
+                "way_id", "osm_hash"
+            )
         )
-        return building
 
     def update_company(self, save=True):
-        for address in self.addresses_nearby.all():
-            companies = Company.livestock_companies()
-            companies = companies.filter(address=address)
-            if companies:
-                # TODO BR: what if there are more companies found?
-                self.company = companies[0]
-                break
+        self.company_id = Building.resolve_companies([self])[self.id]
         if save:
             self.save()
 
+    @classmethod
+    def update_companies(cls, buildings: Iterable["Building"], batch_size=1000) -> None:
+        """
+        Links the buildings to the livestock company of their nearest address that has one.
+        The companies are resolved and saved per batch, each batch in its own transaction.
+        """
+        if isinstance(buildings, QuerySet):
+            buildings = buildings.only(
+                "id", "lat_min", "lat_max", "lon_min", "lon_max", "company"
+            ).iterator(chunk_size=batch_size)
+        batch = []
+        count = 0
+        for building in buildings:
+            batch.append(building)
+            if len(batch) == batch_size:
+                count += cls._update_companies_batch(batch)
+                logger.info(f"updated the company of {count} buildings")
+                batch = []
+        count += cls._update_companies_batch(batch)
+        logger.info(f"updated the company of {count} buildings")
+
+    @classmethod
+    def _update_companies_batch(cls, buildings: List["Building"]) -> int:
+        if len(buildings) == 0:
+            return 0
+        company_ids = cls.resolve_companies(buildings)
+        for building in buildings:
+            building.company_id = company_ids[building.id]
+        with transaction.atomic():
+            Building.objects.bulk_update(buildings, ["company"])
+        return len(buildings)
+
+    @classmethod
+    def resolve_companies(cls, buildings: List["Building"]) -> Dict[int, Optional[int]]:
+        """
+        Returns the id of the livestock company of each building (by building id).
+        This is the company at the nearest of the nearby addresses that has a livestock company,
+        the company with the lowest id if there are multiple at that address.
+        """
+        building_ids = [building.id for building in buildings]
+        pairs = list(
+            Building.addresses_nearby.through.objects.filter(
+                building_id__in=building_ids
+            ).values_list("building_id", "address_id")
+        )
+        address_ids = {address_id for _building_id, address_id in pairs}
+        company_by_address_id = {}
+        companies = (
+            Company.livestock_companies()
+            .filter(address_id__in=address_ids)
+            .order_by("-id")
+            .values_list("address_id", "id")
+        )
+        for address_id, company_id in companies:
+            company_by_address_id[address_id] = company_id
+        pairs = [pair for pair in pairs if pair[1] in company_by_address_id]
+
+        company_ids = {building_id: None for building_id in building_ids}
+        if len(pairs) == 0:
+            return company_ids
+        address_coordinates = dict(
+            (id, (lat, lon))
+            for id, lat, lon in Address.objects.filter(
+                id__in={address_id for _building_id, address_id in pairs}
+            ).values_list("id", "lat", "lon")
+        )
+        centers = {building.id: building.center for building in buildings}
+        distances = haversine_array(
+            [centers[building_id].lat for building_id, _address_id in pairs],
+            [centers[building_id].lon for building_id, _address_id in pairs],
+            [address_coordinates[address_id][0] for _building_id, address_id in pairs],
+            [address_coordinates[address_id][1] for _building_id, address_id in pairs],
+        )
+        distances_min = {}
+        for (building_id, address_id), distance in zip(pairs, distances.tolist()):
+            key = (distance, address_id)
+            if building_id not in distances_min or key < distances_min[building_id]:
+                distances_min[building_id] = key
+                company_ids[building_id] = company_by_address_id[address_id]
+        return company_ids
+
     @classmethod
     def update_nearby_addresses(
-        cls, buildings: List["Building"], limit=5
+        cls,
+        buildings: List["Building"],
+        limit=5,
+        address_index: Optional[PointIndex] = None,
     ) -> List[Address]:
-        addresses = []
-        for i, building in enumerate(buildings):
-            logger.info(f"finding address for building {i+1}/{len(buildings)}")
-            nodes = get_address_nearby(
-                building.center.lat, building.center.lon, distance=100
-            )
+        """
+        Finds the addresses near each building in an index of address nodes.
+        If no index is given, the address nodes around the buildings are requested in a single query.
+        """
+        if address_index is None:
+            address_index = PointIndex.from_nodes(cls.get_address_nodes(buildings))
+        logger.info(f"finding addresses for {len(buildings)} buildings")
+        nodes_nearby = []
+        for building in buildings:
+            center = building.center
+            nodes = address_index.within(center.lat, center.lon, cls.ADDRESS_DISTANCE)
             if len(nodes) == 0:
-                nodes = get_address_nearby(
-                    building.center.lat, building.center.lon, distance=200
+                nodes = address_index.within(
+                    center.lat, center.lon, cls.ADDRESS_DISTANCE_MAX
                 )
-            addresses_nearby = [Address.get_or_create_from_node(node) for node in nodes]
-            addresses_nearby = [a for a in addresses_nearby if a is not None]
+            nodes_nearby.append(nodes)
+
+        addresses_by_node_id = Address.create_from_nodes(
+            [node for nodes in nodes_nearby for node in nodes]
+        )
+        addresses = []
+        addresses_nearby_by_building = {}
+        for building, nodes in zip(buildings, nodes_nearby):
+            addresses_nearby = [
+                addresses_by_node_id[node["id"]]
+                for node in nodes
+                if node["id"] in addresses_by_node_id
+            ]
             addresses_nearby = cls.filter_nearest(
                 building, addresses_nearby, limit=limit
             )
             building.addresses_nearby_count = len(nodes)
-            building.addresses_nearby.set(addresses_nearby)
-            building.save()
+            addresses_nearby_by_building[building.id] = addresses_nearby
             addresses += addresses_nearby
+        cls.set_addresses_nearby_many(addresses_nearby_by_building)
+        Building.objects.bulk_update(
+            buildings, ["addresses_nearby_count"], batch_size=500
+        )
         return addresses
 
+    @classmethod
+    @transaction.atomic
+    def set_addresses_nearby_many(
+        cls, addresses_by_building_id: Dict[int, List[Address]], batch_size=500
+    ) -> None:
+        """
+        Sets the nearby addresses of many buildings, like addresses_nearby.set() per building.
+        Only the missing relations are inserted and only the obsolete relations are deleted.
+        """
+        through = Building.addresses_nearby.through
+        building_ids = list(addresses_by_building_id.keys())
+        pairs_new = {
+            (building_id, address.id)
+            for building_id, addresses in addresses_by_building_id.items()
+            for address in addresses
+        }
+        pairs_existing = {}
+        for i in range(0, len(building_ids), batch_size):
+            rows = through.objects.filter(
+                building_id__in=building_ids[i : i + batch_size]
+            ).values_list("id", "building_id", "address_id")
+            pairs_existing.update(
+                {(building_id, address_id): id for id, building_id, address_id in rows}
+            )
+        ids_delete = [
+            id for pair, id in pairs_existing.items() if pair not in pairs_new
+        ]
+        for i in range(0, len(ids_delete), batch_size):
+            through.objects.filter(id__in=ids_delete[i : i + batch_size]).delete()
+        through.objects.bulk_create(
+            [
+                through(building_id=building_id, address_id=address_id)
+                for building_id, address_id in pairs_new
+                if (building_id, address_id) not in pairs_existing
+            ],
+            batch_size=batch_size,
+            ignore_conflicts=True,
+        )
+
+    @classmethod
+    def get_address_nodes(cls, buildings: List["Building"]) -> List[Dict]:
+        """
+        Requests the address nodes needed to find the nearby addresses of the buildings,
+        and to count the address nodes near those addresses.
+        """
+        if len(buildings) == 0:
+            return []
+        distance = cls.ADDRESS_DISTANCE_MAX + Address.NEARBY_DISTANCE
+        nodes = get_addresses_in_bbox(cls.get_bbox(buildings).expand(distance))
+        logger.info(f"{len(nodes)} address nodes found for {len(buildings)} buildings")
+        return nodes
+
+    @classmethod
+    def get_in_bbox(cls, bbox: BBox) -> List["Building"]:
+        """
+        The buildings with their center in the bbox, without osm_raw loaded
+        """
+        buildings = Building.objects.defer("osm_raw").filter(
+            lat_max__gte=bbox.lat_min,
+            lat_min__lte=bbox.lat_max,
+            lon_max__gte=bbox.lon_min,
+            lon_min__lte=bbox.lon_max,
+        )
+        return [
+            building
+            for building in buildings
+            if bbox.lat_min <= building.center.lat <= bbox.lat_max
+            and bbox.lon_min <= building.center.lon <= bbox.lon_max
+        ]
+
+    @classmethod
+    def get_bbox(cls, buildings: List["Building"]) -> BBox:
+        return BBox(
+            lon_min=min(building.lon_min for building in buildings),
+            lon_max=max(building.lon_max for building in buildings),
+            lat_min=min(building.lat_min for building in buildings),
+            lat_max=max(building.lat_max for building in buildings),
+        )
+
     @classmethod
     def filter_nearest(
         cls, building, addresses: List[Address], limit=5
     ) -> List[Address]:
-        count = min(limit, len(addresses))
-        return sorted(
-            addresses,
-            key=lambda a: a.coordinate.distance_to(building.center),
-        )[:count]
+        addresses = list(addresses)
+        if limit <= 0 or len(addresses) == 0:
+            return []
+        indices = building.center.nearest_indices(
+            [address.lat for address in addresses],
+            [address.lon for address in addresses],
+            k=limit,
+        )
+        return [addresses[i] for i in indices]
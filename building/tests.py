@@ -1,9 +1,32 @@
+import json
+import tempfile
+import threading
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone as dt_timezone
+from unittest import mock
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
 from django.test import TestCase
+from django.utils import timezone
 
 from building.create import BuildingFactory
+from building.create import LeaseLost
+from building.create import TileLeaseHeartbeat
+from building.models import Address
+from building.models import Animal
 from building.models import Building
 from building.models import Company
+from building.models import Coordinate
+from building.models import Tile
+from cache.disk import DiskCache
+from geo.index import PointIndex
 from geo.utils import BBox
+from osm.building import BuildingChanges
+from osm.building import OSMBuilding
+from osm.client import AsyncOverpassClient
+from osm.core import OverpassPool
 
 
 class BuildingFactoryTest(TestCase):
@@ -30,3 +53,557 @@ class BuildingFactoryTest(TestCase):
         self.assertEqual(round(building_largest.area), 2010)
         self.assertEqual(round(building_largest.width), 24)
         self.assertEqual(round(building_largest.length), 87)
+
+
+class TileLeaseTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i in range(3):
+            Tile.from_bbox(BBox(lat_min=i, lon_min=i, lat_max=i + 1, lon_max=i + 1))
+
+    def test_claim_different_tiles(self):
+        tile_a = Tile.claim("worker-a", lease_sec=60)
+        tile_b = Tile.claim("worker-b", lease_sec=60)
+        self.assertNotEqual(tile_a.id, tile_b.id)
+        self.assertEqual(tile_a.lease_owner, "worker-a")
+        self.assertEqual(tile_b.lease_owner, "worker-b")
+
+    def test_claim_skips_complete_and_excluded(self):
+        Tile.objects.filter(id=Tile.objects.first().id).update(complete=True)
+        tile_a = Tile.claim("worker-a", lease_sec=60)
+        tile_b = Tile.claim("worker-a", lease_sec=60, exclude_ids=[tile_a.id])
+        self.assertIsNone(Tile.claim("worker-b", lease_sec=60))
+        self.assertNotEqual(tile_a.id, tile_b.id)
+
+    def test_reclaim_expired_lease(self):
+        tiles = [Tile.claim("worker-a", lease_sec=60) for _ in range(3)]
+        self.assertIsNone(Tile.claim("worker-b", lease_sec=60))
+        Tile.objects.filter(id=tiles[1].id).update(
+            lease_expires=timezone.now() - timedelta(seconds=1)
+        )
+        tile = Tile.claim("worker-b", lease_sec=60)
+        self.assertEqual(tile.id, tiles[1].id)
+        self.assertFalse(tiles[1].renew_lease(60))
+
+    def test_release_lease(self):
+        tile = Tile.claim("worker-a", lease_sec=60)
+        tile.release_lease()
+        self.assertEqual(Tile.claim("worker-b", lease_sec=60).id, tile.id)
+
+    def test_claim_complete_least_recently_synced(self):
+        tiles = list(Tile.objects.order_by("id"))
+        now = timezone.now()
+        for tile, synced in zip(tiles, [now, now - timedelta(days=1), None]):
+            Tile.objects.filter(id=tile.id).update(
+                complete=True, datetime_synced=synced
+            )
+        claimed = [
+            Tile.claim("worker-a", lease_sec=60, complete=True) for _ in range(3)
+        ]
+        self.assertEqual(
+            [tiles[2].id, tiles[1].id, tiles[0].id], [tile.id for tile in claimed]
+        )
+        self.assertIsNone(Tile.claim("worker-b", lease_sec=60, complete=True))
+        self.assertIsNone(Tile.claim("worker-b", lease_sec=60))
+
+    def reclaim(self, tile: Tile) -> Tile:
+        Tile.objects.filter(id=tile.id).update(
+            lease_expires=timezone.now() - timedelta(seconds=1)
+        )
+        return Tile.claim("worker-b", lease_sec=60)
+
+    def test_save_result_after_reclaim(self):
+        tile = Tile.claim("worker-a", lease_sec=60)
+        tile.complete = True
+        self.assertTrue(tile.save_result())
+        Tile.objects.filter(id=tile.id).update(complete=False)
+        self.assertEqual(self.reclaim(tile).id, tile.id)
+        tile.building_count = 10
+        self.assertFalse(tile.save_result())
+        tile.release_lease()
+        tile_stored = Tile.objects.get(id=tile.id)
+        self.assertEqual("worker-b", tile_stored.lease_owner)
+        self.assertIsNone(tile_stored.building_count)
+
+    def test_lease_lost_discards_result(self):
+        tile = Tile.claim("worker-a", lease_sec=60)
+        self.reclaim(tile)
+        lease = TileLeaseHeartbeat(tile, lease_sec=60)
+        lease.lost.set()
+        with self.assertRaises(LeaseLost):
+            lease.check()
+        with mock.patch.object(
+            BuildingFactory, "create_tile", side_effect=lambda *a, **kw: lease.check()
+        ), mock.patch.object(Tile, "save_result") as save_result:
+            self.assertFalse(BuildingFactory._create_tile_safe(tile, lease=lease))
+        save_result.assert_not_called()
+        tile_stored = Tile.objects.get(id=tile.id)
+        self.assertEqual("worker-b", tile_stored.lease_owner)
+        self.assertFalse(tile_stored.complete)
+        self.assertFalse(tile_stored.failed)
+
+    def test_lease_lost_releases_lease(self):
+        with mock.patch.object(
+            BuildingFactory, "create_tile", side_effect=LeaseLost("lost lease")
+        ) as create_tile:
+            BuildingFactory.create_tiles(owner="worker-a")
+        self.assertEqual(3, create_tile.call_count)
+        for tile in Tile.objects.all():
+            self.assertFalse(tile.failed)
+            self.assertEqual("", tile.error)
+            self.assertEqual("", tile.lease_owner)
+            self.assertIsNone(tile.lease_expires)
+
+
+class CreateBuildingsCommandTest(TestCase):
+
+    def test_workers_unsupported_options(self):
+        for option in [
+            "--region=lunteren",
+            "--extract=netherlands.osm.pbf",
+            "--refresh",
+        ]:
+            with self.assertRaises(CommandError):
+                call_command("create_buildings", "--workers=2", option)
+
+
+class CoordinateTest(TestCase):
+
+    def test_distance_matrix(self):
+        lats = [52.0, 52.01, 52.1]
+        lons = [5.0, 5.02, 5.3]
+        matrix = Coordinate.distance_matrix(lats, lons, lats[:2], lons[:2])
+        self.assertEqual(matrix.shape, (3, 2))
+        for i in range(3):
+            for j in range(2):
+                distance = Coordinate.distance(
+                    Coordinate(lat=lats[i], lon=lons[i]),
+                    Coordinate(lat=lats[j], lon=lons[j]),
+                )
+                self.assertAlmostEqual(matrix[i, j], distance, places=6)
+
+    def test_nearest_indices(self):
+        coordinate = Coordinate(lat=52.0, lon=5.0)
+        lats = [52.03, 52.01, 52.0, 52.02]
+        lons = [5.0, 5.0, 5.0, 5.0]
+        self.assertEqual(list(coordinate.nearest_indices(lats, lons, k=2)), [2, 1])
+        self.assertEqual(
+            list(coordinate.nearest_indices(lats, lons, k=10)), [2, 1, 3, 0]
+        )
+
+
+def create_osm_building(way_id, lat, lon, delta_lat=0.0003, delta_lon=0.001):
+    points = [
+        (lat, lon),
+        (lat, lon + delta_lon),
+        (lat + delta_lat, lon + delta_lon),
+        (lat + delta_lat, lon),
+        (lat, lon),
+    ]
+    return OSMBuilding.create_from_osm_way(
+        {
+            "type": "way",
+            "id": way_id,
+            "bounds": {
+                "minlat": lat,
+                "minlon": lon,
+                "maxlat": lat + delta_lat,
+                "maxlon": lon + delta_lon,
+            },
+            "nodes": list(range(way_id * 10, way_id * 10 + 4)) + [way_id * 10],
+            "geometry": [{"lat": p[0], "lon": p[1]} for p in points],
+            "tags": {"building": "farm_auxiliary"},
+        }
+    )
+
+
+class BuildingCreateFromOSMTest(TestCase):
+
+    def test_create_from_osm_many(self):
+        osm_buildings = [
+            create_osm_building(i, 52.0 + i * 0.001, 5.0) for i in range(5)
+        ]
+        buildings = Building.create_from_osm_many(osm_buildings, batch_size=2)
+        self.assertEqual(Building.objects.count(), 5)
+        self.assertEqual([b.way_id for b in buildings], list(range(5)))
+        self.assertTrue(all(b.pk is not None for b in buildings))
+        building = Building.objects.get(way_id=2)
+        self.assertEqual(building.osm_raw, osm_buildings[2].raw)
+        self.assertEqual(round(building.length), 69)
+
+    def test_update_keeps_other_fields(self):
+        Building.create_from_osm_many([create_osm_building(1, 52.0, 5.0)])
+        address = Address.objects.create(
+            node_id=1, lat=52.0, lon=5.0, street="Postweg", housenumber="1"
+        )
+        company = Company.objects.create(description="melkvee", address=address)
+        Building.objects.filter(way_id=1).update(company=company)
+        osm_building = create_osm_building(1, 52.0, 5.0, delta_lat=0.0006)
+        buildings = Building.create_from_osm_many([osm_building])
+        self.assertEqual(Building.objects.count(), 1)
+        self.assertEqual(buildings[0].company, company)
+        self.assertEqual(round(buildings[0].width), 67)
+
+    def test_unchanged_not_written(self):
+        osm_buildings = [
+            create_osm_building(i, 52.0 + i * 0.001, 5.0) for i in range(3)
+        ]
+        Building.create_from_osm_many(osm_buildings)
+        Building.objects.update(area=1)
+        # building 1 changed its tags, the others are the same
+        osm_buildings = [
+            create_osm_building(i, 52.0 + i * 0.001, 5.0) for i in range(3)
+        ]
+        osm_buildings[1].tags["livestock"] = "cattle"
+        buildings = Building.create_from_osm_many(osm_buildings)
+        self.assertEqual([0, 1, 2], [b.way_id for b in buildings])
+        self.assertEqual(1, buildings[0].area)
+        self.assertGreater(buildings[1].area, 1000)
+        self.assertEqual(1, buildings[2].area)
+        self.assertEqual("cattle", Building.objects.get(way_id=1).tags["livestock"])
+        # the geometry of unchanged buildings is not calculated
+        self.assertIsNone(osm_buildings[0]._geometry)
+
+    def test_create_for_bbox_per_batch(self):
+        batches = [[create_osm_building(i, 52.0 + i * 0.001, 5.0)] for i in range(2)]
+        bbox = BBox(lat_min=52.0, lon_min=5.0, lat_max=52.1, lon_max=5.1)
+        with mock.patch.object(
+            BuildingFactory, "_get_large_osm_buildings", return_value=iter(batches)
+        ), mock.patch.object(
+            Building, "get_address_nodes", return_value=[]
+        ) as get_address_nodes, mock.patch.object(
+            Address, "update_companies", return_value=[]
+        ):
+            buildings, _companies = BuildingFactory.create_for_bbox(bbox)
+        self.assertEqual([0, 1], [building.way_id for building in buildings])
+        # the addresses are requested for each batch
+        self.assertEqual(
+            [[0], [1]],
+            [
+                [building.way_id for building in call.args[0]]
+                for call in get_address_nodes.call_args_list
+            ],
+        )
+
+    def test_create_for_bbox_stream_finished_before_addresses(self):
+        # one sub-tile streams several batches while the server has one slot, the address
+        # query of a batch needs that slot and fails if the stream still holds it
+        class OneSlotAPI:
+            def __init__(self):
+                self.slot = threading.Semaphore(1)
+
+            def stream(self, query, verbosity="body"):
+                with self.slot:
+                    for i in range(6):
+                        yield create_osm_building(i, 52.0 + i * 0.001, 5.0).raw
+
+            def get(self, query, **kwargs):
+                if not self.slot.acquire(timeout=1):
+                    raise AssertionError("no free slot for the address query")
+                self.slot.release()
+                return {"elements": []}
+
+        overpass_api = OneSlotAPI()
+        bbox = BBox(lat_min=52.0, lon_min=5.0, lat_max=52.01, lon_max=5.01)
+        with mock.patch.object(BuildingFactory, "OSM_BATCH_SIZE", 2), mock.patch.object(
+            AsyncOverpassClient, "STREAM_BATCH_SIZE", 1
+        ), mock.patch.object(AsyncOverpassClient, "STREAM_QUEUE_SIZE", 1), mock.patch(
+            "osm.client.get_pool", return_value=overpass_api
+        ), mock.patch(
+            "osm.building.get_pool", return_value=overpass_api
+        ), mock.patch.object(
+            Address, "update_companies", return_value=[]
+        ) as update_companies:
+            buildings, _companies = BuildingFactory.create_for_bbox(bbox)
+        self.assertEqual(list(range(6)), [building.way_id for building in buildings])
+        self.assertEqual(3, update_companies.call_count)
+
+    def test_unchanged_address_not_written(self):
+        nodes = [create_address_node(i, 52.0, 5.0 + i * 0.001) for i in range(2)]
+        Address.create_from_nodes(nodes)
+        Address.objects.update(city="Ede")
+        nodes[1]["lat"] = 52.001
+        addresses = Address.create_from_nodes(nodes)
+        self.assertEqual("Ede", addresses[0].city)
+        self.assertEqual("Lunteren", addresses[1].city)
+        self.assertEqual(52.001, addresses[1].lat)
+
+
+def create_address_node(node_id, lat, lon, street="Postweg"):
+    tags = {"addr:housenumber": str(node_id), "addr:city": "Lunteren"}
+    if street is not None:
+        tags["addr:street"] = street
+    return {"type": "node", "id": node_id, "lat": lat, "lon": lon, "tags": tags}
+
+
+class BuildingNearbyAddressesTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.buildings = Building.create_from_osm_many(
+            [create_osm_building(1, 52.0, 5.0), create_osm_building(2, 52.01, 5.0)]
+        )
+        # nodes north of building 1 at about 0, 33, 67, 100, 133, ... m from its center
+        self.nodes = [
+            create_address_node(i, 52.00015 + i * 0.0003, 5.0005) for i in range(8)
+        ]
+        self.nodes.append(create_address_node(100, 52.00015, 5.0006, street=None))
+
+    def test_update_nearby_addresses(self):
+        addresses = Building.update_nearby_addresses(
+            self.buildings, limit=2, address_index=PointIndex.from_nodes(self.nodes)
+        )
+        building_1, building_2 = Building.objects.order_by("way_id")
+        self.assertEqual(building_1.addresses_nearby_count, 4)
+        self.assertEqual(
+            sorted(a.node_id for a in building_1.addresses_nearby.all()), [0, 1]
+        )
+        self.assertEqual(building_2.addresses_nearby_count, 0)
+        self.assertEqual([a.node_id for a in addresses], [0, 1])
+        self.assertEqual(Address.objects.count(), 3)
+
+    def test_update_nearby_addresses_again(self):
+        index = PointIndex.from_nodes(self.nodes)
+        Building.update_nearby_addresses(self.buildings, limit=3, address_index=index)
+        Building.update_nearby_addresses(self.buildings, limit=1, address_index=index)
+        building_1 = Building.objects.get(way_id=1)
+        self.assertEqual([a.node_id for a in building_1.addresses_nearby.all()], [0])
+        self.assertEqual(Building.addresses_nearby.through.objects.count(), 1)
+
+
+class CompanyUpdateTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        address = Address.objects.create(
+            node_id=1, lat=52.0, lon=5.0, street="Postweg", housenumber="227"
+        )
+        cls.company_dairy = Company.objects.create(
+            description="Landbouwbedrijf, bestaande uit een melkveehouderij.",
+            address=address,
+        )
+        cls.company_pig = Company.objects.create(
+            description="Het houden van varkens.", address=address
+        )
+        for way_id in range(2):
+            Building.objects.create(
+                way_id=way_id,
+                osm_raw={},
+                area=800,
+                length=40,
+                width=20,
+                lon_min=5.0,
+                lon_max=5.001,
+                lat_min=52.0,
+                lat_max=52.001,
+                company=cls.company_dairy,
+            )
+
+    def test_update_companies(self):
+        Company.update_companies(Company.objects.all())
+        company_dairy = Company.objects.get(id=self.company_dairy.id)
+        company_pig = Company.objects.get(id=self.company_pig.id)
+        self.assertEqual(company_dairy.animal_type_main, Animal.COW_DAIRY)
+        self.assertEqual(company_dairy.animal_count, 200)
+        self.assertTrue(company_dairy.cattle)
+        self.assertEqual(company_pig.animal_type_main, Animal.PIG)
+        self.assertEqual(company_pig.animal_count, 0)
+
+    def test_update_companies_skips_classified(self):
+        Company.update_companies(Company.objects.all())
+        Company.objects.filter(id=self.company_pig.id).update(pig=False)
+        Company.update_companies(Company.objects.all())
+        self.assertFalse(Company.objects.get(id=self.company_pig.id).pig)
+        Company.objects.filter(id=self.company_pig.id).update(classification_key="")
+        Company.update_companies(Company.objects.all())
+        self.assertTrue(Company.objects.get(id=self.company_pig.id).pig)
+
+    def test_update(self):
+        company = Company.objects.get(id=self.company_dairy.id)
+        company.update(save=False)
+        self.assertEqual(company.animal_count, 200)
+        self.assertIsNone(Company.objects.get(id=company.id).animal_type_main)
+        company.update()
+        company = Company.objects.get(id=company.id)
+        self.assertEqual(company.animal_type_main, Animal.COW_DAIRY)
+        self.assertEqual(company.animal_count, 200)
+
+
+class BuildingUpdateCompanyTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.building_1, self.building_2 = Building.create_from_osm_many(
+            [create_osm_building(1, 52.0, 5.0), create_osm_building(2, 52.01, 5.0)]
+        )
+        self.address_near = Address.objects.create(
+            node_id=1, lat=52.0002, lon=5.0005, street="Postweg", housenumber="1"
+        )
+        self.address_far = Address.objects.create(
+            node_id=2, lat=52.0008, lon=5.0005, street="Postweg", housenumber="2"
+        )
+        self.building_1.addresses_nearby.set([self.address_far, self.address_near])
+        self.building_2.addresses_nearby.set([self.address_far])
+
+    def create_company(self, address, description="melkveehouderij"):
+        company = Company.objects.create(description=description, address=address)
+        company.update()
+        return company
+
+    def test_update_companies_nearest(self):
+        company_far = self.create_company(self.address_far)
+        company_near = self.create_company(self.address_near, "varkenshouderij")
+        self.create_company(self.address_near, "melkveehouderij")
+        self.create_company(self.address_near, "administratiekantoor")
+        Building.update_companies(Building.objects.all(), batch_size=1)
+        self.assertEqual(Building.objects.get(way_id=1).company, company_near)
+        self.assertEqual(Building.objects.get(way_id=2).company, company_far)
+
+    def test_update_companies_no_livestock(self):
+        self.create_company(self.address_near, "administratiekantoor")
+        Building.update_companies([self.building_1, self.building_2])
+        self.assertIsNone(Building.objects.get(way_id=1).company)
+        self.building_1.update_company()
+        self.assertIsNone(self.building_1.company)
+
+
+class BuildingRefreshTest(TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bbox = BBox(lat_min=52.0, lon_min=5.0, lat_max=52.1, lon_max=5.1)
+        Building.create_from_osm_many(
+            [create_osm_building(i, 52.0 + i * 0.01, 5.01) for i in range(1, 4)]
+        )
+        patcher = mock.patch.object(Building, "get_address_nodes", return_value=[])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(Address, "update_companies", return_value=[])
+        self.update_companies = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def refresh(self, changes: BuildingChanges):
+        with mock.patch("building.create.get_building_changes", return_value=changes):
+            return BuildingFactory.refresh_for_bbox(
+                self.bbox, datetime(2024, 7, 1, tzinfo=dt_timezone.utc)
+            )
+
+    def test_refresh(self):
+        timestamp = datetime(2024, 7, 21, tzinfo=dt_timezone.utc)
+        changes = BuildingChanges(
+            # building 1 is larger, building 4 is new
+            ways=[
+                create_osm_building(1, 52.01, 5.01, delta_lat=0.0006).raw,
+                create_osm_building(4, 52.05, 5.01).raw,
+            ],
+            # an address near building 3 changed
+            address_nodes=[create_address_node(10, 52.0301, 5.0105)],
+            # building 2 was deleted
+            way_ids={1, 3, 4},
+            address_node_ids={10},
+            timestamp=timestamp,
+        )
+        buildings, _companies, synced = self.refresh(changes)
+        self.assertEqual(timestamp, synced)
+        self.assertEqual([1, 4, 3], [building.way_id for building in buildings])
+        self.assertEqual(
+            [1, 3, 4],
+            list(Building.objects.order_by("way_id").values_list("way_id", flat=True)),
+        )
+        self.assertEqual(67, round(Building.objects.get(way_id=1).width))
+
+    def test_refresh_without_changes(self):
+        changes = BuildingChanges(
+            ways=[],
+            address_nodes=[],
+            way_ids={1, 2, 3},
+            address_node_ids=set(),
+            timestamp=None,
+        )
+        buildings, _companies, synced = self.refresh(changes)
+        self.assertEqual([], buildings)
+        self.assertIsNone(synced)
+        self.assertEqual(3, Building.objects.count())
+
+    def test_refresh_removed_address(self):
+        address_removed, address = Address.create_from_nodes(
+            [
+                create_address_node(10, 52.0301, 5.0105),
+                create_address_node(11, 52.0501, 5.0105),
+            ]
+        ).values()
+        Company.objects.create(description="melkvee", address=address_removed)
+        changes = BuildingChanges(
+            ways=[],
+            address_nodes=[],
+            way_ids={1, 2, 3},
+            address_node_ids={11},
+            timestamp=None,
+        )
+        buildings, _companies, _synced = self.refresh(changes)
+        # the building near the removed address gets its addresses again
+        self.assertEqual([3], [building.way_id for building in buildings])
+        self.assertEqual(
+            [address.id], list(Address.objects.values_list("id", flat=True))
+        )
+        self.assertEqual(0, Company.objects.count())
+
+    def test_refresh_tile(self):
+        tile = Tile.from_bbox(self.bbox)
+        tile.complete = True
+        tile.datetime_synced = timezone.now() - timedelta(days=1)
+        tile.save()
+        changes = BuildingChanges(
+            ways=[],
+            address_nodes=[],
+            way_ids={1, 3},
+            address_node_ids=set(),
+            timestamp=None,
+        )
+        with mock.patch("building.create.get_building_changes", return_value=changes):
+            BuildingFactory.refresh_tiles()
+        tile.refresh_from_db()
+        self.assertFalse(tile.failed)
+        self.assertGreater(tile.datetime_synced, timezone.now() - timedelta(hours=2))
+        self.assertIsNone(tile.lease_expires)
+        self.assertEqual(2, Building.objects.count())
+
+    def test_create_tile_synced_cached(self):
+        # the buildings were created from a cached response of a week ago
+        tile = Tile.from_bbox(self.bbox)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        pool = OverpassPool([], cache=DiskCache(directory.name))
+        response = {"osm3s": {"timestamp_osm_base": "2024-07-14T08:00:00Z"}}
+        pool.cache.set(
+            OverpassPool.get_cache_key("way(1);"), json.dumps(response).encode()
+        )
+
+        def create_for_bbox(bbox, lease=None):
+            pool.get("way(1);")
+            return [], []
+
+        with mock.patch(
+            "building.create.get_pool", return_value=pool
+        ), mock.patch.object(
+            BuildingFactory, "create_for_bbox", side_effect=create_for_bbox
+        ):
+            BuildingFactory.create_tile(tile)
+        self.assertEqual(
+            datetime(2024, 7, 14, 8, tzinfo=dt_timezone.utc), tile.datetime_synced
+        )
+
+    def test_refresh_tile_leased(self):
+        tile = Tile.from_bbox(self.bbox)
+        tile.complete = True
+        tile.save()
+        Tile.objects.filter(id=tile.id).update(
+            lease_owner="worker-b", lease_expires=timezone.now() + timedelta(minutes=5)
+        )
+        with mock.patch("building.create.get_building_changes") as get_building_changes:
+            BuildingFactory.refresh_tiles()
+        get_building_changes.assert_not_called()
+        self.assertEqual(3, Building.objects.count())
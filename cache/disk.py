@@ -0,0 +1,176 @@
+import hashlib
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable
+from typing import Iterator
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    writes: int = 0
+    evictions: int = 0
+
+    def __str__(self):
+        lookups = self.hits + self.misses
+        ratio = self.hits / lookups * 100 if lookups else 0
+        return f"{self.hits} hits, {self.misses} misses ({ratio:.1f}% hit ratio), {self.writes} writes, {self.evictions} evictions"
+
+
+class DiskCache:
+    """
+    A persistent key/value cache of zlib compressed bytes, one file per key.
+    Entries older than ttl_sec are misses. The modification time of a file is its last use,
+    if the total size exceeds max_size_bytes the least recently used files are removed.
+    """
+
+    HEADER = struct.Struct("<d")  # creation time of the entry
+    SUFFIX = ".z"
+
+    def __init__(
+        self,
+        directory: str,
+        ttl_sec: Optional[float] = None,
+        max_size_bytes: Optional[int] = None,
+    ):
+        self.directory = directory
+        self.ttl_sec = ttl_sec
+        self.max_size_bytes = max_size_bytes
+        self.stats = CacheStats()
+        self._size: Optional[int] = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + self.SUFFIX)
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            (created,) = self.HEADER.unpack_from(data)
+            if self.ttl_sec is not None and time.time() - created > self.ttl_sec:
+                self._remove(path)
+                value = None
+            else:
+                value = zlib.decompress(data[self.HEADER.size :])
+                os.utime(path)
+        except FileNotFoundError:
+            value = None
+        except (OSError, struct.error, zlib.error) as e:
+            logger.warning(f"removing unreadable cache entry {path}: {e}")
+            self._remove(path)
+            value = None
+        with self._lock:
+            if value is None:
+                self.stats.misses += 1
+            else:
+                self.stats.hits += 1
+        return value
+
+    def set(self, key: str, value: bytes) -> None:
+        with self.writer(key) as write:
+            write(value)
+
+    @contextmanager
+    def writer(self, key: str) -> Iterator[Callable[[bytes], None]]:
+        """
+        Writes the value of a key in chunks, without keeping the value in memory.
+        The entry is only stored if the block completes, on an error or close it is discarded.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temporary file first so readers never see a partial entry
+        fd, path_tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        compressor = zlib.compressobj()
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(self.HEADER.pack(time.time()))
+                yield lambda chunk: f.write(compressor.compress(chunk))
+                f.write(compressor.flush())
+        except BaseException:
+            os.remove(path_tmp)
+            raise
+        size_old = self._file_size(path)
+        size = self._file_size(path_tmp)
+        os.replace(path_tmp, path)
+        with self._lock:
+            self.stats.writes += 1
+            if self._size is not None:
+                self._size += size - size_old
+        self._evict_if_needed()
+
+    def delete(self, key: str) -> None:
+        self._remove(self._path(key))
+
+    def clear(self) -> None:
+        for path, _size, _mtime in self._entries():
+            self._remove(path)
+
+    def size(self) -> int:
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _path, size, _mtime in self._entries())
+            return self._size
+
+    def _evict_if_needed(self) -> None:
+        if self.max_size_bytes is None or self.size() <= self.max_size_bytes:
+            return
+        # evict to below 90% of the maximum, to not scan the directory on every write
+        target = self.max_size_bytes * 0.9
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        size = sum(size for _path, size, _mtime in entries)
+        evicted = 0
+        for path, entry_size, _mtime in entries:
+            if size <= target:
+                break
+            self._remove(path, count=False)
+            size -= entry_size
+            evicted += 1
+        with self._lock:
+            self._size = size
+            self.stats.evictions += evicted
+        logger.info(f"evicted {evicted} entries from cache {self.directory}")
+
+    def _entries(self):
+        for root, _dirs, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(self.SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def _remove(self, path: str, count=True) -> None:
+        size = self._file_size(path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        if count:
+            with self._lock:
+                if self._size is not None:
+                    self._size -= size
+
+    @staticmethod
+    def _file_size(path: str) -> int:
+        try:
+            return os.path.getsize(path)
+        except FileNotFoundError:
+            return 0
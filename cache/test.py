@@ -0,0 +1,73 @@
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from cache.disk import DiskCache
+
+
+class TestDiskCache(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_get_set(self):
+        cache = DiskCache(self.directory)
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", b"value a" * 100)
+        self.assertEqual(b"value a" * 100, cache.get("a"))
+        self.assertEqual(1, cache.stats.hits)
+        self.assertEqual(1, cache.stats.misses)
+        self.assertLess(cache.size(), 100)
+        # a new instance reads the entries stored before
+        self.assertEqual(b"value a" * 100, DiskCache(self.directory).get("a"))
+
+    def test_ttl(self):
+        cache = DiskCache(self.directory, ttl_sec=60)
+        cache.set("a", b"value")
+        self.assertEqual(b"value", cache.get("a"))
+        cache.ttl_sec = 0
+        time.sleep(0.01)
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(0, cache.size())
+
+    def test_evict_least_recently_used(self):
+        cache = DiskCache(self.directory)
+        for i in range(10):
+            cache.set(str(i), os.urandom(1000))
+            os.utime(cache._path(str(i)), (i, i))
+        cache.get("0")  # makes "0" the most recently used
+        cache.max_size_bytes = cache.size() // 2
+        cache.set("10", os.urandom(1000))
+        self.assertLessEqual(cache.size(), cache.max_size_bytes)
+        self.assertIsNotNone(cache.get("0"))
+        self.assertIsNotNone(cache.get("10"))
+        self.assertIsNone(cache.get("1"))
+        self.assertGreater(cache.stats.evictions, 0)
+
+    def test_unreadable_entry(self):
+        cache = DiskCache(self.directory)
+        cache.set("a", b"value")
+        with open(cache._path("a"), "wb") as f:
+            f.write(b"corrupt")
+        self.assertIsNone(cache.get("a"))
+        self.assertFalse(os.path.exists(cache._path("a")))
+
+    def test_writer(self):
+        cache = DiskCache(self.directory)
+        with cache.writer("a") as write:
+            for i in range(3):
+                write(b"chunk %d;" % i)
+        self.assertEqual(b"chunk 0;chunk 1;chunk 2;", cache.get("a"))
+        with self.assertRaises(ValueError):
+            with cache.writer("b") as write:
+                write(b"partial")
+                raise ValueError()
+        # the incomplete entry is discarded
+        self.assertIsNone(cache.get("b"))
+        files = [
+            name for _root, _dirs, names in os.walk(self.directory) for name in names
+        ]
+        self.assertEqual(1, len(files))
+        self.assertEqual(1, cache.stats.writes)
@@ -0,0 +1,116 @@
+import hashlib
+import re
+from dataclasses import dataclass
+from dataclasses import fields
+from functools import lru_cache
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+
+@dataclass(frozen=True)
+class Classification:
+    cattle: bool = False
+    cattle_beef: bool = False
+    cattle_dairy: bool = False
+    chicken: bool = False
+    pig: bool = False
+    sheep: bool = False
+    goat: bool = False
+    other_activities: bool = False
+
+
+class DescriptionClassifier:
+    """
+    Classifies company descriptions by the keywords they contain.
+    The keywords are compiled once into a table of (keyword, flags) bit masks, so a description
+    is classified with one substring search per keyword and no allocations.
+    Classifications are memoized by normalized description in a bounded LRU cache.
+    """
+
+    # bump the version when the keywords or the main type logic change, to reclassify all companies
+    VERSION = 1
+    CACHE_SIZE = 10000
+    WHITESPACE = re.compile(r"\s+")
+    FLAGS = tuple(field.name for field in fields(Classification))
+    KEYWORDS = {
+        "cattle": ("melkvee", "rundvee", "kalveren"),
+        "cattle_dairy": ("melkvee",),
+        "cattle_beef": ("rundvee", "vleeskalveren", "kalveren"),
+        "chicken": ("pluimvee", "kippen", "kuikens", "hennen"),
+        "pig": ("varken", "zeug"),
+        "sheep": ("schaap", "schapen"),
+        "goat": ("geit",),
+        "other_activities": (
+            "dienstverlening",
+            "arbeidskrachten",
+            "loonwerk",
+            "loonbedrijf",
+            "teelt",
+        ),
+    }
+    # phrases that unset a flag, also if one of its keywords is found
+    NEGATIONS = {
+        "cattle_dairy": ("geen melkvee", "niet melkvee"),
+    }
+
+    def __init__(
+        self,
+        keywords: Optional[Dict[str, Tuple[str, ...]]] = None,
+        negations: Optional[Dict[str, Tuple[str, ...]]] = None,
+    ):
+        self._keywords = self._compile(keywords or self.KEYWORDS)
+        self._negations = self._compile(negations or self.NEGATIONS)
+        self._classifications = [
+            Classification(
+                **{flag: bool(flags & (1 << i)) for i, flag in enumerate(self.FLAGS)}
+            )
+            for flags in range(1 << len(self.FLAGS))
+        ]
+        self._classify_normalized = lru_cache(maxsize=self.CACHE_SIZE)(
+            self._classify_normalized
+        )
+
+    @classmethod
+    def _compile(
+        cls, keywords_by_flag: Dict[str, Tuple[str, ...]]
+    ) -> Tuple[Tuple[str, int], ...]:
+        masks: Dict[str, int] = {}
+        for flag, keywords in keywords_by_flag.items():
+            for keyword in keywords:
+                masks[keyword] = masks.get(keyword, 0) | (1 << cls.FLAGS.index(flag))
+        return tuple(masks.items())
+
+    @classmethod
+    def normalize(cls, description: str) -> str:
+        return cls.WHITESPACE.sub(" ", description).strip().lower()
+
+    @classmethod
+    def get_key(cls, description: str) -> str:
+        """
+        A hash of the classifier version and the normalized description.
+        A company does not need to be classified again if its stored key is equal.
+        """
+        value = f"{cls.VERSION}:{cls.normalize(description)}"
+        return hashlib.sha1(value.encode("utf-8")).hexdigest()
+
+    def classify(self, description: str) -> Classification:
+        return self._classify_normalized(self.normalize(description))
+
+    def _classify_normalized(self, description: str) -> Classification:
+        flags = 0
+        for keyword, mask in self._keywords:
+            if keyword in description:
+                flags |= mask
+        for keyword, mask in self._negations:
+            if keyword in description:
+                flags &= ~mask
+        return self._classifications[flags]
+
+    def cache_info(self):
+        return self._classify_normalized.cache_info()
+
+    def classify_many(self, descriptions: Iterable[str]) -> List[Classification]:
+        return [self.classify(description) for description in descriptions]
@@ -1,10 +1,27 @@
+import json
 import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from typing import Dict
 from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
 
 import requests
+from django.conf import settings
+from lxml import etree
 from lxml import html
 from pydantic import BaseModel
+from requests.adapters import HTTPAdapter
 
+from cache.disk import DiskCache
 
 logger = logging.getLogger(__name__)
 
@@ -16,38 +33,521 @@ class ScraperMalfunction(RuntimeError):
 class Company(BaseModel):
     description: str
     active: bool
+    address: Optional[str] = None
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket rate limiter.
+    Tokens are added at rate per second up to capacity, acquire() blocks until a token is available.
+    """
+
+    def __init__(
+        self, rate: float, capacity: float = 1, clock=time.monotonic, sleep=time.sleep
+    ):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        Takes tokens from the bucket, waiting for them if needed. Returns the wait time in seconds.
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            # reserve the tokens, callers that come later wait for the refill after this one
+            self._tokens -= tokens
+            wait = max(0.0, -self._tokens / self.rate)
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+
+class ScraperHealthMonitor:
+    """
+    Infers whether the scraper still works from the responses it gets.
+    An unexpected status code, a page without the expected markup or a long run of searches
+    without any result is an anomaly, only then check() runs the canary search.
+    """
+
+    EMPTY_RUN_MAX = 30
+
+    def __init__(self, empty_run_max: Optional[int] = None):
+        self.empty_run_max = empty_run_max or self.EMPTY_RUN_MAX
+        self.anomaly: Optional[str] = None
+        self.empty_run = 0
+        self.responses = 0
+        self.canary_runs = 0
+        self._lock = threading.Lock()
+
+    def record_response(
+        self, status_code: int, has_markup_anchor: bool = True, result_count: int = 0
+    ) -> None:
+        with self._lock:
+            self.responses += 1
+            if status_code != 200:
+                self.anomaly = f"status code {status_code}"
+            elif not has_markup_anchor:
+                self.anomaly = "expected markup not found"
+            elif result_count == 0:
+                self.empty_run += 1
+                if self.empty_run >= self.empty_run_max:
+                    self.anomaly = f"{self.empty_run} searches in a row without results"
+            else:
+                self.empty_run = 0
+
+    def record_anomaly(self, anomaly: str) -> None:
+        with self._lock:
+            self.anomaly = anomaly
+
+    def reset(self) -> None:
+        with self._lock:
+            self.anomaly = None
+            self.empty_run = 0
+
+    def check(self, canary: Callable[[], bool]) -> bool:
+        """
+        Returns False if there is an anomaly that the canary confirms.
+        """
+        anomaly = self.anomaly
+        if anomaly is None:
+            return True
+        logger.warning(f"scraper anomaly: {anomaly}, running canary search")
+        self.canary_runs += 1
+        if not canary():
+            return False
+        logger.info("canary search succeeded, scraper is working")
+        self.reset()
+        return True
+
+
+class CircuitBreaker:
+    """
+    Opens on a failure for a backoff time that doubles with every consecutive failure,
+    up to backoff_max_sec. A success closes it and resets the backoff.
+    """
+
+    def __init__(
+        self,
+        backoff_base_sec: float,
+        backoff_max_sec: float,
+        jitter: float = 0.1,
+        clock=time.monotonic,
+    ):
+        self.backoff_base_sec = backoff_base_sec
+        self.backoff_max_sec = backoff_max_sec
+        self.jitter = jitter
+        self.failures = 0
+        self._clock = clock
+        self._open_until = 0.0
+
+    def record_failure(self) -> float:
+        """
+        Opens the breaker, returns the backoff time in seconds.
+        """
+        self.failures += 1
+        backoff = min(
+            self.backoff_max_sec, self.backoff_base_sec * 2 ** (self.failures - 1)
+        )
+        # jitter to spread the retries of workers that failed at the same time
+        backoff *= 1 + random.uniform(0, self.jitter)
+        self._open_until = self._clock() + backoff
+        return backoff
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self._open_until = 0.0
+
+    def remaining_sec(self) -> float:
+        return max(0.0, self._open_until - self._clock())
+
+    def is_open(self) -> bool:
+        return self.remaining_sec() > 0
+
+    def wait(self) -> float:
+        """
+        Blocks until the breaker lets a new attempt through, returns the time waited in seconds.
+        """
+        remaining = self.remaining_sec()
+        if remaining > 0:
+            logger.info(f"scraper circuit open, waiting {remaining:.0f} s")
+            time.sleep(remaining)
+        return remaining
+
+
+class ResultsPage(NamedTuple):
+    companies: List[Company]
+    has_markup_anchor: bool
+    has_next_page: bool = False
+
+
+class ResultsParser:
+    """
+    Extracts the companies from a results page of the register with precompiled XPath expressions.
+    With a stop marker, the page is cut off at the marker after the last result block before it is parsed.
+    """
+
+    RESULT_BLOCKS = etree.XPath('//div[@class="result-block"]')
+    DESCRIPTION = etree.XPath(
+        './/div[contains(@class, "detail-block mt-4")]/div[contains(text(), "Omschrijving:")]/following-sibling::span[@class="value-column"]/text()'
+    )
+    ADDRESS = etree.XPath(
+        './/div[contains(@class, "detail-block")]/div[contains(text(), "Adres:") or contains(text(), "Vestigingsadres:")]/following-sibling::span[@class="value-column"]/text()'
+    )
+    INACTIVE = etree.XPath('.//span[contains(@class, "inactive")]/text()')
+    # a link to the next page of a paginated results page
+    NEXT_PAGE = etree.XPath('//a[@rel="next"] | //link[@rel="next"]')
+    RESULT_BLOCK_MARKER = 'class="result-block"'
+
+    def __init__(
+        self, stop_marker: Optional[str] = None, markup_anchor: Optional[str] = None
+    ):
+        # text that follows the results on every page, like the start of the footer
+        self.stop_marker = stop_marker
+        # an XPath expression that matches every results page, also those without results
+        self.markup_anchor = etree.XPath(markup_anchor) if markup_anchor else None
+
+    def truncate(self, text: str) -> str:
+        if self.stop_marker is None:
+            return text
+        start = max(0, text.rfind(self.RESULT_BLOCK_MARKER))
+        end = text.find(self.stop_marker, start)
+        return text if end == -1 else text[:end]
+
+    def parse(self, text: str) -> ResultsPage:
+        text = self.truncate(text)
+        tree = html.document_fromstring(text)
+        companies = self.parse_tree(tree)
+        return ResultsPage(
+            companies=companies,
+            has_markup_anchor=self.has_markup_anchor(tree, companies),
+            has_next_page=bool(self.NEXT_PAGE(tree)),
+        )
+
+    def has_markup_anchor(self, tree, companies: List[Company]) -> bool:
+        """
+        False if there are result blocks without any company, as the markup of the results changed,
+        or if the page does not match the markup anchor
+        """
+        if not companies and self.RESULT_BLOCKS(tree):
+            return False
+        return self.markup_anchor is None or bool(self.markup_anchor(tree))
+
+    def parse_tree(self, tree) -> List[Company]:
+        # Extract the content after the "Omschrijving" field and check for "Niet actief"
+        companies = []
+        for block in self.RESULT_BLOCKS(tree):
+            omschrijving = self.DESCRIPTION(block)
+            omschrijving_text = omschrijving[0].strip() if omschrijving else ""
+            if not omschrijving_text:
+                continue
+            adres = self.ADDRESS(block)
+            companies.append(
+                Company(
+                    description=omschrijving_text,
+                    active=not self.INACTIVE(block),
+                    address=adres[0].strip() if adres else None,
+                )
+            )
+        return companies
 
 
 class UittrekselRegisterScraper:
+    URL = "https://www.uittrekselregister.nl/zoekresultaten"
+    TIMEOUT_SEC = 30
+    # a street search with a next page, or with this many results, may be truncated
+    # and its addresses are searched one by one
+    STREET_RESULTS_MAX = 50
+    STREET_GROUP_MIN = 2
+
+    _session: Optional[requests.Session] = None
+    _rate_limiter: Optional[TokenBucket] = None
+    _cache: Optional[DiskCache] = None
+    _lock = threading.Lock()
+
+    health_monitor = ScraperHealthMonitor()
+    parser = ResultsParser(
+        stop_marker=settings.KVK_RESULTS_STOP_MARKER,
+        markup_anchor=settings.KVK_MARKUP_ANCHOR_XPATH,
+    )
+
+    @classmethod
+    def get_session(cls) -> requests.Session:
+        """
+        A session that keeps connections alive, shared by all requests of the process
+        """
+        with cls._lock:
+            if cls._session is None:
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=settings.KVK_SCRAPE_CONCURRENCY
+                )
+                cls._session = requests.Session()
+                cls._session.mount("https://", adapter)
+                cls._session.mount("http://", adapter)
+            return cls._session
+
+    @classmethod
+    def get_rate_limiter(cls) -> TokenBucket:
+        with cls._lock:
+            if cls._rate_limiter is None:
+                cls._rate_limiter = TokenBucket(
+                    rate=settings.KVK_SCRAPE_RATE_PER_SEC,
+                    capacity=settings.KVK_SCRAPE_BURST,
+                )
+            return cls._rate_limiter
 
     @classmethod
-    def get_companies_for_address(cls, address: str) -> List[Company]:
-        url = f"https://www.uittrekselregister.nl/zoekresultaten?q={address}"
-        logger.info(f"Requesting {url}")
-        response = requests.get(url)
+    def get_cache(cls) -> Optional[DiskCache]:
+        """
+        The cache of parsed search results by normalized address, None if disabled in the settings
+        """
+        if settings.CACHE_DIR is None:
+            return None
+        with cls._lock:
+            if cls._cache is None:
+                cls._cache = DiskCache(
+                    os.path.join(settings.CACHE_DIR, "kvk"),
+                    ttl_sec=settings.KVK_CACHE_TTL_SEC,
+                    max_size_bytes=settings.KVK_CACHE_MAX_SIZE_BYTES,
+                )
+            return cls._cache
+
+    @classmethod
+    def normalize_address(cls, address: str) -> str:
+        return " ".join(address.lower().split())
+
+    @classmethod
+    def get_companies_for_address(
+        cls, address: str, use_cache: bool = True
+    ) -> List[Company]:
+        if use_cache:
+            cached = cls._cache_get(address)
+            if cached is not None:
+                return cached
+        return cls._fetch_companies(address, use_cache=use_cache)
+
+    @classmethod
+    def _fetch_companies(cls, address: str, use_cache: bool = True) -> List[Company]:
+        companies = cls._request_companies(address)
+        if use_cache:
+            cls._cache_set(address, companies)
+        return companies
+
+    @classmethod
+    def _cache_get(cls, address: str) -> Optional[List[Company]]:
+        cache = cls.get_cache()
+        if cache is None:
+            return None
+        cached = cache.get(cls.normalize_address(address))
+        if cached is None:
+            return None
+        return [Company(**company) for company in json.loads(cached)]
+
+    @classmethod
+    def _cache_set(cls, address: str, companies: List[Company]) -> None:
+        cache = cls.get_cache()
+        if cache is not None:
+            value = json.dumps([c.model_dump() for c in companies]).encode()
+            cache.set(cls.normalize_address(address), value)
+
+    @classmethod
+    def _request_companies(cls, address: str) -> List[Company]:
+        return cls._request_page(address).companies
+
+    @classmethod
+    def _request_page(cls, address: str) -> ResultsPage:
+        cls.get_rate_limiter().acquire()
+        logger.info(f"Requesting {cls.URL} for {address}")
+        response = cls.get_session().get(
+            cls.URL, params={"q": address}, timeout=cls.TIMEOUT_SEC
+        )
         if response.status_code != 200:
+            cls.health_monitor.record_response(response.status_code)
             raise ScraperMalfunction(response.status_code)
-        logger.info(f"Received response for {url}")
-        tree = html.fromstring(response.text)
+        logger.info(f"Received response for {address}")
+        page = cls.parser.parse(response.text)
+        companies = page.companies
+        cls.health_monitor.record_response(
+            response.status_code,
+            has_markup_anchor=page.has_markup_anchor,
+            result_count=len(companies),
+        )
+        logger.info(f"{len(companies)} companies found for {address}")
+        return page
 
-        # Extract the content after the "Omschrijving" field and check for "Niet actief"
-        result_blocks = tree.xpath('//div[@class="result-block"]')
-        companies = []
+    @classmethod
+    def get_companies_for_addresses(
+        cls, addresses: List[str], max_workers: Optional[int] = None
+    ) -> List[List[Company]]:
+        """
+        Requests the companies of multiple addresses concurrently, within the rate limit.
+        Returns the companies in the order of the addresses.
+        """
+        max_workers = max_workers or settings.KVK_SCRAPE_CONCURRENCY
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(cls.get_companies_for_address, addresses))
+
+    @classmethod
+    def format_address(cls, street: str, housenumber: str, city: Optional[str]) -> str:
+        return f"{street} {housenumber}, {city}"
 
-        for block in result_blocks:
-            omschrijving = block.xpath(
-                './/div[contains(@class, "detail-block mt-4")]/div[contains(text(), "Omschrijving:")]/following-sibling::span[@class="value-column"]/text()'
+    @classmethod
+    def normalize_housenumber(cls, housenumber: str) -> str:
+        """
+        Like "229a" for "229 A" and "229-a", the separator of "12 - 1" is kept as "12-1"
+        """
+        housenumber = re.sub(r"\s+", "", housenumber.lower())
+        return re.sub(r"-(?=[a-z])", "", housenumber)
+
+    @classmethod
+    def parse_housenumber(cls, address: str, street: str) -> Optional[str]:
+        """
+        The housenumber in an address like "Postweg 229 A, 6741LB Lunteren", None if it is on another street
+        """
+        address = cls.normalize_address(address)
+        street = cls.normalize_address(street)
+        if not address.startswith(street + " "):
+            return None
+        return cls.normalize_housenumber(address[len(street) :].split(",")[0])
+
+    @classmethod
+    def parse_city(cls, address: str) -> Optional[str]:
+        """
+        The city in an address like "Postweg 229 A, 6741LB Lunteren", None if the address has no city
+        """
+        if "," not in address:
+            return None
+        city = cls.normalize_address(address.rsplit(",", 1)[1])
+        return re.sub(r"^\d{4}\s?[a-z]{2}\s+", "", city) or None
+
+    @classmethod
+    def get_companies_for_street(
+        cls, street: str, city: Optional[str], housenumbers: List[str]
+    ) -> Optional[Dict[str, List[Company]]]:
+        """
+        Searches all companies of a street with a single request and assigns them to the housenumbers
+        by the address in the results. Returns None if the results are truncated
+        or cannot be assigned reliably, the addresses are then searched one by one.
+        """
+        query = f"{street}, {city}"
+        companies = cls._cache_get(query)
+        if companies is None:
+            page = cls._request_page(query)
+            if page.has_next_page:
+                logger.info(f"results for {street}, {city} have more pages")
+                return None
+            companies = page.companies
+            cls._cache_set(query, companies)
+        if len(companies) >= cls.STREET_RESULTS_MAX:
+            logger.info(f"too many results for {street}, {city}")
+            return None
+        companies_by_number = {
+            cls.normalize_housenumber(housenumber): [] for housenumber in housenumbers
+        }
+        for company in companies:
+            if company.address is None:
+                logger.info(f"no addresses in results for {street}, {city}")
+                return None
+            if city:
+                city_company = cls.parse_city(company.address)
+                if city_company is None:
+                    logger.info(f"no city in results for {street}, {city}")
+                    return None
+                if city_company != cls.normalize_address(city):
+                    continue
+            housenumber = cls.parse_housenumber(company.address, street)
+            if housenumber in companies_by_number:
+                companies_by_number[housenumber].append(company)
+        result = {}
+        for housenumber in housenumbers:
+            result[housenumber] = companies_by_number[
+                cls.normalize_housenumber(housenumber)
+            ]
+            cls._cache_set(
+                cls.format_address(street, housenumber, city), result[housenumber]
             )
-            niet_actief = block.xpath('.//span[contains(@class, "inactive")]/text()')
+        return result
 
-            omschrijving_text = omschrijving[0].strip() if omschrijving else ""
-            active = not bool(niet_actief)
-            if omschrijving_text:
-                companies.append(Company(description=omschrijving_text, active=active))
-        logger.info(f"{len(companies)} companies found for {address}")
-        return companies
+    @classmethod
+    def get_companies_for_addresses_by_street(
+        cls,
+        addresses: List[Tuple[str, str, Optional[str]]],
+        max_workers: Optional[int] = None,
+    ) -> List[List[Company]]:
+        """
+        Requests the companies of (street, housenumber, city) addresses with one search per street,
+        for streets with multiple uncached addresses. Other addresses, and those of streets
+        with results that cannot be assigned, are searched one by one.
+        Returns the companies in the order of the addresses.
+        """
+        max_workers = max_workers or settings.KVK_SCRAPE_CONCURRENCY
+        queries = [cls.format_address(*address) for address in addresses]
+        results: List[Optional[List[Company]]] = [
+            cls._cache_get(query) for query in queries
+        ]
+
+        groups: Dict[Tuple[str, str], List[int]] = defaultdict(list)
+        for i, (street, _housenumber, city) in enumerate(addresses):
+            if results[i] is None:
+                key = (cls.normalize_address(street), cls.normalize_address(city or ""))
+                groups[key].append(i)
+        street_groups = [
+            indices
+            for indices in groups.values()
+            if len(indices) >= cls.STREET_GROUP_MIN
+        ]
+        logger.info(
+            f"searching {len(street_groups)} streets for {sum(map(len, street_groups))} addresses"
+        )
+
+        def get_companies_for_group(indices: List[int]):
+            street, _housenumber, city = addresses[indices[0]]
+            housenumbers = [addresses[i][1] for i in indices]
+            return cls.get_companies_for_street(street, city, housenumbers)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for indices, companies_by_number in zip(
+                street_groups, executor.map(get_companies_for_group, street_groups)
+            ):
+                if companies_by_number is None:
+                    continue
+                for i in indices:
+                    results[i] = companies_by_number[addresses[i][1]]
+
+            pending = [i for i, result in enumerate(results) if result is None]
+            fetched = executor.map(cls._fetch_companies, [queries[i] for i in pending])
+            for i, companies in zip(pending, fetched):
+                results[i] = companies
+        return results
+
+    @classmethod
+    def log_cache_stats(cls) -> None:
+        cache = cls.get_cache()
+        if cache is not None:
+            logger.info(f"KVK cache: {cache.stats}")
+
+    @classmethod
+    def parse_companies(cls, text: str) -> List[Company]:
+        return cls.parser.parse(text).companies
 
     @classmethod
     def check_is_working(cls) -> bool:
-        companies = cls.get_companies_for_address("Postweg 227 Lunteren")
+        companies = cls.get_companies_for_address(
+            "Postweg 227 Lunteren", use_cache=False
+        )
         return len(companies) == 3
+
+    @classmethod
+    def check_health(cls) -> bool:
+        """
+        Returns False if the responses show an anomaly and the canary search fails
+        """
+        return cls.health_monitor.check(cls.check_is_working)
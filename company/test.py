@@ -1,7 +1,31 @@
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
 from unittest import TestCase
+from unittest import mock
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
 
+from django.test import SimpleTestCase
+from django.test import override_settings
+
+from cache.disk import DiskCache
+from company.classifier import Classification
+from company.classifier import DescriptionClassifier
+from company.kvk import CircuitBreaker
+from company.kvk import Company
+from company.kvk import ScraperHealthMonitor
+from company.kvk import ResultsPage
+from company.kvk import ResultsParser
+from company.kvk import ScraperMalfunction
+from company.kvk import TokenBucket
 from company.kvk import UittrekselRegisterScraper
 
+TESTDATA_DIR = os.path.join(os.path.dirname(__file__), "testdata")
+
 
 class TestScrapeKVKOmschrijving(TestCase):
     def test_scrape_company_description(self):
@@ -18,3 +42,375 @@ class TestScrapeKVKOmschrijving(TestCase):
         address = "Pietjepuk 227 Lunteren"
         companies = UittrekselRegisterScraper.get_companies_for_address(address)
         self.assertEqual(0, len(companies))
+
+
+class KVKStandInHandler(BaseHTTPRequestHandler):
+    """Serves a recorded results page for Postweg addresses and an empty page otherwise"""
+
+    with open(os.path.join(TESTDATA_DIR, "zoekresultaten.html"), "rb") as f:
+        page = f.read()
+    with open(os.path.join(TESTDATA_DIR, "zoekresultaten_straat.html"), "rb") as f:
+        page_street = f.read()
+    page_street_paginated = page_street.replace(
+        b"<footer", b'<a rel="next" href="/zoekresultaten?page=2">Volgende</a><footer'
+    )
+    page_empty = b"<html><body><div>Geen resultaten</div></body></html>"
+    page_changed = (
+        b'<html><body><div class="result-block"><p>Postweg</p></div></body></html>'
+    )
+    lock = threading.Lock()
+    in_flight = 0
+    max_in_flight = 0
+    request_times = []
+    delay_sec = 0.05
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+            cls.request_times.append(time.monotonic())
+        time.sleep(cls.delay_sec)
+        address = parse_qs(urlparse(self.path).query)["q"][0]
+        if address == "error":
+            body, status = b"", 503
+        elif address == "Postweg, Lunteren":
+            body, status = cls.page_street, 200
+        elif address == "Postweg, Ede":
+            body, status = cls.page_street_paginated, 200
+        elif address.startswith("Postweg"):
+            body, status = cls.page, 200
+        elif address == "changed":
+            body, status = cls.page_changed, 200
+        else:
+            body, status = cls.page_empty, 200
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with cls.lock:
+            cls.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+@override_settings(CACHE_DIR=None)
+class TestScraperStandIn(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), KVKStandInHandler)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}/zoekresultaten"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        KVKStandInHandler.max_in_flight = 0
+        KVKStandInHandler.request_times = []
+        self.rate = 40
+        patches = [
+            mock.patch.object(UittrekselRegisterScraper, "URL", self.url),
+            mock.patch.object(
+                UittrekselRegisterScraper, "_rate_limiter", TokenBucket(self.rate)
+            ),
+            mock.patch.object(
+                UittrekselRegisterScraper, "health_monitor", ScraperHealthMonitor()
+            ),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_get_companies_for_address(self):
+        companies = UittrekselRegisterScraper.get_companies_for_address(
+            "Postweg 227 Lunteren"
+        )
+        self.assertEqual(3, len(companies))
+        self.assertEqual(
+            "Landbouwbedrijf, bestaande uit een melkveehouderij.",
+            companies[1].description,
+        )
+        self.assertFalse(companies[2].active)
+        self.assertTrue(UittrekselRegisterScraper.check_is_working())
+
+    def test_get_companies_for_addresses(self):
+        addresses = [f"Postweg {i} Lunteren" for i in range(10)]
+        addresses[3] = "Pietjepuk 227 Lunteren"
+        results = UittrekselRegisterScraper.get_companies_for_addresses(
+            addresses, max_workers=3
+        )
+        self.assertEqual(
+            [0 if i == 3 else 3 for i in range(10)], list(map(len, results))
+        )
+        self.assertGreater(KVKStandInHandler.max_in_flight, 1)
+        self.assertLessEqual(KVKStandInHandler.max_in_flight, 3)
+        times = KVKStandInHandler.request_times
+        elapsed = times[-1] - times[0]
+        self.assertGreaterEqual(elapsed, (len(times) - 1) / self.rate * 0.9)
+
+    def test_cache(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = DiskCache(directory.name)
+        patch = mock.patch.object(UittrekselRegisterScraper, "_cache", cache)
+        patch.start()
+        self.addCleanup(patch.stop)
+        with self.settings(CACHE_DIR=cache.directory):
+            addresses = ["Postweg 227 Lunteren", "Pietjepuk 227 Lunteren"]
+            results = UittrekselRegisterScraper.get_companies_for_addresses(addresses)
+            self.assertEqual(2, len(KVKStandInHandler.request_times))
+            results_cached = UittrekselRegisterScraper.get_companies_for_addresses(
+                [" postweg 227  LUNTEREN", "Pietjepuk 227 Lunteren"]
+            )
+            self.assertEqual(results, results_cached)
+            self.assertEqual(2, len(KVKStandInHandler.request_times))
+            self.assertEqual(2, cache.stats.hits)
+            # the health check always requests the register
+            UittrekselRegisterScraper.check_is_working()
+            self.assertEqual(3, len(KVKStandInHandler.request_times))
+
+    def test_get_companies_for_addresses_by_street(self):
+        addresses = [
+            ("Postweg", "227", "Lunteren"),
+            ("Dorpsstraat", "3", "Ede"),
+            ("Postweg", "229a", "Lunteren"),
+            ("Postweg", "12", "Lunteren"),
+        ]
+        results = UittrekselRegisterScraper.get_companies_for_addresses_by_street(
+            addresses
+        )
+        self.assertEqual([2, 0, 1, 0], list(map(len, results)))
+        self.assertEqual(
+            "Landbouwbedrijf, bestaande uit een melkveehouderij.",
+            results[0][0].description,
+        )
+        self.assertFalse(results[0][1].active)
+        self.assertEqual("Het houden van pluimvee.", results[2][0].description)
+        # one search for Postweg and one for Dorpsstraat
+        self.assertEqual(2, len(KVKStandInHandler.request_times))
+
+    def test_get_companies_for_addresses_by_street_fallback(self):
+        # the results for this street have no addresses, each address is searched
+        addresses = [("Postweg", "1", "Barneveld"), ("Postweg", "2", "Barneveld")]
+        results = UittrekselRegisterScraper.get_companies_for_addresses_by_street(
+            addresses
+        )
+        self.assertEqual([3, 3], list(map(len, results)))
+        self.assertEqual(3, len(KVKStandInHandler.request_times))
+
+    def test_get_companies_for_addresses_by_street_paginated(self):
+        # the results for this street have a next page, each address is searched
+        addresses = [("Postweg", "227", "Ede"), ("Postweg", "229a", "Ede")]
+        results = UittrekselRegisterScraper.get_companies_for_addresses_by_street(
+            addresses
+        )
+        self.assertEqual([3, 3], list(map(len, results)))
+        self.assertEqual(3, len(KVKStandInHandler.request_times))
+
+    def test_parse_housenumber(self):
+        parse = UittrekselRegisterScraper.parse_housenumber
+        self.assertEqual("229a", parse("Postweg 229 A, 6741LB Lunteren", "Postweg"))
+        self.assertEqual("12-1", parse("postweg 12-1", "Postweg"))
+        self.assertEqual("12-1", parse("Postweg 12 - 1, 6741LB Lunteren", "Postweg"))
+        self.assertEqual("229a", parse("Postweg 229-A, Lunteren", "Postweg"))
+        self.assertIsNone(parse("Postwegje 12, Lunteren", "Postweg"))
+
+    def test_get_companies_for_street_city(self):
+        companies = [
+            Company(description="Het houden van varkens.", active=True, address=address)
+            for address in ["Dorpsstraat 3, 8181HA Heerde", "Dorpsstraat 3, 6711AB Ede"]
+        ]
+        page = ResultsPage(companies=companies, has_markup_anchor=True)
+        with mock.patch.object(
+            UittrekselRegisterScraper, "_request_page", return_value=page
+        ):
+            result = UittrekselRegisterScraper.get_companies_for_street(
+                "Dorpsstraat", "Ede", ["3"]
+            )
+        self.assertEqual([companies[1]], result["3"])
+
+    def test_parse_city(self):
+        parse = UittrekselRegisterScraper.parse_city
+        self.assertEqual("lunteren", parse("Postweg 229 A, 6741LB Lunteren"))
+        self.assertEqual("heerde", parse("Dorpsstraat 3, 8181 HA Heerde"))
+        self.assertEqual("ede", parse("Dorpsstraat 3, Ede"))
+        self.assertIsNone(parse("Dorpsstraat 3 Ede"))
+
+    def test_error_status(self):
+        with self.assertRaises(ScraperMalfunction):
+            UittrekselRegisterScraper.get_companies_for_addresses(
+                ["Postweg 1", "error"]
+            )
+        self.assertEqual(
+            "status code 503", UittrekselRegisterScraper.health_monitor.anomaly
+        )
+
+    def test_check_health(self):
+        monitor = UittrekselRegisterScraper.health_monitor
+        UittrekselRegisterScraper.get_companies_for_addresses(
+            ["Postweg 1", "Kerkweg 1"]
+        )
+        self.assertTrue(UittrekselRegisterScraper.check_health())
+        self.assertEqual(0, monitor.canary_runs)
+        self.assertEqual(2, len(KVKStandInHandler.request_times))
+
+        UittrekselRegisterScraper.get_companies_for_address("changed")
+        self.assertEqual("expected markup not found", monitor.anomaly)
+        self.assertTrue(UittrekselRegisterScraper.check_health())
+        self.assertEqual(1, monitor.canary_runs)
+        self.assertIsNone(monitor.anomaly)
+
+
+class TestResultsParser(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.pages = []
+        for filename in ["zoekresultaten.html", "zoekresultaten_straat.html"]:
+            with open(os.path.join(TESTDATA_DIR, filename), encoding="utf-8") as f:
+                cls.pages.append(f.read())
+
+    def test_parse(self):
+        page = ResultsParser().parse(self.pages[0])
+        self.assertTrue(page.has_markup_anchor)
+        self.assertEqual(3, len(page.companies))
+        self.assertEqual(
+            "Landbouwbedrijf, bestaande uit een melkveehouderij.",
+            page.companies[1].description,
+        )
+        self.assertEqual([True, True, False], [c.active for c in page.companies])
+
+    def test_next_page(self):
+        self.assertFalse(ResultsParser().parse(self.pages[1]).has_next_page)
+        page = ResultsParser().parse(KVKStandInHandler.page_street_paginated.decode())
+        self.assertTrue(page.has_next_page)
+        self.assertEqual(4, len(page.companies))
+
+    def test_partial_equals_full(self):
+        parser_partial = ResultsParser(stop_marker="<footer")
+        for text in self.pages:
+            self.assertEqual(text, ResultsParser().truncate(text))
+            self.assertLess(len(parser_partial.truncate(text)), len(text))
+            self.assertEqual(ResultsParser().parse(text), parser_partial.parse(text))
+
+    def test_markup_anchor(self):
+        self.assertTrue(ResultsParser().parse(self.pages[0]).has_markup_anchor)
+        page_changed = KVKStandInHandler.page_changed.decode()
+        self.assertFalse(ResultsParser().parse(page_changed).has_markup_anchor)
+        page_empty = KVKStandInHandler.page_empty.decode()
+        self.assertTrue(ResultsParser().parse(page_empty).has_markup_anchor)
+        parser = ResultsParser(markup_anchor='//div[@class="results"]')
+        self.assertTrue(parser.parse(self.pages[0]).has_markup_anchor)
+        self.assertFalse(parser.parse(page_empty).has_markup_anchor)
+
+    def test_truncate_without_results(self):
+        parser = ResultsParser(stop_marker="<footer")
+        text = "<html><body><div>Geen resultaten</div></body></html>"
+        self.assertEqual(text, parser.truncate(text))
+        text_footer = text.replace("<div>", "<footer><div>")
+        self.assertEqual("<html><body>", parser.truncate(text_footer))
+        page = parser.parse(text_footer)
+        self.assertEqual([], page.companies)
+        self.assertTrue(page.has_markup_anchor)
+
+
+class TestScraperHealthMonitor(TestCase):
+    def test_empty_run(self):
+        monitor = ScraperHealthMonitor(empty_run_max=3)
+        canary_results = []
+        for result_count in [0, 0, 2, 0, 0]:
+            monitor.record_response(200, result_count=result_count)
+        self.assertTrue(monitor.check(lambda: canary_results.append(True)))
+        self.assertEqual([], canary_results)
+        monitor.record_response(200, result_count=0)
+        self.assertIsNotNone(monitor.anomaly)
+        self.assertFalse(monitor.check(lambda: False))
+        self.assertIsNotNone(monitor.anomaly)
+        self.assertTrue(monitor.check(lambda: True))
+        self.assertIsNone(monitor.anomaly)
+        self.assertEqual(2, monitor.canary_runs)
+
+
+class TestCircuitBreaker(TestCase):
+    def test_backoff(self):
+        now = [0.0]
+        breaker = CircuitBreaker(10, 35, jitter=0, clock=lambda: now[0])
+        self.assertFalse(breaker.is_open())
+        self.assertEqual([10, 20, 35, 35], [breaker.record_failure() for _ in range(4)])
+        self.assertTrue(breaker.is_open())
+        now[0] = 20.0
+        self.assertEqual(15, breaker.remaining_sec())
+        now[0] = 35.0
+        self.assertFalse(breaker.is_open())
+        breaker.record_success()
+        self.assertEqual(10, breaker.record_failure())
+
+    def test_jitter(self):
+        breaker = CircuitBreaker(10, 100, jitter=0.5)
+        backoff = breaker.record_failure()
+        self.assertGreaterEqual(backoff, 10)
+        self.assertLessEqual(backoff, 15)
+
+
+class TestTokenBucket(TestCase):
+    def test_acquire(self):
+        now = [0.0]
+        waits = []
+        bucket = TokenBucket(
+            rate=2, capacity=2, clock=lambda: now[0], sleep=waits.append
+        )
+        self.assertEqual([0, 0, 0.5, 1.0], [bucket.acquire() for _ in range(4)])
+        self.assertEqual([0.5, 1.0], waits)
+        now[0] = 10.0
+        self.assertEqual(0, bucket.acquire())
+        self.assertEqual(0, bucket.acquire())
+        self.assertEqual(0.5, bucket.acquire())
+
+
+class TestDescriptionClassifier(TestCase):
+    def setUp(self):
+        self.classifier = DescriptionClassifier()
+
+    def test_classify(self):
+        classification = self.classifier.classify(
+            "Landbouwbedrijf, bestaande uit een Melkveehouderij."
+        )
+        self.assertEqual(Classification(cattle=True, cattle_dairy=True), classification)
+
+    def test_classify_keyword_in_keyword(self):
+        classification = self.classifier.classify("Het houden van vleeskalveren")
+        self.assertEqual(Classification(cattle=True, cattle_beef=True), classification)
+
+    def test_classify_negation(self):
+        classification = self.classifier.classify("Rundveehouderij, geen melkvee")
+        self.assertEqual(Classification(cattle=True, cattle_beef=True), classification)
+
+    def test_classify_many(self):
+        classifications = self.classifier.classify_many(
+            ["Varkenshouderij", "Schapen- en geitenhouderij", "Administratiekantoor"]
+        )
+        self.assertEqual(
+            [
+                Classification(pig=True),
+                Classification(sheep=True, goat=True),
+                Classification(),
+            ],
+            classifications,
+        )
+
+    def test_key(self):
+        key = DescriptionClassifier.get_key("Varkens  houderij ")
+        self.assertEqual(key, DescriptionClassifier.get_key("varkens houderij"))
+        self.assertNotEqual(key, DescriptionClassifier.get_key("varkenshouderij"))
+
+    def test_classify_cached(self):
+        self.classifier.classify("Varkenshouderij")
+        self.classifier.classify("VARKENSHOUDERIJ ")
+        self.assertEqual(1, self.classifier.cache_info().hits)
@@ -0,0 +1,232 @@
+import math
+from collections import defaultdict
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Sequence
+from typing import Tuple
+
+import numpy as np
+
+from geo.utils import METERS_PER_DEGREE_LAT
+from geo.utils import haversine
+
+
+class PointIndex:
+    """
+    A grid index over points for nearest-k and count-within-radius queries.
+    Points are bucketed in cells of about cell_size meters (an equirectangular projection),
+    candidates from the cells around a query are checked with the haversine distance.
+    """
+
+    def __init__(
+        self,
+        items: Sequence[Any],
+        lats: Sequence[float],
+        lons: Sequence[float],
+        cell_size: float = 100,
+    ):
+        assert len(items) == len(lats) == len(lons)
+        self.items = list(items)
+        self.lats = list(lats)
+        self.lons = list(lons)
+        self.cell_size = cell_size
+        lat_ref = sum(self.lats) / len(self.lats) if self.lats else 0.0
+        self.cell_lat = cell_size / METERS_PER_DEGREE_LAT
+        self.cell_lon = self.cell_lat / math.cos(math.radians(min(abs(lat_ref), 89.0)))
+        self.bounds = (
+            (min(self.lats), max(self.lats), min(self.lons), max(self.lons))
+            if self.lats
+            else None
+        )
+        self.cells: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+        for i, (lat, lon) in enumerate(zip(self.lats, self.lons)):
+            self.cells[self._cell(lat, lon)].append(i)
+
+    @classmethod
+    def from_nodes(cls, nodes: List[Dict], cell_size: float = 100) -> "PointIndex":
+        """
+        Creates an index of OSM nodes as returned by Overpass
+        """
+        return cls(
+            nodes,
+            [node["lat"] for node in nodes],
+            [node["lon"] for node in nodes],
+            cell_size=cell_size,
+        )
+
+    @classmethod
+    def from_objects(cls, objects: Iterable[Any], cell_size: float = 100):
+        """
+        Creates an index of objects with lat and lon attributes, for example addresses
+        """
+        objects = list(objects)
+        return cls(
+            objects,
+            [o.lat for o in objects],
+            [o.lon for o in objects],
+            cell_size=cell_size,
+        )
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def within(self, lat: float, lon: float, radius: float) -> List[Any]:
+        """
+        Returns the items within radius (in m), sorted by distance
+        """
+        return [self.items[i] for _distance, i in self._query(lat, lon, radius)]
+
+    def count_within(self, lat: float, lon: float, radius: float) -> int:
+        return len(self._query(lat, lon, radius))
+
+    def nearest(
+        self, lat: float, lon: float, k: int, max_distance: Optional[float] = None
+    ) -> List[Any]:
+        """
+        Returns the k nearest items, optionally limited to those within max_distance (in m)
+        """
+        if max_distance is not None:
+            return self.within(lat, lon, max_distance)[:k]
+        if not self.items:
+            return []
+        radius = self.cell_size
+        radius_max = self._distance_max(lat, lon)
+        while radius < radius_max:
+            candidates = self._query(lat, lon, radius)
+            if len(candidates) >= k:
+                return [self.items[i] for _distance, i in candidates[:k]]
+            radius *= 2
+        return self.within(lat, lon, radius_max)[:k]
+
+    def within_many(
+        self, coordinates: Iterable[Tuple[float, float]], radius: float
+    ) -> List[List[Any]]:
+        return [self.within(lat, lon, radius) for lat, lon in coordinates]
+
+    def count_within_many(
+        self, coordinates: Iterable[Tuple[float, float]], radius: float
+    ) -> List[int]:
+        return [self.count_within(lat, lon, radius) for lat, lon in coordinates]
+
+    def nearest_many(
+        self,
+        coordinates: Iterable[Tuple[float, float]],
+        k: int,
+        max_distance: Optional[float] = None,
+    ) -> List[List[Any]]:
+        return [
+            self.nearest(lat, lon, k, max_distance=max_distance)
+            for lat, lon in coordinates
+        ]
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return math.floor(lat / self.cell_lat), math.floor(lon / self.cell_lon)
+
+    def _query(self, lat: float, lon: float, radius: float) -> List[Tuple[float, int]]:
+        """
+        Returns (distance, index) pairs of the points within radius, sorted by distance
+        """
+        if not self.items:
+            return []
+        delta_lat = radius / METERS_PER_DEGREE_LAT
+        lat_abs_max = min(abs(lat) + delta_lat, 89.0)
+        # slightly widen the longitude range to be conservative near the range ends
+        delta_lon = 1.01 * delta_lat / math.cos(math.radians(lat_abs_max))
+        row_min, col_min = self._cell(lat - delta_lat, lon - delta_lon)
+        row_max, col_max = self._cell(lat + delta_lat, lon + delta_lon)
+        candidates = self._candidates(row_min, row_max, col_min, col_max)
+        result = []
+        for i in candidates:
+            distance = haversine(lat, lon, self.lats[i], self.lons[i])
+            if distance <= radius:
+                result.append((distance, i))
+        result.sort()
+        return result
+
+    def _candidates(
+        self, row_min: int, row_max: int, col_min: int, col_max: int
+    ) -> Iterable[int]:
+        """
+        The indices of the points in the cells of the given rows and columns
+        """
+        if (row_max - row_min + 1) * (col_max - col_min + 1) > len(self.cells):
+            return (i for indices in self.cells.values() for i in indices)
+        return (
+            i
+            for row in range(row_min, row_max + 1)
+            for col in range(col_min, col_max + 1)
+            for i in self.cells.get((row, col), ())
+        )
+
+    def _distance_max(self, lat: float, lon: float) -> float:
+        """
+        An upper bound of the distance from the given point to any point in the index
+        """
+        lat_min, lat_max, lon_min, lon_max = self.bounds
+        delta_lat = max(abs(lat - lat_min), abs(lat - lat_max))
+        delta_lon = max(abs(lon - lon_min), abs(lon - lon_max))
+        return (delta_lat + delta_lon) * METERS_PER_DEGREE_LAT + self.cell_size
+
+
+class CompactPointIndex(PointIndex):
+    """
+    A PointIndex for millions of points, like all address nodes of a country.
+    The coordinates are kept in numpy arrays and the cells as sorted arrays of cell keys,
+    instead of Python lists, so a point takes about 32 bytes.
+    The items are not copied, they can be a compact sequence that creates each item on access.
+    """
+
+    # a cell key is row * 2**32 + col, columns are within +-2**31 for cells larger than 1 cm
+    COLUMNS = 2**32
+
+    def __init__(
+        self,
+        items: Sequence[Any],
+        lats: Sequence[float],
+        lons: Sequence[float],
+        cell_size: float = 100,
+    ):
+        assert len(items) == len(lats) == len(lons)
+        self.items = items
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.cell_size = cell_size
+        lat_ref = float(self.lats.mean()) if len(self.lats) else 0.0
+        self.cell_lat = cell_size / METERS_PER_DEGREE_LAT
+        self.cell_lon = self.cell_lat / math.cos(math.radians(min(abs(lat_ref), 89.0)))
+        self.bounds = (
+            (
+                float(self.lats.min()),
+                float(self.lats.max()),
+                float(self.lons.min()),
+                float(self.lons.max()),
+            )
+            if len(self.lats)
+            else None
+        )
+        rows = np.floor(self.lats / self.cell_lat).astype(np.int64)
+        cols = np.floor(self.lons / self.cell_lon).astype(np.int64)
+        keys = rows * self.COLUMNS + cols
+        # the point indices sorted by cell, with the start of each cell in them
+        self.order = np.argsort(keys, kind="stable")
+        self.keys, starts = np.unique(keys[self.order], return_index=True)
+        self.starts = np.append(starts, len(keys))
+
+    def _candidates(
+        self, row_min: int, row_max: int, col_min: int, col_max: int
+    ) -> Iterable[int]:
+        if (row_max - row_min + 1) * (col_max - col_min + 1) > len(self.keys):
+            return range(len(self.items))
+        # the cells of a row are adjacent in the sorted keys
+        rows = np.arange(row_min, row_max + 1, dtype=np.int64) * self.COLUMNS
+        firsts = np.searchsorted(self.keys, rows + col_min, side="left")
+        lasts = np.searchsorted(self.keys, rows + col_max, side="right")
+        return [
+            i
+            for first, last in zip(firsts.tolist(), lasts.tolist())
+            if first < last
+            for i in self.order[self.starts[first] : self.starts[last]].tolist()
+        ]
@@ -0,0 +1,84 @@
+import random
+from unittest import TestCase
+
+from geo.index import CompactPointIndex
+from geo.index import PointIndex
+from geo.utils import BBox
+from geo.utils import haversine
+
+
+class TestBBox(TestCase):
+
+    def test_expand(self):
+        bbox = BBox(lat_min=52.0, lon_min=5.0, lat_max=52.1, lon_max=5.1)
+        bbox_expanded = bbox.expand(1000)
+        self.assertAlmostEqual(
+            haversine(bbox.lat_min, 5.0, bbox_expanded.lat_min, 5.0), 1000, delta=1
+        )
+        self.assertGreater(
+            haversine(52.1, bbox.lon_max, 52.1, bbox_expanded.lon_max), 1000
+        )
+
+
+class TestPointIndex(TestCase):
+    INDEX_CLASS = PointIndex
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        rng = random.Random(1)
+        cls.points = [
+            (rng.uniform(52.0, 52.05), rng.uniform(5.5, 5.58)) for _ in range(2000)
+        ]
+        cls.queries = [
+            (rng.uniform(51.99, 52.06), rng.uniform(5.49, 5.59)) for _ in range(100)
+        ]
+        cls.index = cls.INDEX_CLASS(
+            list(range(len(cls.points))),
+            [lat for lat, _lon in cls.points],
+            [lon for _lat, lon in cls.points],
+        )
+
+    def distances(self, lat, lon):
+        return sorted(
+            (haversine(lat, lon, point_lat, point_lon), i)
+            for i, (point_lat, point_lon) in enumerate(self.points)
+        )
+
+    def test_within(self):
+        for lat, lon in self.queries:
+            expected = [
+                i for distance, i in self.distances(lat, lon) if distance <= 150
+            ]
+            self.assertEqual(self.index.within(lat, lon, 150), expected)
+            self.assertEqual(self.index.count_within(lat, lon, 150), len(expected))
+
+    def test_nearest(self):
+        for lat, lon in self.queries:
+            expected = [i for _distance, i in self.distances(lat, lon)[:5]]
+            self.assertEqual(self.index.nearest(lat, lon, 5), expected)
+
+    def test_nearest_far_away(self):
+        nearest = self.index.nearest(50.0, 3.0, 3)
+        expected = [i for _distance, i in self.distances(50.0, 3.0)[:3]]
+        self.assertEqual(nearest, expected)
+
+    def test_many(self):
+        counts = self.index.count_within_many(self.queries, 200)
+        nearest = self.index.nearest_many(self.queries, 2, max_distance=200)
+        for count, items in zip(counts, nearest):
+            self.assertEqual(min(count, 2), len(items))
+
+    def test_empty(self):
+        index = self.INDEX_CLASS([], [], [])
+        self.assertEqual(index.nearest(52.0, 5.0, 3), [])
+        self.assertEqual(index.count_within(52.0, 5.0, 100), 0)
+
+
+class TestCompactPointIndex(TestPointIndex):
+    INDEX_CLASS = CompactPointIndex
+
+    def test_negative_coordinates(self):
+        index = CompactPointIndex(["a", "b"], [-33.9, -33.9], [-70.0, 18.4])
+        self.assertEqual(["a"], index.within(-33.9001, -70.0001, 50))
+        self.assertEqual(["b"], index.nearest(-34.0, 18.0, 1))
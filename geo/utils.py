@@ -1,5 +1,37 @@
+import math
+
+import numpy as np
 from pydantic import BaseModel
 
+EARTH_RADIUS = 6371 * 1000  # in m
+METERS_PER_DEGREE_LAT = EARTH_RADIUS * math.pi / 180
+
+
+def haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """
+    The haversine distance (in m) between two coordinates
+    """
+    d_lat = math.radians(lat2 - lat1)
+    d_lon = math.radians(lon2 - lon1)
+    a = math.sin(d_lat / 2) ** 2 + math.sin(d_lon / 2) ** 2 * math.cos(
+        math.radians(lat1)
+    ) * math.cos(math.radians(lat2))
+    return 2 * EARTH_RADIUS * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
+def haversine_array(lats1, lons1, lats2, lons2) -> np.ndarray:
+    """
+    The haversine distances (in m) between arrays of coordinates, broadcast as numpy arrays
+    """
+    lats1 = np.radians(np.asarray(lats1, dtype=np.float64))
+    lons1 = np.radians(np.asarray(lons1, dtype=np.float64))
+    lats2 = np.radians(np.asarray(lats2, dtype=np.float64))
+    lons2 = np.radians(np.asarray(lons2, dtype=np.float64))
+    a = np.sin((lats2 - lats1) / 2) ** 2 + np.sin((lons2 - lons1) / 2) ** 2 * np.cos(
+        lats1
+    ) * np.cos(lats2)
+    return 2 * EARTH_RADIUS * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
 
 class BBox(BaseModel):
     lon_min: float
@@ -15,5 +47,21 @@ class BBox(BaseModel):
             lon_min=values[0], lat_min=values[1], lon_max=values[2], lat_max=values[3]
         )
 
+    def expand(self, distance: float) -> "BBox":
+        """
+        Returns a bbox with a margin of the given distance (in m) on all sides
+        """
+        lat_margin = distance / METERS_PER_DEGREE_LAT
+        lat_abs_max = max(abs(self.lat_min), abs(self.lat_max)) + lat_margin
+        lon_margin = distance / (
+            METERS_PER_DEGREE_LAT * math.cos(math.radians(min(lat_abs_max, 89.0)))
+        )
+        return BBox(
+            lon_min=self.lon_min - lon_margin,
+            lon_max=self.lon_max + lon_margin,
+            lat_min=self.lat_min - lat_margin,
+            lat_max=self.lat_max + lat_margin,
+        )
+
     def __str__(self) -> str:
         return f"{self.lon_min}, {self.lon_max}, {self.lat_min}, {self.lat_max}"
@@ -1,19 +1,29 @@
+import hashlib
+import json
 import logging
 import time
 import warnings
-from dataclasses import dataclass
-from functools import partial
+from datetime import datetime
+from datetime import timezone
+from functools import lru_cache
 from typing import Any
 from typing import Dict
+from typing import Iterator
 from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+from typing import Tuple
 
+import numpy as np
 import pyproj
-from shapely.geometry import Point
+import shapely
 from shapely.geometry import Polygon
-from shapely.ops import transform
 
 from geo.utils import BBox
-from osm.core import api
+from osm.client import AsyncOverpassClient
+from osm.client import iterate_async
+from osm.core import get_pool
 from osm.tile import generate_tiles
 
 logger = logging.getLogger(__name__)
@@ -22,15 +32,15 @@ logger = logging.getLogger(__name__)
 warnings.filterwarnings(action="ignore", category=FutureWarning, module="shapely")
 
 
-@dataclass
 class OSMBuilding:
-    id: int
-    tags: Dict[str, str]
-    raw: Dict[Any, Any]
-    polygon: Polygon
-    coordinates: List[Dict[str, float]]
+    """
+    A compact OSM building way. The coordinates are kept as one float64 array of
+    (lon, lat) rows, the polygon is created when first used and the raw Overpass
+    way is only reconstructed when requested.
+    """
+
+    __slots__ = ("id", "tags", "lonlats", "nodes", "_bounds", "_polygon", "_geometry")
 
-    WGS84 = pyproj.Proj(init="epsg:4326")
     EXCLUDE_TYPES_DEFAULT = (
         "apartments",
         "barracks",
@@ -63,77 +73,227 @@ class OSMBuilding:
         "warehouse",
     )
 
+    def __init__(
+        self,
+        id: int,
+        tags: Dict[str, str],
+        lonlats: np.ndarray,
+        nodes: Optional[np.ndarray] = None,
+        bounds: Optional[Tuple[float, float, float, float]] = None,
+    ):
+        self.id = id
+        self.tags = tags
+        self.lonlats = lonlats
+        self.nodes = nodes
+        self._bounds = bounds  # (minlat, minlon, maxlat, maxlon)
+        self._polygon: Optional[Polygon] = None
+        # area, length and width in m^2 and m, calculated by calculate_geometries
+        self._geometry: Optional[Tuple[float, float, float]] = None
+
+    def __repr__(self) -> str:
+        return f"OSMBuilding(id={self.id}, tags={self.tags})"
+
     @classmethod
     def create_from_osm_way(cls, osm_way_json) -> "OSMBuilding":
-        points = [(point["lon"], point["lat"]) for point in osm_way_json["geometry"]]
-        polygon = Polygon(points)
+        lonlats = np.array(
+            [(point["lon"], point["lat"]) for point in osm_way_json["geometry"]],
+            dtype=np.float64,
+        )
+        nodes = osm_way_json.get("nodes")
+        bounds = osm_way_json.get("bounds")
         return OSMBuilding(
-            raw=osm_way_json,
             id=osm_way_json["id"],
             tags=osm_way_json["tags"],
-            polygon=polygon,
-            coordinates=osm_way_json["geometry"],
+            lonlats=lonlats,
+            nodes=np.array(nodes, dtype=np.int64) if nodes is not None else None,
+            bounds=(
+                (bounds["minlat"], bounds["minlon"], bounds["maxlat"], bounds["maxlon"])
+                if bounds is not None
+                else None
+            ),
         )
 
+    @property
+    def polygon(self) -> Polygon:
+        if self._polygon is None:
+            self._polygon = Polygon(self.lonlats)
+        return self._polygon
+
+    @property
+    def coordinates(self) -> List[Dict[str, float]]:
+        return [{"lat": lat, "lon": lon} for lon, lat in self.lonlats.tolist()]
+
+    @property
+    def bounds(self) -> Dict[str, float]:
+        if self._bounds is None:
+            lon_min, lat_min = self.lonlats.min(axis=0).tolist()
+            lon_max, lat_max = self.lonlats.max(axis=0).tolist()
+            self._bounds = (lat_min, lon_min, lat_max, lon_max)
+        minlat, minlon, maxlat, maxlon = self._bounds
+        return {"minlat": minlat, "minlon": minlon, "maxlat": maxlat, "maxlon": maxlon}
+
+    @property
+    def raw(self) -> Dict[str, Any]:
+        """
+        The way as returned by Overpass
+        """
+        raw = {"type": "way", "id": self.id, "bounds": self.bounds}
+        if self.nodes is not None:
+            raw["nodes"] = self.nodes.tolist()
+        raw["geometry"] = self.coordinates
+        raw["tags"] = self.tags
+        return raw
+
+    @property
+    def content_hash(self) -> str:
+        """
+        A hash of the tags, node ids and coordinates, to detect changed ways
+        """
+        data = json.dumps(self.tags, sort_keys=True).encode() + self.lonlats.tobytes()
+        if self.nodes is not None:
+            data += self.nodes.tobytes()
+        return get_content_hash(data)
+
     @property
     def area_square_meters(self) -> float:
-        return self._polygon_utm_projection.area
+        return self._get_geometry()[0]
 
     @property
-    def length_width(self):
-        box = self._polygon_utm_projection.minimum_rotated_rectangle
-        # get coordinates of polygon vertices
-        x, y = box.exterior.coords.xy
-        # get length of bounding box edges
-        edge_length = (
-            Point(x[0], y[0]).distance(Point(x[1], y[1])),
-            Point(x[1], y[1]).distance(Point(x[2], y[2])),
-        )
-        length = max(edge_length)
-        width = min(edge_length)
+    def length_width(self) -> Tuple[float, float]:
+        _area, length, width = self._get_geometry()
         return length, width
 
     @classmethod
     def calculate_utm_zone(cls, lon) -> int:
         return int((lon + 180) / 6) + 1
 
-    @property
-    def _polygon_utm_projection(self) -> Polygon:
-        utm_zone = self.calculate_utm_zone(self.coordinates[0]["lon"])
-        utm = pyproj.Proj(proj="utm", zone=utm_zone, datum="WGS84")
-        proj = partial(pyproj.transform, self.WGS84, utm)
-        proj_transformed = transform(proj, self.polygon)
-        return proj_transformed
+    def _get_geometry(self) -> Tuple[float, float, float]:
+        if self._geometry is None:
+            self.calculate_geometries([self])
+        return self._geometry
+
+    @classmethod
+    def calculate_geometries(cls, buildings: List["OSMBuilding"]) -> None:
+        """
+        Calculates the area, length and width of the buildings in one pass.
+        The polygons of all buildings in a UTM zone are projected and measured at once.
+        Buildings of which the geometry is already calculated are skipped.
+        A way that is not a closed ring of at least 4 nodes gets an empty geometry.
+        """
+        buildings = [b for b in buildings if b._geometry is None]
+        buildings = [b for b in buildings if cls._check_ring(b)]
+        if len(buildings) == 0:
+            return
+        utm_zones = np.array(
+            [cls.calculate_utm_zone(b.lonlats[0, 0]) for b in buildings]
+        )
+        for utm_zone in np.unique(utm_zones):
+            indices = np.flatnonzero(utm_zones == utm_zone)
+            buildings_zone = [buildings[i] for i in indices]
+            areas, lengths, widths = cls._calculate_geometries_utm(
+                buildings_zone, int(utm_zone)
+            )
+            for building, area, length, width in zip(
+                buildings_zone, areas, lengths, widths
+            ):
+                building._geometry = (float(area), float(length), float(width))
+
+    @classmethod
+    def _check_ring(cls, building: "OSMBuilding") -> bool:
+        lonlats = building.lonlats
+        if len(lonlats) >= 4 and np.array_equal(lonlats[0], lonlats[-1]):
+            return True
+        logger.warning(
+            f"way {building.id} is not a closed ring of at least 4 nodes, skipping its geometry"
+        )
+        building._geometry = (0.0, 0.0, 0.0)
+        return False
+
+    @classmethod
+    def _calculate_geometries_utm(
+        cls, buildings: List["OSMBuilding"], utm_zone: int
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        lonlats = np.concatenate([b.lonlats for b in buildings])
+        ring_indices = np.repeat(
+            np.arange(len(buildings)), [len(b.lonlats) for b in buildings]
+        )
+        x, y = get_utm_transformer(utm_zone).transform(lonlats[:, 0], lonlats[:, 1])
+        rings = shapely.linearrings(np.column_stack([x, y]), indices=ring_indices)
+        polygons = shapely.polygons(rings)
+        areas = shapely.area(polygons)
+
+        # the length and width are the edges of the minimum rotated rectangle
+        boxes = shapely.oriented_envelope(polygons)
+        is_polygon = shapely.get_type_id(boxes) == shapely.GeometryType.POLYGON
+        lengths = shapely.length(boxes)  # for degenerate (line) boxes
+        widths = np.zeros(len(buildings))
+        box_coords, box_indices = shapely.get_coordinates(
+            shapely.get_exterior_ring(boxes[is_polygon]), return_index=True
+        )
+        if len(box_coords):
+            starts = np.searchsorted(
+                box_indices, np.arange(np.count_nonzero(is_polygon))
+            )
+            edges = np.stack(
+                [
+                    np.linalg.norm(box_coords[starts + 1] - box_coords[starts], axis=1),
+                    np.linalg.norm(
+                        box_coords[starts + 2] - box_coords[starts + 1], axis=1
+                    ),
+                ]
+            )
+            lengths[is_polygon] = edges.max(axis=0)
+            widths[is_polygon] = edges.min(axis=0)
+        return areas, lengths, widths
 
     @classmethod
     def filter_by_area(cls, buildings_osm: List["OSMBuilding"]) -> List["OSMBuilding"]:
-        buildings_osm_large = []
-        for i, building in enumerate(buildings_osm):
-            if i % 1000 == 0:
-                logger.info(f"filtering large buildings {i + 1}/{len(buildings_osm)}")
-            if building.area_square_meters < 200:
-                continue
-            buildings_osm_large.append(building)
-        return buildings_osm_large
+        logger.info(f"filtering large buildings of {len(buildings_osm)} buildings")
+        cls.calculate_geometries(buildings_osm)
+        return [
+            building for building in buildings_osm if building.area_square_meters >= 200
+        ]
 
 
-def get_buildings(bbox, exclude_types, country_code: str):
+def get_content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def get_utm_transformer(utm_zone: int) -> pyproj.Transformer:
+    utm = pyproj.CRS.from_dict({"proj": "utm", "zone": utm_zone, "datum": "WGS84"})
+    return pyproj.Transformer.from_crs("EPSG:4326", utm, always_xy=True)
+
+
+def get_buildings_query(bbox, exclude_types, country_code: str) -> str:
     bbox = f"({bbox[0]},{bbox[1]},{bbox[2]},{bbox[3]})"
     exclude_str = "|".join(exclude_types)
-    query = f"""(
+    return f"""(
         area["ISO3166-1"="{country_code}"];
         way[building]["building"!~"^({exclude_str})$"]{bbox}(area);
     )   
     """
+
+
+def get_buildings(bbox, exclude_types, country_code: str):
+    query = get_buildings_query(bbox, exclude_types, country_code)
     logger.info(f"get buildings for {bbox}")
-    return api.get(
+    return get_pool().get(
         query, responseformat="json", verbosity="geom"
     )  # use verbosity = geom to get way geometry in geojson
 
 
 def get_buildings_batches(
-    bbox: BBox, exclude_types=OSMBuilding.EXCLUDE_TYPES_DEFAULT, country_code="NL"
-):
+    bbox: BBox,
+    exclude_types=OSMBuilding.EXCLUDE_TYPES_DEFAULT,
+    country_code="NL",
+    client: Optional[AsyncOverpassClient] = None,
+) -> Iterator[Dict[str, Any]]:
+    """
+    Yields the building ways in the bbox, fetched in sub-tiles that are requested concurrently.
+    The responses are parsed while they stream in, so ways are yielded before a sub-tile completes
+    and memory use does not grow with the size of the bbox. A way in multiple sub-tiles is yielded once.
+    """
     tiles = generate_tiles(
         min_lat=bbox.lat_min,
         min_lon=bbox.lon_min,
@@ -143,14 +303,97 @@ def get_buildings_batches(
         delta_lon=0.07,
     )
     logger.info(f"{len(tiles)} tiles created")
-    buildings = []
-    for i, tile in enumerate(tiles):
-        logger.info(f"getting tile: {i+1}/{len(tiles)}")
-        buildings += get_buildings(
-            tile, exclude_types=exclude_types, country_code=country_code
-        )["elements"]
-    buildings = [building for building in buildings if building["type"] == "way"]
-    return buildings
+    client = client or AsyncOverpassClient()
+    queries = [
+        (i, get_buildings_query(tile, exclude_types, country_code))
+        for i, tile in enumerate(tiles)
+    ]
+    batches = client.stream_many(queries, verbosity="geom")
+    way_ids = set()
+    for i, elements in iterate_async(batches):
+        logger.debug(f"received {len(elements)} elements of tile {i+1}")
+        for element in elements:
+            if element["type"] == "way" and element["id"] not in way_ids:
+                way_ids.add(element["id"])
+                yield element
+
+
+# the format of Overpass timestamps, datetime.fromisoformat only accepts a trailing Z from Python 3.11
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+def parse_timestamp(timestamp: str) -> datetime:
+    return datetime.strptime(timestamp, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+
+
+class BuildingChanges(NamedTuple):
+    ways: List[Dict[str, Any]]  # building ways that changed, or of which a node changed
+    address_nodes: List[Dict[str, Any]]  # address nodes that changed
+    way_ids: Set[int]  # the ids of all current building ways
+    address_node_ids: Set[int]  # the ids of all current address nodes
+    timestamp: Optional[datetime]  # the time of the OSM data the changes are based on
+
+
+def get_buildings_changed_query(bbox, since: datetime, country_code: str) -> str:
+    bbox = f"({bbox[0]},{bbox[1]},{bbox[2]},{bbox[3]})"
+    since = since.astimezone(timezone.utc).strftime(TIMESTAMP_FORMAT)
+    # moving a node does not change the timestamp of its ways, so ways of changed nodes are included
+    return f"""
+        area["ISO3166-1"="{country_code}"]->.country;
+        node(newer:"{since}"){bbox}->.changed;
+        (
+            way[building](newer:"{since}"){bbox}(area.country);
+            way(bn.changed)[building](area.country);
+            node.changed["addr:housenumber"];
+        );
+    """
+
+
+def get_buildings_current_query(bbox, exclude_types, country_code: str) -> str:
+    bbox = f"({bbox[0]},{bbox[1]},{bbox[2]},{bbox[3]})"
+    exclude_str = "|".join(exclude_types)
+    return f"""(
+        area["ISO3166-1"="{country_code}"];
+        way[building]["building"!~"^({exclude_str})$"]{bbox}(area);
+        node["addr:housenumber"]{bbox};
+    );
+    """
+
+
+def get_building_changes(
+    bbox: BBox,
+    since: datetime,
+    exclude_types=OSMBuilding.EXCLUDE_TYPES_DEFAULT,
+    country_code="NL",
+) -> BuildingChanges:
+    """
+    Requests the building ways and address nodes in the bbox that changed since a time,
+    and the ids of all building ways and address nodes in the bbox to find deleted ones.
+    Changed ways are returned regardless of their building type, a way of an excluded type
+    is not in way_ids. Both queries bypass the Overpass cache.
+    """
+    bbox_tuple = (bbox.lat_min, bbox.lon_min, bbox.lat_max, bbox.lon_max)
+    logger.info(f"get building changes for {bbox} since {since}")
+    changed = get_pool().get(
+        get_buildings_changed_query(bbox_tuple, since, country_code),
+        use_cache=False,
+        responseformat="json",
+        verbosity="geom",
+    )
+    current = get_pool().get(
+        get_buildings_current_query(bbox_tuple, exclude_types, country_code),
+        use_cache=False,
+        responseformat="json",
+        verbosity="ids",
+    )
+    timestamp = changed.get("osm3s", {}).get("timestamp_osm_base")
+    return BuildingChanges(
+        ways=[e for e in changed["elements"] if e["type"] == "way"],
+        address_nodes=[e for e in changed["elements"] if e["type"] == "node"],
+        way_ids={e["id"] for e in current["elements"] if e["type"] == "way"},
+        address_node_ids={e["id"] for e in current["elements"] if e["type"] == "node"},
+        timestamp=parse_timestamp(timestamp) if timestamp else None,
+    )
 
 
 def get_address_nearby(lat: float, lon: float, distance: float):
@@ -161,4 +404,13 @@ def get_address_nearby(lat: float, lon: float, distance: float):
     logger.info(
         f"get nearby addresses for {lat}, {lon} within a distance of {distance} m"
     )
-    return api.get(query, responseformat="json")["elements"]
+    return get_pool().get(query, responseformat="json")["elements"]
+
+
+def get_addresses_in_bbox(bbox: BBox):
+    query = f"""(
+        node["addr:housenumber"]({bbox.lat_min},{bbox.lon_min},{bbox.lat_max},{bbox.lon_max});
+    );
+    """
+    logger.info(f"get addresses in {bbox}")
+    return get_pool().get(query, responseformat="json")["elements"]
@@ -0,0 +1,167 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import AsyncIterator
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import requests
+from overpass.errors import OverpassError
+from overpass.errors import OverpassSyntaxError
+
+from osm.core import get_pool
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncOverpassClient:
+    """
+    A thread pool behind an asyncio facade: the synchronous api (the endpoint pool by default)
+    streams each query in a worker thread, at most max_concurrent at a time.
+    A query can be retried with an increasing wait on timeouts and server errors, the pool already
+    retries on other endpoints, so by default queries are not retried here.
+    The timeout includes waiting for a free slot, so it should be well above the query budget.
+    """
+
+    MAX_CONCURRENT = 2
+    TIMEOUT_SEC = 600
+    RETRIES = 0
+    RETRY_WAIT_SEC = 10
+    STREAM_BATCH_SIZE = 200
+    STREAM_QUEUE_SIZE = 16
+
+    def __init__(
+        self,
+        overpass_api=None,
+        max_concurrent: Optional[int] = None,
+        timeout_sec: Optional[float] = None,
+        retries: Optional[int] = None,
+        retry_wait_sec: Optional[float] = None,
+    ):
+        self.api = overpass_api or get_pool()
+        self.max_concurrent = max_concurrent or self.MAX_CONCURRENT
+        self.timeout_sec = timeout_sec or self.TIMEOUT_SEC
+        self.retries = self.RETRIES if retries is None else retries
+        self.retry_wait_sec = (
+            self.RETRY_WAIT_SEC if retry_wait_sec is None else retry_wait_sec
+        )
+
+    async def stream_many(
+        self, queries: Iterable[Tuple[Any, str]], **kwargs
+    ) -> AsyncIterator[Tuple[Any, List[Any]]]:
+        """
+        Streams (key, query) pairs concurrently with api.stream, yields (key, elements) batches
+        of the queries interleaved as the responses are parsed.
+        At most STREAM_QUEUE_SIZE batches are buffered, the queries pause while the consumer is behind.
+        The timeout applies to the wait for each batch, a query is only retried before its first batch.
+        """
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(self.STREAM_QUEUE_SIZE)
+        stop = threading.Event()
+
+        def put(item) -> bool:
+            # blocks the worker thread while the queue is full, returns False once stopped
+            coroutine = queue.put(item)
+            try:
+                future = asyncio.run_coroutine_threadsafe(coroutine, loop)
+            except RuntimeError:
+                # the event loop is closed
+                coroutine.close()
+                return False
+            while True:
+                try:
+                    future.result(timeout=1)
+                    return True
+                except concurrent.futures.TimeoutError:
+                    if stop.is_set():
+                        future.cancel()
+                        return False
+
+        def produce(key: Any, query: str) -> None:
+            try:
+                self._stream(key, query, put, stop, **kwargs)
+            except Exception as e:
+                put((key, None, e))
+            else:
+                put((key, None, None))
+
+        queries = list(queries)
+        executor = ThreadPoolExecutor(self.max_concurrent)
+        for key, query in queries:
+            executor.submit(produce, key, query)
+        remaining = len(queries)
+        try:
+            while remaining > 0:
+                key, batch, error = await asyncio.wait_for(
+                    queue.get(), self.timeout_sec
+                )
+                if error is not None:
+                    raise error
+                if batch is None:
+                    remaining -= 1
+                    logger.info(
+                        f"received query {key} ({len(queries) - remaining}/{len(queries)})"
+                    )
+                    continue
+                yield key, batch
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _stream(
+        self, key: Any, query: str, put, stop: threading.Event, **kwargs
+    ) -> None:
+        for attempt in range(self.retries + 1):
+            delivered = False
+            elements = self.api.stream(query, **kwargs)
+            try:
+                batch = []
+                for element in elements:
+                    if stop.is_set():
+                        return
+                    batch.append(element)
+                    if len(batch) == self.STREAM_BATCH_SIZE:
+                        if not put((key, batch, None)):
+                            return
+                        delivered = True
+                        batch = []
+                if batch:
+                    put((key, batch, None))
+                return
+            except OverpassSyntaxError:
+                raise
+            except (OverpassError, requests.RequestException) as e:
+                if delivered or attempt == self.retries:
+                    raise
+                wait_sec = self.retry_wait_sec * 2**attempt
+                logger.warning(
+                    f"overpass query failed ({type(e).__name__}: {e}), retry in {wait_sec} s"
+                )
+                if stop.wait(wait_sec):
+                    return
+            finally:
+                elements.close()
+
+
+def iterate_async(iterator: AsyncIterator) -> Iterator:
+    """
+    Iterates an async iterator from synchronous code, in a new event loop.
+    The loop is closed once the worker threads of the iterator have finished.
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(iterator.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(iterator.aclose())
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
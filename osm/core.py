@@ -1,22 +1,569 @@
+import json
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextlib import nullcontext
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from urllib.parse import urljoin
+
 import overpass
 import requests
+from overpass.errors import MultipleRequestsError
+from overpass.errors import OverpassError
+from overpass.errors import OverpassSyntaxError
+from overpass.errors import ServerLoadError
+from overpass.errors import TimeoutError as OverpassTimeoutError
+from overpass.errors import UnknownOverpassError
 
-api = overpass.API(timeout=60)
+from cache.disk import DiskCache
+from osm.stream import JSONStreamError
+from osm.stream import ElementStream
 
+logger = logging.getLogger(__name__)
 
-def get_country_area_id():
-    query = """
-        (area["ISO3166-1"="NL"];)
+INTERPRETER_URL = "https://overpass-api.de/api/interpreter"
+
+
+class QueryCancelled(OverpassError):
+    """The query ran past its budget and was killed on the server"""
+
+
+@dataclass
+class OverpassStatus:
+    rate_limit: int
+    slots_available: int
+    slot_waits_sec: List[int] = field(default_factory=list)
+    running_queries: int = 0
+
+    @classmethod
+    def parse(cls, text: str) -> "OverpassStatus":
+        rate_limit = re.search(r"Rate limit: (\d+)", text)
+        slots_available = re.search(r"(\d+) slots? available now", text)
+        slot_waits_sec = [
+            int(wait)
+            for wait in re.findall(
+                r"Slot available after: \S+, in (-?\d+) seconds?", text
+            )
+        ]
+        running = text.split("Currently running queries", 1)
+        running_queries = 0
+        if len(running) == 2:
+            running_queries = len(re.findall(r"^\d+\s", running[1], re.MULTILINE))
+        return cls(
+            rate_limit=int(rate_limit.group(1)) if rate_limit else 0,
+            slots_available=int(slots_available.group(1)) if slots_available else 0,
+            slot_waits_sec=slot_waits_sec,
+            running_queries=running_queries,
+        )
+
+
+class OverpassScheduler:
+    """
+    Runs queries on an Overpass server when its status endpoint reports a free slot.
+    The status is cached: queries take the free slots it reported, and when none is left the
+    scheduler waits until the earliest slot time it reported instead of polling the status.
+    A query that runs longer than budget_sec, by default the HTTP timeout, is killed on the server.
+    """
+
+    TIMEOUT_SEC = 60
+    STATUS_TIMEOUT_SEC = 10
+    STATUS_MAX_AGE_SEC = 60
+    SLOT_WAIT_MIN_SEC = 1
+    SLOT_WAIT_MAX_SEC = 5 * 60
+    STREAM_CHUNK_SIZE = 65536
+
+    def __init__(
+        self,
+        url: str = INTERPRETER_URL,
+        timeout_sec: float = TIMEOUT_SEC,
+        overpass_api=None,
+        status_url: Optional[str] = None,
+        kill_url: Optional[str] = None,
+        budget_sec: Optional[float] = None,
+        sleep=None,
+        clock=time.monotonic,
+    ):
+        self.url = url
+        self.timeout_sec = timeout_sec
+        self.api = overpass_api or overpass.API(endpoint=url, timeout=timeout_sec)
+        self.status_url = status_url or urljoin(url, "status")
+        self.kill_url = kill_url or urljoin(url, "kill_my_queries")
+        # the response of a query is not read after the HTTP timeout, so it is killed then
+        self.budget_sec = timeout_sec if budget_sec is None else budget_sec
+        # by default, waiting for a slot is interrupted when a query of this scheduler finishes
+        self._sleep = sleep
+        self._clock = clock
+        self._in_flight = 0
+        # the times at which the slots of the cached status are free, None if queries are not paced
+        self._slot_times: Optional[List[float]] = None
+        self._status_expires = float("-inf")
+        self._cancel_events: Set[threading.Event] = set()
+        self._condition = threading.Condition()
+
+    def get_status(self) -> Optional[OverpassStatus]:
+        try:
+            response = requests.get(self.status_url, timeout=self.STATUS_TIMEOUT_SEC)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            logger.warning(f"overpass status unavailable: {e}")
+            return None
+        return OverpassStatus.parse(response.text)
+
+    def _update_status(self, now: float) -> None:
+        status = self.get_status()
+        self._status_expires = now + self.STATUS_MAX_AGE_SEC
+        # without status, or without a rate limit (self-hosted servers), queries are not paced
+        if status is None or status.rate_limit == 0:
+            self._slot_times = None
+            return
+        # the server may not report the queries started by this scheduler yet
+        slots_free = min(status.slots_available, status.rate_limit - self._in_flight)
+        self._slot_times = [now] * max(0, slots_free) + [
+            now + wait for wait in status.slot_waits_sec if wait > 0
+        ]
+
+    def acquire_slot(self) -> float:
+        """
+        Waits until the server has a slot that is not taken by a query of this scheduler.
+        Returns the time waited in seconds.
+        """
+        waited = 0.0
+        with self._condition:
+            while True:
+                now = self._clock()
+                if now >= self._status_expires:
+                    self._update_status(now)
+                if self._slot_times is None:
+                    break
+                slot_time = min(self._slot_times, default=None)
+                if slot_time is not None and slot_time <= now:
+                    self._slot_times.remove(slot_time)
+                    break
+                if slot_time is None:
+                    # all slots are taken by queries of this scheduler, the status is requested
+                    # again after one of them finishes
+                    wait = self.SLOT_WAIT_MIN_SEC
+                    self._status_expires = now
+                else:
+                    wait = slot_time - now
+                wait = max(self.SLOT_WAIT_MIN_SEC, min(wait, self.SLOT_WAIT_MAX_SEC))
+                logger.info(f"no free overpass slot, waiting {wait:.0f} s")
+                if self._sleep is None:
+                    self._condition.wait(wait)
+                else:
+                    self._sleep(wait)
+                waited += wait
+            self._in_flight += 1
+        return waited
+
+    def release_slot(self) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def get(self, query: str, **kwargs):
+        self.acquire_slot()
+        try:
+            return self._get_within_budget(query, **kwargs)
+        finally:
+            self.release_slot()
+
+    def _get_within_budget(self, query: str, **kwargs):
+        with self._budget() as cancelled:
+            result = self.api.get(query, **kwargs)
+        if cancelled.is_set():
+            # the response may be incomplete if the query was killed while it was sent
+            raise QueryCancelled("query killed on the server")
+        return result
+
+    @contextmanager
+    def _budget(self) -> Iterator[threading.Event]:
+        """
+        Kills the queries on the server when the block runs longer than budget_sec.
+        An error raised in the block after the kill is raised as QueryCancelled.
+        """
+        cancelled = threading.Event()
+
+        def cancel():
+            logger.warning(
+                f"overpass query running longer than {self.budget_sec} s, killing it"
+            )
+            self._cancel_all()
+            self.kill_queries()
+
+        timer = threading.Timer(self.budget_sec, cancel)
+        timer.daemon = True
+        with self._condition:
+            self._cancel_events.add(cancelled)
+        timer.start()
+        try:
+            yield cancelled
+        except Exception as e:
+            if cancelled.is_set():
+                raise QueryCancelled("query killed on the server") from e
+            raise
+        finally:
+            timer.cancel()
+            with self._condition:
+                self._cancel_events.discard(cancelled)
+
+    def _cancel_all(self) -> None:
+        # kill_queries kills all queries of this client, the running queries of this scheduler
+        # are marked as cancelled so that they fail with QueryCancelled
+        with self._condition:
+            for cancelled in self._cancel_events:
+                cancelled.set()
+            count = len(self._cancel_events)
+        if count > 1:
+            logger.warning(f"{count - 1} other overpass queries are killed too")
+
+    def stream(self, query: str, verbosity: str = "body") -> Iterator[bytes]:
+        """
+        Runs a query with a json response and yields the response body in chunks as it arrives.
+        The slot is held until the response is read completely or the generator is closed.
+        """
+        self.acquire_slot()
+        try:
+            with self._budget() as cancelled:
+                yield from self._stream_response(query, verbosity)
+            if cancelled.is_set():
+                raise QueryCancelled("query killed on the server")
+        finally:
+            self.release_slot()
+
+    def build_query(self, query: str, verbosity: str) -> str:
+        """
+        The json query of overpass.API.get, with the budget as the timeout on the server
+        """
+        query = query.rstrip()
+        if not query.endswith(";"):
+            query += ";"
+        timeout = math.ceil(self.budget_sec)
+        return f"[out:json][timeout:{timeout}];{query}out {verbosity};"
+
+    def _stream_response(self, query: str, verbosity: str) -> Iterator[bytes]:
+        # same errors as overpass.API.get, which only returns complete responses
+        full_query = self.build_query(query, verbosity)
+        try:
+            response = requests.post(
+                self.url,
+                data={"data": full_query},
+                timeout=self.timeout_sec,
+                stream=True,
+            )
+        except requests.exceptions.Timeout as e:
+            raise OverpassTimeoutError(self.timeout_sec) from e
+        with response:
+            if response.status_code == 400:
+                raise OverpassSyntaxError(full_query)
+            if response.status_code == 429:
+                raise MultipleRequestsError()
+            if response.status_code == 504:
+                raise ServerLoadError(self.timeout_sec)
+            if response.status_code != 200:
+                raise UnknownOverpassError(
+                    f"The request returned status code {response.status_code}"
+                )
+            yield from response.iter_content(chunk_size=self.STREAM_CHUNK_SIZE)
+
+    def kill_queries(self) -> None:
+        """
+        Kills all running queries of this client on the server. The server identifies a client
+        by its IP address, so the queries of other schedulers and processes on this host are killed too.
+        """
+        try:
+            requests.get(self.kill_url, timeout=self.STATUS_TIMEOUT_SEC)
+        except requests.RequestException as e:
+            logger.warning(f"failed to kill overpass queries: {e}")
+
+
+class OverpassEndpoint:
+    """
+    An Overpass server with its own slot scheduler and a health score.
+    The health score is a moving average of query successes (1) and failures (0).
+    After a failure the endpoint is not used for a backoff time with jitter,
+    that doubles with every consecutive failure.
     """
-    return api.get(query, responseformat="json")
 
+    HEALTH_DECAY = 0.8
+    HEALTH_MIN = 0.05
+    BACKOFF_BASE_SEC = 5
+    BACKOFF_MAX_SEC = 5 * 60
+
+    def __init__(
+        self,
+        url: str,
+        weight: float = 1,
+        timeout_sec: float = OverpassScheduler.TIMEOUT_SEC,
+        budget_sec: Optional[float] = None,
+        clock=time.monotonic,
+    ):
+        self.url = url
+        self.weight = weight
+        self.health = 1.0
+        self.failures = 0
+        self._clock = clock
+        self._available_after = 0.0
+        self._lock = threading.Lock()
+        self.scheduler = OverpassScheduler(url, timeout_sec, budget_sec=budget_sec)
+
+    def __str__(self):
+        return self.url
+
+    @property
+    def score(self) -> float:
+        return self.weight * max(self.health, self.HEALTH_MIN)
+
+    def backoff_remaining_sec(self) -> float:
+        return max(0.0, self._available_after - self._clock())
 
-def get_api_status():
-    return requests.get("https://overpass-api.de/api/status")
+    def record_success(self) -> None:
+        with self._lock:
+            self.health = self.HEALTH_DECAY * self.health + (1 - self.HEALTH_DECAY)
+            self.failures = 0
+            self._available_after = 0.0
 
+    def record_failure(self) -> float:
+        """
+        Lowers the health and starts a backoff, returns the backoff time in seconds.
+        """
+        with self._lock:
+            self.health = self.HEALTH_DECAY * self.health
+            self.failures += 1
+            backoff = min(
+                self.BACKOFF_MAX_SEC, self.BACKOFF_BASE_SEC * 2 ** (self.failures - 1)
+            )
+            backoff *= random.uniform(0.5, 1.5)
+            self._available_after = self._clock() + backoff
+            return backoff
 
-def kill_my_queries():
-    return requests.get("https://overpass-api.de/api/kill_my_queries")
+
+@dataclass(eq=False)
+class TimestampRecorder:
+    """
+    The oldest OSM timestamp of the Overpass responses used while recording, in the Overpass format.
+    """
+
+    oldest: Optional[str] = None
+
+    def add(self, timestamp: str) -> None:
+        # the timestamps have a fixed format, so they are ordered as strings
+        if self.oldest is None or timestamp < self.oldest:
+            self.oldest = timestamp
+
+
+class OverpassPool:
+    """
+    Routes queries to a pool of Overpass endpoints, chosen at random weighted by their score.
+    Endpoints in backoff are skipped, if all are in backoff the pool waits for the first.
+    A query that fails with a timeout, rate limit or server error is retried on the next choice.
+    With a cache, responses are stored by their normalized query and replayed without a request.
+    """
+
+    RETRIES = 3
+    RETRYABLE_ERRORS = (OverpassError, requests.RequestException)
+    RETRYABLE_STREAM_ERRORS = RETRYABLE_ERRORS + (JSONStreamError,)
+    WHITESPACE = re.compile(r"\s+")
+
+    def __init__(
+        self,
+        endpoints: List[OverpassEndpoint],
+        retries: int = RETRIES,
+        cache: Optional[DiskCache] = None,
+        sleep=time.sleep,
+    ):
+        self.endpoints = endpoints
+        self.retries = retries
+        self.cache = cache
+        self._sleep = sleep
+        self._recorders: List[TimestampRecorder] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create_endpoints(cls, configs: List[Dict[str, Any]]) -> List[OverpassEndpoint]:
+        return [OverpassEndpoint(**config) for config in configs]
+
+    @classmethod
+    def get_cache_key(cls, query: str, **kwargs) -> str:
+        options = ",".join(f"{key}={value}" for key, value in sorted(kwargs.items()))
+        return f"{options}:{cls.WHITESPACE.sub(' ', query).strip()}"
+
+    def choose(self) -> OverpassEndpoint:
+        available = [e for e in self.endpoints if e.backoff_remaining_sec() == 0]
+        if not available:
+            endpoint = min(self.endpoints, key=lambda e: e.backoff_remaining_sec())
+            wait = endpoint.backoff_remaining_sec()
+            logger.info(f"all overpass endpoints backing off, waiting {wait:.1f} s")
+            self._sleep(wait)
+            return endpoint
+        return random.choices(available, weights=[e.score for e in available])[0]
+
+    def get(self, query: str, use_cache: bool = True, **kwargs):
+        """
+        Runs a query on the endpoints. Without use_cache, a cached response is not used
+        but the response is stored, for queries that should reflect the current data.
+        """
+        if self.cache is not None:
+            key = self.get_cache_key(query, **kwargs)
+            cached = self.cache.get(key) if use_cache else None
+            if cached is not None:
+                result = json.loads(cached)
+                self._record_timestamp(result)
+                return result
+        result = self._get_from_endpoints(query, **kwargs)
+        if self.cache is not None:
+            self.cache.set(key, json.dumps(result).encode())
+        self._record_timestamp(result)
+        return result
+
+    def _get_from_endpoints(self, query: str, **kwargs):
+        for attempt in range(self.retries + 1):
+            endpoint = self.choose()
+            try:
+                result = endpoint.scheduler.get(query, **kwargs)
+            except OverpassSyntaxError:
+                raise
+            except self.RETRYABLE_ERRORS as e:
+                backoff = endpoint.record_failure()
+                logger.warning(
+                    f"overpass query on {endpoint} failed ({type(e).__name__}: {e}), "
+                    f"health {endpoint.health:.2f}, backing off {backoff:.1f} s"
+                )
+                if attempt == self.retries:
+                    raise
+                continue
+            endpoint.record_success()
+            return result
+
+    def stream(self, query: str, verbosity: str = "body") -> Iterator[Dict[str, Any]]:
+        """
+        Yields the elements of a json query one at a time while the response is read.
+        A failed query is only retried on another endpoint if no element was yielded yet.
+        With a cache, the raw response is written to the cache as it is read,
+        and only stored once it is complete.
+        """
+        key = self.get_cache_key(query, responseformat="json", verbosity=verbosity)
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                elements = ElementStream([cached])
+                yield from elements
+                self._record_timestamp(elements.header)
+                return
+        for attempt in range(self.retries + 1):
+            endpoint = self.choose()
+            chunks = endpoint.scheduler.stream(query, verbosity=verbosity)
+            yielded = False
+            try:
+                with self._cache_writer(key) as write:
+                    elements = ElementStream(self._record(chunks, write))
+                    for element in elements:
+                        yielded = True
+                        yield element
+            except OverpassSyntaxError:
+                raise
+            except self.RETRYABLE_STREAM_ERRORS as e:
+                backoff = endpoint.record_failure()
+                logger.warning(
+                    f"overpass query on {endpoint} failed ({type(e).__name__}: {e}), "
+                    f"health {endpoint.health:.2f}, backing off {backoff:.1f} s"
+                )
+                if yielded or attempt == self.retries:
+                    raise
+                continue
+            finally:
+                chunks.close()
+            endpoint.record_success()
+            self._record_timestamp(elements.header)
+            return
+
+    @contextmanager
+    def record_timestamps(self) -> Iterator[TimestampRecorder]:
+        """
+        Records the oldest OSM timestamp of the responses in the block. Cached responses keep
+        the timestamp of their request, so the data used is at least as recent as it.
+        """
+        recorder = TimestampRecorder()
+        with self._lock:
+            self._recorders.append(recorder)
+        try:
+            yield recorder
+        finally:
+            with self._lock:
+                self._recorders.remove(recorder)
+
+    def _record_timestamp(self, response: Dict[str, Any]) -> None:
+        timestamp = response.get("osm3s", {}).get("timestamp_osm_base")
+        if timestamp:
+            with self._lock:
+                for recorder in self._recorders:
+                    recorder.add(timestamp)
+
+    def _cache_writer(self, key: str):
+        if self.cache is None:
+            return nullcontext()
+        return self.cache.writer(key)
+
+    @staticmethod
+    def _record(
+        chunks: Iterator[bytes], write: Optional[Callable[[bytes], None]]
+    ) -> Iterator[bytes]:
+        for chunk in chunks:
+            if write is not None:
+                write(chunk)
+            yield chunk
+
+    def log_cache_stats(self) -> None:
+        if self.cache is not None:
+            logger.info(f"Overpass cache: {self.cache.stats}")
+
+
+_pool: Optional[OverpassPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> OverpassPool:
+    """
+    The pool of the process, configured by the OVERPASS_ settings on first use.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            from django.conf import settings
+
+            cache = None
+            if settings.CACHE_DIR is not None:
+                cache = DiskCache(
+                    os.path.join(settings.CACHE_DIR, "overpass"),
+                    ttl_sec=settings.OVERPASS_CACHE_TTL_SEC,
+                    max_size_bytes=settings.OVERPASS_CACHE_MAX_SIZE_BYTES,
+                )
+            _pool = OverpassPool(
+                OverpassPool.create_endpoints(settings.OVERPASS_ENDPOINTS),
+                retries=settings.OVERPASS_RETRIES,
+                cache=cache,
+            )
+        return _pool
+
+
+def get_country_area_id():
+    query = """
+        (area["ISO3166-1"="NL"];)
+    """
+    return get_pool().get(query, responseformat="json")
 
 
 # def shapely_to_geojson(shapely_polygon: Polygon) -> geojson.Feature:
@@ -0,0 +1,282 @@
+import bz2
+import gzip
+import json
+import logging
+from array import array
+from typing import Any
+from typing import Dict
+from typing import Iterator
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+from lxml import etree
+
+from geo.utils import BBox
+from geo.utils import haversine
+from osm.building import OSMBuilding
+
+try:
+    import osmium
+except ImportError:
+    osmium = None
+
+logger = logging.getLogger(__name__)
+
+
+class OSMExtract:
+    """
+    Building ways and address nodes from a local OSM file, like netherlands-latest.osm.pbf from Geofabrik.
+    OSM XML files (.osm, .osm.gz, .osm.bz2) are read with lxml, PBF files need the optional osmium package.
+    Elements are returned in the json format of Overpass with geometry, so an extract can replace
+    the Overpass queries of osm.building. Every query reads the whole file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+    @property
+    def is_pbf(self) -> bool:
+        return self.path.endswith(".pbf")
+
+    def iter_buildings(
+        self, exclude_types=OSMBuilding.EXCLUDE_TYPES_DEFAULT
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Yields the building ways that are not of an excluded building type.
+        """
+        exclude_types = set(exclude_types)
+        for element in self._iter_elements(ways=True):
+            if element["type"] != "way":
+                continue
+            building = element["tags"].get("building")
+            if building is not None and building not in exclude_types:
+                yield element
+
+    def iter_address_nodes(self) -> Iterator[Dict[str, Any]]:
+        for element in self._iter_elements(ways=False):
+            if "addr:housenumber" in element["tags"]:
+                yield element
+
+    def get_buildings_batches(
+        self,
+        bbox: Optional[BBox],
+        exclude_types=OSMBuilding.EXCLUDE_TYPES_DEFAULT,
+        country_code=None,
+        client=None,
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Like osm.building.get_buildings_batches, yields the buildings with bounds overlapping the bbox,
+        or all buildings without bbox.
+        The extract is expected to cover one country, country_code and client are ignored.
+        """
+        for way in self.iter_buildings(exclude_types):
+            bounds = way["bounds"]
+            if bbox is None or (
+                bounds["minlat"] <= bbox.lat_max
+                and bounds["maxlat"] >= bbox.lat_min
+                and bounds["minlon"] <= bbox.lon_max
+                and bounds["maxlon"] >= bbox.lon_min
+            ):
+                yield way
+
+    def get_addresses_in_bbox(self, bbox: BBox):
+        return [
+            node
+            for node in self.iter_address_nodes()
+            if bbox.lat_min <= node["lat"] <= bbox.lat_max
+            and bbox.lon_min <= node["lon"] <= bbox.lon_max
+        ]
+
+    def read_address_nodes(self, bbox: Optional[BBox] = None) -> "AddressNodes":
+        """
+        Reads the address nodes in the bbox, or all address nodes without bbox, packed in arrays.
+        """
+        nodes = AddressNodes()
+        for node in self.iter_address_nodes():
+            if bbox is None or (
+                bbox.lat_min <= node["lat"] <= bbox.lat_max
+                and bbox.lon_min <= node["lon"] <= bbox.lon_max
+            ):
+                nodes.append(node)
+        return nodes
+
+    def get_address_nearby(self, lat: float, lon: float, distance: float):
+        bbox = BBox(lon_min=lon, lon_max=lon, lat_min=lat, lat_max=lat).expand(distance)
+        return [
+            node
+            for node in self.get_addresses_in_bbox(bbox)
+            if haversine(lat, lon, node["lat"], node["lon"]) <= distance
+        ]
+
+    def _iter_elements(self, ways: bool) -> Iterator[Dict[str, Any]]:
+        logger.info(f"reading {'ways' if ways else 'nodes'} from {self.path}")
+        if self.is_pbf:
+            return self._iter_pbf(ways)
+        return self._iter_xml(ways)
+
+    def _iter_pbf(self, ways: bool) -> Iterator[Dict[str, Any]]:
+        if osmium is None:
+            raise ImportError("reading .pbf extracts requires the osmium package")
+        if ways:
+            processor = osmium.FileProcessor(self.path, osmium.osm.WAY)
+            processor = processor.with_locations().with_filter(
+                osmium.filter.KeyFilter("building")
+            )
+        else:
+            processor = osmium.FileProcessor(self.path, osmium.osm.NODE).with_filter(
+                osmium.filter.KeyFilter("addr:housenumber")
+            )
+        for obj in processor:
+            tags = {tag.k: tag.v for tag in obj.tags}
+            if obj.is_node():
+                yield self.create_node(obj.id, obj.location.lat, obj.location.lon, tags)
+                continue
+            if not all(node.location.valid() for node in obj.nodes):
+                continue  # a way crossing the border of the extract
+            yield self.create_way(
+                obj.id,
+                [node.ref for node in obj.nodes],
+                [node.location.lat for node in obj.nodes],
+                [node.location.lon for node in obj.nodes],
+                tags,
+            )
+
+    def _iter_xml(self, ways: bool) -> Iterator[Dict[str, Any]]:
+        # node locations are kept in arrays of 24 bytes per node to resolve the nodes of ways,
+        # nodes after the first way are ignored as in OSM files nodes come before ways,
+        # and reading stops at the first relation as relations come last
+        node_ids = array("q")
+        node_lats = array("d")
+        node_lons = array("d")
+        locations = None
+        with self._open() as file:
+            elements = etree.iterparse(file, tag=("node", "way", "relation"))
+            for _event, element in elements:
+                if element.tag == "relation":
+                    break
+                if element.tag == "node":
+                    lat, lon = float(element.get("lat")), float(element.get("lon"))
+                    if ways and locations is None:
+                        node_ids.append(int(element.get("id")))
+                        node_lats.append(lat)
+                        node_lons.append(lon)
+                    elif len(element):
+                        tags = self._get_tags(element)
+                        if "addr:housenumber" in tags:
+                            yield self.create_node(
+                                int(element.get("id")), lat, lon, tags
+                            )
+                elif ways:
+                    if locations is None:
+                        locations = self._index_locations(
+                            node_ids, node_lats, node_lons
+                        )
+                    way = self._create_way_from_xml(element, locations)
+                    if way is not None:
+                        yield way
+                else:
+                    break
+                # free the parsed elements, including preceding elements like <bounds>
+                element.clear()
+                while element.getprevious() is not None:
+                    del element.getparent()[0]
+
+    def _open(self):
+        if self.path.endswith(".gz"):
+            return gzip.open(self.path, "rb")
+        if self.path.endswith(".bz2"):
+            return bz2.open(self.path, "rb")
+        return open(self.path, "rb")
+
+    @staticmethod
+    def _get_tags(element) -> Dict[str, str]:
+        return {tag.get("k"): tag.get("v") for tag in element.iterfind("tag")}
+
+    @staticmethod
+    def _index_locations(
+        node_ids: array, node_lats: array, node_lons: array
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        ids = np.frombuffer(node_ids, dtype=np.int64)
+        lats = np.frombuffer(node_lats, dtype=np.float64)
+        lons = np.frombuffer(node_lons, dtype=np.float64)
+        # nodes are sorted by id in OSM files, but that is not required
+        if len(ids) > 1 and np.any(ids[1:] < ids[:-1]):
+            order = np.argsort(ids, kind="stable")
+            ids, lats, lons = ids[order], lats[order], lons[order]
+        return ids, lats, lons
+
+    def _create_way_from_xml(
+        self, element, locations: Tuple[np.ndarray, np.ndarray, np.ndarray]
+    ) -> Optional[Dict[str, Any]]:
+        tags = self._get_tags(element)
+        if "building" not in tags:
+            return None
+        refs = np.array(
+            [int(nd.get("ref")) for nd in element.iterfind("nd")], dtype=np.int64
+        )
+        ids, lats, lons = locations
+        indices = np.searchsorted(ids, refs)
+        indices_valid = np.minimum(indices, len(ids) - 1)
+        if len(ids) == 0 or np.any(ids[indices_valid] != refs):
+            return None  # a way crossing the border of the extract
+        return self.create_way(
+            int(element.get("id")),
+            refs.tolist(),
+            lats[indices].tolist(),
+            lons[indices].tolist(),
+            tags,
+        )
+
+    @staticmethod
+    def create_node(id: int, lat: float, lon: float, tags: Dict[str, str]):
+        return {"type": "node", "id": id, "lat": lat, "lon": lon, "tags": tags}
+
+    @staticmethod
+    def create_way(id: int, nodes, lats, lons, tags: Dict[str, str]):
+        return {
+            "type": "way",
+            "id": id,
+            "bounds": {
+                "minlat": min(lats),
+                "minlon": min(lons),
+                "maxlat": max(lats),
+                "maxlon": max(lons),
+            },
+            "nodes": nodes,
+            "geometry": [{"lat": lat, "lon": lon} for lat, lon in zip(lats, lons)],
+            "tags": tags,
+        }
+
+
+class AddressNodes:
+    """
+    A sequence of address nodes packed in arrays, to keep all address nodes of a country in memory.
+    The tags of the nodes are stored as json in one buffer, a node is created in the Overpass
+    format when it is accessed.
+    """
+
+    def __init__(self):
+        self.ids = array("q")
+        self.lats = array("d")
+        self.lons = array("d")
+        self._tags = bytearray()
+        self._tags_ends = array("q")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, i: int) -> Dict[str, Any]:
+        start = self._tags_ends[i - 1] if i > 0 else 0
+        tags = json.loads(self._tags[start : self._tags_ends[i]])
+        return OSMExtract.create_node(self.ids[i], self.lats[i], self.lons[i], tags)
+
+    def append(self, node: Dict[str, Any]) -> None:
+        self.ids.append(node["id"])
+        self.lats.append(node["lat"])
+        self.lons.append(node["lon"])
+        self._tags += json.dumps(node["tags"], separators=(",", ":")).encode()
+        self._tags_ends.append(len(self._tags))
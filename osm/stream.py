@@ -0,0 +1,128 @@
+import codecs
+import json
+from typing import Any
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+
+from overpass.errors import UnknownOverpassError
+
+
+class JSONStreamError(ValueError):
+    pass
+
+
+class ElementStream:
+    """
+    Incrementally parses an Overpass JSON response from chunks of bytes.
+    The items of the top-level "elements" array are yielded one at a time as soon as they are complete,
+    the other top-level values are parsed whole and kept in header.
+    A runtime error reported in the "remark" after the elements is raised at the end.
+    """
+
+    WHITESPACE = " \t\n\r"
+    DELIMITERS = WHITESPACE + ",:]}"
+    READ_SIZE = 65536
+
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        self._decoder = json.JSONDecoder()
+        self._utf8 = codecs.getincrementaldecoder("utf-8")()
+        self._buffer = ""
+        self._pos = 0
+        self._eof = False
+        self.header: Dict[str, Any] = {}
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        self._expect("{")
+        while True:
+            if self._peek() == "}":
+                break
+            key = self._decode()
+            self._expect(":")
+            if key == "elements":
+                yield from self._iter_array()
+            else:
+                self.header[key] = self._decode()
+            if self._peek() == ",":
+                self._pos += 1
+        remark = self.header.get("remark")
+        if remark and remark.startswith("runtime error"):
+            raise UnknownOverpassError(remark)
+
+    def _iter_array(self) -> Iterator[Dict[str, Any]]:
+        self._expect("[")
+        if self._peek() == "]":
+            self._pos += 1
+            return
+        while True:
+            yield self._decode()
+            char = self._peek()
+            self._pos += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise JSONStreamError(f"expected , or ] but found {char!r}")
+
+    def _decode(self) -> Any:
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                if not self._read():
+                    raise
+                continue
+            # a value is complete when a delimiter follows, a number like 0.6 may be cut off at 0.
+            complete = end < len(self._buffer) and self._buffer[end] in self.DELIMITERS
+            if not complete and self._read():
+                continue
+            self._pos = end
+            self._compact()
+            return value
+
+    def _peek(self) -> str:
+        while True:
+            while self._pos < len(self._buffer):
+                if self._buffer[self._pos] not in self.WHITESPACE:
+                    return self._buffer[self._pos]
+                self._pos += 1
+            if not self._read():
+                raise JSONStreamError("unexpected end of response")
+
+    def _expect(self, char: str) -> None:
+        found = self._peek()
+        if found != char:
+            raise JSONStreamError(f"expected {char!r} but found {found!r}")
+        self._pos += 1
+
+    def _read(self) -> bool:
+        """
+        Appends at least READ_SIZE characters, or the rest of the response, to the buffer.
+        Returns False if the response was already read completely.
+        """
+        if self._eof:
+            return False
+        texts = []
+        size = 0
+        for chunk in self._chunks:
+            text = self._utf8.decode(chunk)
+            texts.append(text)
+            size += len(text)
+            if size >= self.READ_SIZE:
+                break
+        else:
+            texts.append(self._utf8.decode(b"", final=True))
+            self._eof = True
+        self._buffer += "".join(texts)
+        return True
+
+    def _compact(self) -> None:
+        # drop the parsed part of the buffer once it is most of it
+        if self._pos > self.READ_SIZE and self._pos * 2 > len(self._buffer):
+            self._buffer = self._buffer[self._pos :]
+            self._pos = 0
+
+
+def iter_elements(chunks: Iterable[bytes]) -> Iterator[Dict[str, Any]]:
+    return iter(ElementStream(chunks))
@@ -1,9 +1,42 @@
+import asyncio
+import gzip
 import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from datetime import timezone
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
 from unittest import TestCase
+from unittest import mock
 
+from overpass.errors import OverpassSyntaxError
+from overpass.errors import ServerLoadError
+from overpass.errors import UnknownOverpassError
+
+from cache.disk import DiskCache
 from geo.utils import BBox
+from osm.building import OSMBuilding
 from osm.building import get_address_nearby
+from osm.building import get_addresses_in_bbox
+from osm.building import get_building_changes
 from osm.building import get_buildings_batches
+from osm.client import AsyncOverpassClient
+from osm.core import OverpassEndpoint
+from osm.core import OverpassPool
+from osm.core import OverpassScheduler
+from osm.core import OverpassStatus
+from osm.core import QueryCancelled
+from osm.extract import OSMExtract
+from osm.stream import ElementStream
+from osm.stream import iter_elements
+
+TESTDATA_DIR = os.path.join(os.path.dirname(__file__), "testdata")
 
 
 class TestGetAddressNearby(TestCase):
@@ -22,6 +55,13 @@ class TestGetAddressNearby(TestCase):
         nodes = get_address_nearby(lat, lon, distance)
         self.assertEqual(len(nodes), 12)
 
+    def test_get_addresses_in_bbox(self):
+        lat = 52.0988864
+        lon = 5.5681605
+        bbox = BBox(lat_min=lat, lon_min=lon, lat_max=lat, lon_max=lon).expand(100)
+        nodes = get_addresses_in_bbox(bbox)
+        self.assertGreaterEqual(len(nodes), 3)
+
 
 class TestGetBuildings(TestCase):
 
@@ -32,6 +72,669 @@ class TestGetBuildings(TestCase):
             lat_max=51.86140663964038,
             lon_max=6.500762549598242,
         )
-        buildings = get_buildings_batches(bbox)
+        buildings = list(get_buildings_batches(bbox))
         self.assertGreater(len(buildings), 8)
         self.assertLessEqual(len(buildings), 20)
+
+
+class TestGetBuildingChanges(TestCase):
+
+    def test_get_building_changes(self):
+        changed = {
+            "osm3s": {"timestamp_osm_base": "2024-07-21T10:15:03Z"},
+            "elements": [
+                {"type": "way", "id": 1},
+                {"type": "node", "id": 10},
+            ],
+        }
+        current = {
+            "elements": [
+                {"type": "way", "id": 1},
+                {"type": "way", "id": 2},
+                {"type": "node", "id": 10},
+            ]
+        }
+        bbox = BBox(lat_min=52.0, lon_min=5.0, lat_max=52.1, lon_max=5.1)
+        since = datetime(2024, 7, 1, tzinfo=timezone.utc)
+        with mock.patch("osm.building.get_pool") as get_pool:
+            get_pool.return_value.get.side_effect = [changed, current]
+            changes = get_building_changes(bbox, since)
+        self.assertEqual([1], [way["id"] for way in changes.ways])
+        self.assertEqual([10], [node["id"] for node in changes.address_nodes])
+        self.assertEqual({1, 2}, changes.way_ids)
+        self.assertEqual({10}, changes.address_node_ids)
+        self.assertEqual(
+            datetime(2024, 7, 21, 10, 15, 3, tzinfo=timezone.utc), changes.timestamp
+        )
+
+
+class TestOSMBuildingGeometry(TestCase):
+
+    @staticmethod
+    def create_rectangle(way_id, lat, lon, delta_lat, delta_lon):
+        points = [
+            (lat, lon),
+            (lat, lon + delta_lon),
+            (lat + delta_lat, lon + delta_lon),
+            (lat + delta_lat, lon),
+            (lat, lon),
+        ]
+        return OSMBuilding.create_from_osm_way(
+            {
+                "type": "way",
+                "id": way_id,
+                "tags": {"building": "farm_auxiliary"},
+                "geometry": [{"lat": p[0], "lon": p[1]} for p in points],
+            }
+        )
+
+    def test_area_length_width(self):
+        building = self.create_rectangle(1, 52.0, 5.0, 0.0003, 0.001)
+        length, width = building.length_width
+        self.assertAlmostEqual(length, 68.7, delta=0.1)
+        self.assertAlmostEqual(width, 33.4, delta=0.1)
+        self.assertAlmostEqual(building.area_square_meters, length * width, delta=1)
+
+    def test_calculate_geometries_batch(self):
+        buildings = [
+            self.create_rectangle(i, 52.0 + i * 0.01, 5.9 + i * 0.05, 0.0002, 0.0004)
+            for i in range(4)
+        ]
+        single = [
+            self.create_rectangle(i, 52.0 + i * 0.01, 5.9 + i * 0.05, 0.0002, 0.0004)
+            for i in range(4)
+        ]
+        OSMBuilding.calculate_geometries(buildings)
+        for building, building_single in zip(buildings, single):
+            self.assertAlmostEqual(
+                building.area_square_meters, building_single.area_square_meters
+            )
+            self.assertEqual(building.length_width, building_single.length_width)
+        self.assertEqual(len(OSMBuilding.filter_by_area(buildings)), 4)
+
+    def test_degenerate_ways(self):
+        two_nodes = OSMBuilding.create_from_osm_way(
+            {
+                "type": "way",
+                "id": 10,
+                "tags": {"building": "yes"},
+                "geometry": [{"lat": 52.0, "lon": 5.0}, {"lat": 52.001, "lon": 5.001}],
+            }
+        )
+        not_closed = self.create_rectangle(11, 52.0, 5.0, 0.0003, 0.001)
+        not_closed.lonlats = not_closed.lonlats[:-1]
+        building = self.create_rectangle(1, 52.0, 5.0, 0.0003, 0.001)
+        buildings = [two_nodes, not_closed, building]
+        OSMBuilding.calculate_geometries(buildings)
+        self.assertEqual(0, two_nodes.area_square_meters)
+        self.assertEqual((0, 0), not_closed.length_width)
+        self.assertEqual([building], OSMBuilding.filter_by_area(buildings))
+
+    def test_raw_round_trip(self):
+        way = {
+            "type": "way",
+            "id": 123456789,
+            "bounds": {
+                "minlat": 52.0,
+                "minlon": 5.0,
+                "maxlat": 52.0003,
+                "maxlon": 5.001,
+            },
+            "nodes": [9000000001, 9000000002, 9000000003, 9000000001],
+            "geometry": [
+                {"lat": 52.0, "lon": 5.0},
+                {"lat": 52.0, "lon": 5.001},
+                {"lat": 52.0003, "lon": 5.0005},
+                {"lat": 52.0, "lon": 5.0},
+            ],
+            "tags": {"building": "farm_auxiliary", "name": "Stal"},
+        }
+        building = OSMBuilding.create_from_osm_way(way)
+        self.assertEqual(way, building.raw)
+        self.assertEqual(way["geometry"], building.coordinates)
+        self.assertEqual(way["bounds"], building.bounds)
+        # without bounds and nodes in the way, the bounds are calculated from the coordinates
+        way_geometry = {key: way[key] for key in ["type", "id", "geometry", "tags"]}
+        building = OSMBuilding.create_from_osm_way(way_geometry)
+        self.assertEqual(way["bounds"], building.bounds)
+        self.assertNotIn("nodes", building.raw)
+
+
+class FakeOverpassAPI:
+    """Returns one way per bbox in a query, and the way on the tile border for every tile"""
+
+    def __init__(self, delay_sec=0.05, failures=0):
+        self.delay_sec = delay_sec
+        self.failures = failures
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.calls = 0
+
+    def get(self, query, responseformat="json", verbosity="body"):
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            fail = self.failures > 0
+            self.failures -= 1
+        try:
+            time.sleep(self.delay_sec)
+            if fail:
+                raise UnknownOverpassError("server error")
+            lat, lon = re.search(r"\(([\d.]+),([\d.]+),", query).groups()
+            return {
+                "elements": [
+                    {"type": "way", "id": hash((lat, lon))},
+                    {"type": "way", "id": 1},
+                    {"type": "node", "id": 2},
+                ]
+            }
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def stream(self, query, verbosity="body"):
+        yield from self.get(query, verbosity=verbosity)["elements"]
+
+
+class TestAsyncOverpassClient(TestCase):
+
+    def test_get_buildings_batches(self):
+        bbox = BBox(lat_min=52.0, lon_min=5.0, lat_max=52.2, lon_max=5.1)
+        overpass_api = FakeOverpassAPI()
+        client = AsyncOverpassClient(overpass_api, max_concurrent=3)
+        buildings = list(get_buildings_batches(bbox, client=client))
+        way_ids = [building["id"] for building in buildings]
+        self.assertEqual(overpass_api.calls, len(way_ids) - 1)
+        self.assertEqual(len(way_ids), len(set(way_ids)))
+        self.assertIn(1, way_ids)
+        self.assertGreater(overpass_api.max_in_flight, 1)
+        self.assertLessEqual(overpass_api.max_in_flight, 3)
+
+    def test_retry(self):
+        overpass_api = FakeOverpassAPI(failures=2)
+        client = AsyncOverpassClient(overpass_api, retries=2, retry_wait_sec=0.01)
+        buildings = list(
+            get_buildings_batches(
+                BBox(lat_min=52.0, lon_min=5.0, lat_max=52.01, lon_max=5.01),
+                client=client,
+            )
+        )
+        self.assertEqual(2, len(buildings))
+        self.assertEqual(3, overpass_api.calls)
+
+    def test_retries_exhausted(self):
+        overpass_api = FakeOverpassAPI(failures=10)
+        client = AsyncOverpassClient(overpass_api, retries=1, retry_wait_sec=0.01)
+        bbox = BBox(lat_min=52.0, lon_min=5.0, lat_max=52.01, lon_max=5.01)
+        with self.assertRaises(UnknownOverpassError):
+            list(get_buildings_batches(bbox, client=client))
+        self.assertEqual(2, overpass_api.calls)
+
+    def test_timeout(self):
+        overpass_api = FakeOverpassAPI(delay_sec=0.5)
+        client = AsyncOverpassClient(overpass_api, timeout_sec=0.05, retries=0)
+        bbox = BBox(lat_min=52.0, lon_min=5.0, lat_max=52.01, lon_max=5.01)
+        # on Python 3.10 asyncio.TimeoutError is not the builtin TimeoutError
+        with self.assertRaises(asyncio.TimeoutError):
+            list(get_buildings_batches(bbox, client=client))
+
+    def test_syntax_error_not_retried(self):
+        class SyntaxErrorAPI(FakeOverpassAPI):
+            def get(self, query, **kwargs):
+                self.calls += 1
+                raise OverpassSyntaxError(query)
+
+        overpass_api = SyntaxErrorAPI()
+        client = AsyncOverpassClient(overpass_api, retry_wait_sec=0.01)
+        bbox = BBox(lat_min=52.0, lon_min=5.0, lat_max=52.01, lon_max=5.01)
+        with self.assertRaises(OverpassSyntaxError):
+            list(get_buildings_batches(bbox, client=client))
+        self.assertEqual(1, overpass_api.calls)
+
+
+STATUS_TEXT = """Connected as: 1234567890
+Current time: 2024-07-21T10:00:00Z
+Announced endpoint: z.overpass-api.de/api/
+Rate limit: 2
+Slot available after: 2024-07-21T10:00:07Z, in 7 seconds.
+Slot available after: 2024-07-21T10:00:03Z, in 3 seconds.
+Currently running queries (pid, space limit, time limit, start time):
+1234\t536870912\t180\t2024-07-21T09:59:58Z
+"""
+
+
+class FakeScheduler(OverpassScheduler):
+    """Returns the statuses in order, the last one repeatedly, and sleeps on a fake clock"""
+
+    def __init__(self, statuses, **kwargs):
+        self.statuses = list(statuses)
+        self.status_requests = 0
+        self.sleeps = []
+        self.kills = 0
+        self.now = 0.0
+        super().__init__(sleep=self.sleep, clock=lambda: self.now, **kwargs)
+
+    def sleep(self, wait):
+        self.sleeps.append(wait)
+        self.now += wait
+
+    def get_status(self):
+        self.status_requests += 1
+        return self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+
+    def kill_queries(self):
+        self.kills += 1
+        self.api.killed.set()
+
+
+class TestOverpassScheduler(TestCase):
+
+    def test_parse_status(self):
+        status = OverpassStatus.parse(STATUS_TEXT)
+        self.assertEqual(2, status.rate_limit)
+        self.assertEqual(0, status.slots_available)
+        self.assertEqual([7, 3], status.slot_waits_sec)
+        self.assertEqual(1, status.running_queries)
+        status = OverpassStatus.parse("Rate limit: 2\n2 slots available now.\n")
+        self.assertEqual(2, status.slots_available)
+
+    def test_wait_for_slot(self):
+        busy = OverpassStatus.parse(STATUS_TEXT)
+        free = OverpassStatus(rate_limit=2, slots_available=1)
+        scheduler = FakeScheduler([busy, busy, free], overpass_api=FakeOverpassAPI())
+        scheduler.get("(way(52.0,5.0,52.1,5.1);)", responseformat="json")
+        # the slot reported to be free in 3 s is taken without requesting the status again
+        self.assertEqual([3], scheduler.sleeps)
+        self.assertEqual(1, scheduler.status_requests)
+
+    def test_status_cached(self):
+        free = OverpassStatus(rate_limit=2, slots_available=2)
+        scheduler = FakeScheduler([free])
+        self.assertEqual(0, scheduler.acquire_slot())
+        self.assertEqual(0, scheduler.acquire_slot())
+        self.assertEqual(1, scheduler.status_requests)
+        scheduler.release_slot()
+        scheduler.now += scheduler.STATUS_MAX_AGE_SEC
+        self.assertEqual(0, scheduler.acquire_slot())
+        self.assertEqual(2, scheduler.status_requests)
+
+    def test_slots_taken_by_own_queries(self):
+        # the server does not report the query started by the scheduler yet
+        scheduler = FakeScheduler([OverpassStatus(rate_limit=1, slots_available=1)])
+        self.assertEqual(0, scheduler.acquire_slot())
+
+        def sleep(wait):
+            FakeScheduler.sleep(scheduler, wait)
+            scheduler.release_slot()
+
+        scheduler._sleep = sleep
+        self.assertEqual(1, scheduler.acquire_slot())
+        self.assertEqual([1], scheduler.sleeps)
+
+    def test_no_rate_limit(self):
+        scheduler = FakeScheduler(
+            [OverpassStatus(rate_limit=0, slots_available=0)],
+            overpass_api=FakeOverpassAPI(),
+        )
+        scheduler.get("(way(52.0,5.0,52.1,5.1);)", responseformat="json")
+        self.assertEqual([], scheduler.sleeps)
+
+    def test_budget_exceeded(self):
+        class SlowAPI:
+            killed = threading.Event()
+
+            def get(self, query, **kwargs):
+                if self.killed.wait(5):
+                    raise UnknownOverpassError("runtime error: query killed")
+                return {"elements": []}
+
+        scheduler = FakeScheduler(
+            [OverpassStatus(rate_limit=2, slots_available=2)],
+            overpass_api=SlowAPI(),
+            budget_sec=0.05,
+        )
+        with self.assertRaises(QueryCancelled):
+            scheduler.get("(way(52.0,5.0,52.1,5.1);)", responseformat="json")
+        self.assertEqual(1, scheduler.kills)
+        self.assertEqual(0, scheduler._in_flight)
+
+    def test_kill_cancels_other_queries(self):
+        class SlowAPI:
+            killed = threading.Event()
+
+            def get(self, query, **kwargs):
+                if self.killed.wait(5):
+                    raise UnknownOverpassError("runtime error: query killed")
+                return {"elements": []}
+
+        scheduler = FakeScheduler(
+            [OverpassStatus(rate_limit=0, slots_available=0)],
+            overpass_api=SlowAPI(),
+            budget_sec=0.2,
+        )
+        errors = []
+
+        def get():
+            try:
+                scheduler.get("(way(52.0,5.0,52.1,5.1);)", responseformat="json")
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=get) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+            time.sleep(0.1)
+        for thread in threads:
+            thread.join()
+        # the second query is killed by the kill of the first
+        self.assertEqual([QueryCancelled, QueryCancelled], list(map(type, errors)))
+        self.assertEqual(1, scheduler.kills)
+
+    def test_budget_from_timeout(self):
+        scheduler = OverpassScheduler(timeout_sec=30)
+        self.assertEqual(30, scheduler.budget_sec)
+        self.assertEqual(
+            "[out:json][timeout:30];way(1);out geom;",
+            scheduler.build_query("way(1)", "geom"),
+        )
+        endpoint = OverpassEndpoint("https://overpass.example.org/api/interpreter")
+        self.assertEqual(
+            "https://overpass.example.org/api/status", endpoint.scheduler.status_url
+        )
+        self.assertEqual(endpoint.scheduler.timeout_sec, endpoint.scheduler.budget_sec)
+
+
+class OverpassStandInHandler(BaseHTTPRequestHandler):
+    """An Overpass server without rate limit, that answers queries according to the mode of the server"""
+
+    def do_GET(self):
+        body = b"Rate limit: 0\n" if self.path.endswith("/status") else b""
+        self.respond(200, body, "text/plain")
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.queries += 1
+        mode = self.server.mode
+        if mode == "rate_limited":
+            self.respond(429, b"", "text/plain")
+        elif mode == "overloaded":
+            self.respond(504, b"", "text/plain")
+        else:
+            if mode == "slow":
+                time.sleep(1)
+            body = json.dumps(
+                {
+                    "osm3s": {"timestamp_osm_base": "2024-07-21T10:00:00Z"},
+                    "elements": [{"type": "way", "id": 1}],
+                }
+            ).encode()
+            self.respond(200, body, "application/json")
+
+    def respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except BrokenPipeError:
+            pass  # the client timed out
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestOverpassPool(TestCase):
+
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def create_endpoint(self, mode, **kwargs) -> OverpassEndpoint:
+        server = ThreadingHTTPServer(("127.0.0.1", 0), OverpassStandInHandler)
+        server.mode = mode
+        server.queries = 0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        url = f"http://127.0.0.1:{server.server_address[1]}/api/interpreter"
+        return OverpassEndpoint(url, **kwargs)
+
+    def create_cache(self) -> DiskCache:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        return DiskCache(directory.name)
+
+    def test_failover(self):
+        rate_limited = self.create_endpoint("rate_limited")
+        ok = self.create_endpoint("ok")
+        sleeps = []
+        pool = OverpassPool([rate_limited, ok], retries=3, sleep=sleeps.append)
+        for _ in range(10):
+            result = pool.get("way(1);", responseformat="json")
+            self.assertEqual([{"type": "way", "id": 1}], result["elements"])
+        self.assertGreater(self.servers[0].queries, 0)
+        self.assertEqual(10, self.servers[1].queries)
+        self.assertLess(rate_limited.health, ok.health)
+        self.assertTrue(rate_limited.backoff_remaining_sec() > 0)
+
+    def test_timeout(self):
+        slow = self.create_endpoint("slow", timeout_sec=0.2, weight=1000)
+        ok = self.create_endpoint("ok")
+        pool = OverpassPool([slow, ok], retries=1, sleep=lambda wait: None)
+        result = pool.get("way(1);", responseformat="json")
+        self.assertEqual(1, len(result["elements"]))
+        self.assertEqual(1, slow.failures)
+
+    def test_all_failing(self):
+        endpoints = [self.create_endpoint("overloaded") for _ in range(2)]
+        sleeps = []
+        pool = OverpassPool(endpoints, retries=3, sleep=sleeps.append)
+        with self.assertRaises(ServerLoadError):
+            pool.get("way(1);", responseformat="json")
+        self.assertEqual(4, sum(server.queries for server in self.servers))
+        # after both endpoints failed, the pool waits for the first to recover
+        self.assertEqual(2, len(sleeps))
+
+    def test_cache(self):
+        ok = self.create_endpoint("ok")
+        cache = self.create_cache()
+        pool = OverpassPool([ok], cache=cache)
+        result = pool.get("way(1);\n  out;", responseformat="json")
+        result_cached = pool.get("  way(1);  out;", responseformat="json")
+        self.assertEqual(result, result_cached)
+        self.assertEqual(1, self.servers[0].queries)
+        pool.get("way(1); out;", responseformat="json", verbosity="geom")
+        self.assertEqual(2, self.servers[0].queries)
+        self.assertEqual(1, cache.stats.hits)
+        pool.get("way(1); out;", use_cache=False, responseformat="json")
+        self.assertEqual(3, self.servers[0].queries)
+
+    def test_errors_not_cached(self):
+        overloaded = self.create_endpoint("overloaded")
+        cache = self.create_cache()
+        pool = OverpassPool(
+            [overloaded], retries=0, cache=cache, sleep=lambda wait: None
+        )
+        for _ in range(2):
+            with self.assertRaises(ServerLoadError):
+                pool.get("way(1);", responseformat="json")
+        self.assertEqual(2, self.servers[0].queries)
+        self.assertEqual(0, cache.stats.writes)
+
+    def test_stream(self):
+        rate_limited = self.create_endpoint("rate_limited")
+        ok = self.create_endpoint("ok")
+        cache = self.create_cache()
+        pool = OverpassPool(
+            [rate_limited, ok], retries=3, cache=cache, sleep=lambda wait: None
+        )
+        elements = list(pool.stream("way(1);", verbosity="geom"))
+        self.assertEqual([{"type": "way", "id": 1}], elements)
+        self.assertEqual(1, self.servers[1].queries)
+        # the streamed response is cached for get and stream
+        result = pool.get("way(1);", responseformat="json", verbosity="geom")
+        self.assertEqual(elements, result["elements"])
+        self.assertEqual(elements, list(pool.stream("way(1);", verbosity="geom")))
+        self.assertEqual(1, self.servers[1].queries)
+        # a response that is not read completely is not cached
+        stream = pool.stream("way(2);", verbosity="geom")
+        next(stream)
+        stream.close()
+        self.assertEqual(1, cache.stats.writes)
+
+    def test_record_timestamps(self):
+        ok = self.create_endpoint("ok")
+        cache = self.create_cache()
+        pool = OverpassPool([ok], cache=cache)
+        # a cached response keeps the timestamp of its request
+        stale = {
+            "osm3s": {"timestamp_osm_base": "2024-07-14T08:00:00Z"},
+            "elements": [{"type": "way", "id": 2}],
+        }
+        key = OverpassPool.get_cache_key("way(2);", responseformat="json")
+        cache.set(key, json.dumps(stale).encode())
+        with pool.record_timestamps() as timestamps:
+            list(pool.stream("way(1);"))
+            self.assertEqual("2024-07-21T10:00:00Z", timestamps.oldest)
+            pool.get("way(2);", responseformat="json")
+        self.assertEqual("2024-07-14T08:00:00Z", timestamps.oldest)
+        # the replayed stream is recorded too
+        with pool.record_timestamps() as timestamps:
+            list(pool.stream("way(1);"))
+        self.assertEqual("2024-07-21T10:00:00Z", timestamps.oldest)
+        self.assertEqual(1, self.servers[0].queries)
+
+    def test_stream_all_failing(self):
+        endpoints = [self.create_endpoint("overloaded") for _ in range(2)]
+        pool = OverpassPool(endpoints, retries=1, sleep=lambda wait: None)
+        with self.assertRaises(ServerLoadError):
+            list(pool.stream("way(1);"))
+        self.assertEqual(2, sum(server.queries for server in self.servers))
+        self.assertEqual(0, endpoints[0].scheduler._in_flight)
+
+    def test_weighted_routing(self):
+        light = OverpassEndpoint("http://127.0.0.1:1/api/interpreter", weight=1)
+        heavy = OverpassEndpoint("http://127.0.0.1:2/api/interpreter", weight=9)
+        pool = OverpassPool([light, heavy])
+        counts = Counter(pool.choose().url for _ in range(1000))
+        self.assertGreater(counts[heavy.url], 800)
+        self.assertGreater(counts[light.url], 30)
+        # a failing endpoint gets less of the queries
+        for _ in range(5):
+            heavy.record_failure()
+        heavy._available_after = 0.0
+        counts = Counter(pool.choose().url for _ in range(1000))
+        self.assertLess(counts[heavy.url], 800)
+
+
+class TestElementStream(TestCase):
+    RESPONSE = {
+        "version": 0.6,
+        "osm3s": {"timestamp_osm_base": "2024-07-21T10:00:00Z"},
+        "elements": [
+            {"type": "way", "id": i, "tags": {"name": f"Straße {i}"}, "lat": 52.1 + i}
+            for i in range(100)
+        ],
+    }
+
+    @staticmethod
+    def split(data: bytes, size: int):
+        return [data[i : i + size] for i in range(0, len(data), size)]
+
+    def test_chunks(self):
+        data = json.dumps(self.RESPONSE, indent=1, ensure_ascii=False).encode()
+        for size in [1, 7, 100, len(data)]:
+            stream = ElementStream(self.split(data, size))
+            self.assertEqual(self.RESPONSE["elements"], list(stream))
+            self.assertEqual(0.6, stream.header["version"])
+
+    def test_lazy(self):
+        response = {"elements": [{"type": "way", "id": i} for i in range(10000)]}
+        data = json.dumps(response).encode()
+        chunks = iter(self.split(data, 1000))
+        elements = iter_elements(chunks)
+        self.assertEqual(0, next(elements)["id"])
+        self.assertIsNotNone(next(chunks, None))
+
+    def test_empty(self):
+        self.assertEqual([], list(iter_elements([b'{"elements": [ ]}'])))
+
+    def test_runtime_error(self):
+        data = b'{"elements": [{"id": 1}], "remark": "runtime error: Query timed out"}'
+        elements = iter_elements(self.split(data, 5))
+        self.assertEqual({"id": 1}, next(elements))
+        with self.assertRaises(UnknownOverpassError):
+            next(elements)
+
+    def test_truncated(self):
+        data = json.dumps(self.RESPONSE).encode()
+        with self.assertRaises(ValueError):
+            list(iter_elements([data[: len(data) // 2]]))
+
+
+class TestOSMExtract(TestCase):
+
+    def setUp(self):
+        self.extract = OSMExtract(os.path.join(TESTDATA_DIR, "extract.osm"))
+
+    def test_buildings(self):
+        # the house is excluded, the barn has a node outside the extract
+        buildings = list(self.extract.iter_buildings())
+        self.assertEqual([1001], [building["id"] for building in buildings])
+        building = OSMBuilding.create_from_osm_way(buildings[0])
+        self.assertEqual({"building": "farm_auxiliary"}, building.tags)
+        self.assertEqual([101, 102, 103, 104, 101], building.nodes.tolist())
+        self.assertEqual({"lat": 52.1003, "lon": 5.5705}, building.coordinates[2])
+        self.assertAlmostEqual(1140, building.area_square_meters, delta=20)
+
+    def test_buildings_in_bbox(self):
+        bbox = BBox(lat_min=52.1002, lon_min=5.5704, lat_max=52.2, lon_max=5.6)
+        self.assertEqual(1, len(list(self.extract.get_buildings_batches(bbox))))
+        bbox = BBox(lat_min=52.1004, lon_min=5.5704, lat_max=52.2, lon_max=5.6)
+        self.assertEqual(0, len(list(self.extract.get_buildings_batches(bbox))))
+
+    def test_addresses(self):
+        nodes = self.extract.get_address_nearby(52.1, 5.57, distance=200)
+        self.assertEqual([301], [node["id"] for node in nodes])
+        self.assertEqual("Postweg", nodes[0]["tags"]["addr:street"])
+        bbox = BBox(lat_min=52.09, lon_min=5.56, lat_max=52.11, lon_max=5.60)
+        self.assertEqual(2, len(self.extract.get_addresses_in_bbox(bbox)))
+
+    def test_read_address_nodes(self):
+        nodes = self.extract.read_address_nodes()
+        self.assertEqual(list(self.extract.iter_address_nodes()), list(nodes))
+        bbox = BBox(lat_min=52.09, lon_min=5.56, lat_max=52.1, lon_max=5.57)
+        nodes = self.extract.read_address_nodes(bbox)
+        self.assertEqual([301], nodes.ids.tolist())
+        self.assertEqual("Postweg", nodes[0]["tags"]["addr:street"])
+
+    def test_stop_at_relation(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "extract.osm")
+        with open(self.extract.path) as source:
+            data = source.read()
+        # a building after the first relation is not read
+        way = (
+            '<way id="1005"><nd ref="101"/><nd ref="102"/><nd ref="103"/>'
+            '<nd ref="101"/><tag k="building" v="yes"/></way>'
+        )
+        with open(path, "w") as target:
+            target.write(data.replace("</osm>", f"{way}</osm>"))
+        buildings = list(OSMExtract(path).iter_buildings())
+        self.assertEqual([1001], [building["id"] for building in buildings])
+
+    def test_compressed(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "extract.osm.gz")
+        with open(self.extract.path, "rb") as source, gzip.open(path, "wb") as target:
+            shutil.copyfileobj(source, target)
+        buildings = list(OSMExtract(path).iter_buildings())
+        self.assertEqual(list(self.extract.iter_buildings()), buildings)